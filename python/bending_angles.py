@@ -13,8 +13,6 @@ from load_contours import get_contours,make_pathdict
 # Default packages
 
 import json
-import cStringIO
-import urllib
 import time
 import random
 import os
@@ -30,8 +28,6 @@ import numpy as np
 from astropy.io import ascii,fits
 from astropy import wcs
 
-from PIL import Image
-
 from matplotlib import pyplot as plt
 from matplotlib.pyplot import cm
 from matplotlib.path import Path
@@ -417,7 +413,7 @@ def plot_one_double(zooniverse_id,pathdict,figno=1,savefig=False,anglepath='',db
 
                 # Plot the KDE map
                 colormap = colormaparr.pop()
-                ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=[xmin, xmax, ymin, ymax])
+                ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=ans['peak_data']['extent'])
         
                 # Plot individual sources
                 color = colorarr.pop()
@@ -452,14 +448,12 @@ def plot_one_double(zooniverse_id,pathdict,figno=1,savefig=False,anglepath='',db
     
     # Display IR and radio images
     
-    url_standard = subject['location']['standard']
-    im_standard = Image.open(cStringIO.StringIO(urllib.urlopen(url_standard).read()))
+    im_standard = consensus.grab_image(subject,imgtype='standard')
     ax1 = fig.add_subplot(141)
     ax1.imshow(im_standard,origin='upper')
     ax1.set_title('WISE')
 
-    url_radio = subject['location']['radio']
-    im_radio = Image.open(cStringIO.StringIO(urllib.urlopen(url_radio).read()))
+    im_radio = consensus.grab_image(subject,imgtype='radio')
     ax2 = fig.add_subplot(142)
     ax2.imshow(im_radio,origin='upper')
     ax2.set_title(subject['metadata']['source'])
@@ -634,7 +628,7 @@ def plot_one_triple(zooniverse_id,pathdict,figno=1,savefig=False,anglepath=''):
 
                 # Plot the KDE map
                 colormap = colormaparr.pop()
-                ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=[xmin, xmax, ymin, ymax])
+                ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=ans['peak_data']['extent'])
         
                 # Plot individual sources
                 color = colorarr.pop()
@@ -666,14 +660,12 @@ def plot_one_triple(zooniverse_id,pathdict,figno=1,savefig=False,anglepath=''):
     
     # Display IR and radio images
     
-    url_standard = subject['location']['standard']
-    im_standard = Image.open(cStringIO.StringIO(urllib.urlopen(url_standard).read()))
+    im_standard = consensus.grab_image(subject,imgtype='standard')
     ax1 = fig.add_subplot(141)
     ax1.imshow(im_standard,origin='upper')
     ax1.set_title('WISE')
 
-    url_radio = subject['location']['radio']
-    im_radio = Image.open(cStringIO.StringIO(urllib.urlopen(url_radio).read()))
+    im_radio = consensus.grab_image(subject,imgtype='radio')
     ax2 = fig.add_subplot(142)
     ax2.imshow(im_radio,origin='upper')
     ax2.set_title(subject['metadata']['source'])
@@ -22,8 +22,7 @@ from load_contours import get_contours,make_pathdict
 # Packges (installed by default with Python)
 
 import datetime
-import operator
-from collections import Counter
+from collections import Counter, namedtuple, OrderedDict
 import cStringIO
 import urllib
 import json
@@ -31,6 +30,15 @@ import os.path
 import time
 import shutil
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import hashlib
+import argparse
+import threading
+import Queue
+import sys
+import zlib
+import cPickle as pickle
 
 # Other packages (may need to install separately)
 
@@ -38,18 +46,25 @@ import numpy as np
 
 from matplotlib import pyplot as plt
 from matplotlib.pyplot import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.path import Path
 import matplotlib.patches as patches
 
 from scipy.ndimage.filters import maximum_filter
 from scipy import stats
-from scipy.ndimage.morphology import generate_binary_structure, binary_erosion
+from scipy.ndimage.morphology import generate_binary_structure, binary_erosion, binary_dilation
+from scipy.signal import fftconvolve
+from scipy.sparse import coo_matrix
 from scipy.linalg.basic import LinAlgError
 
 from astropy.io import fits
 
 from pymongo import ASCENDING
+from pymongo import DESCENDING
 from pymongo import MongoClient
+from pymongo import version_tuple as pymongo_version
+from bson import json_util, ObjectId
 
 from PIL import Image
 
@@ -64,6 +79,7 @@ subjects = db['radio_subjects'] # subjects = images
 classifications = db['radio_classifications'] # classifications = classifications of each subject per user
 consensus = db['consensus{}'.format(version)] # consensus = output of this program
 user_weights = db['user_weights{}'.format(version)]
+weight_params = db['user_weights{}_params'.format(version)] # parameters used by weight_users
 
 logfile = 'consensus{}.log'.format(version)
 
@@ -99,6 +115,21 @@ img_params = {
 
 bad_keys = ('finished_at','started_at','user_agent','lang','pending')
 
+# Fields of a classification used by the consensus; nothing else is retrieved from Mongo
+
+classification_fields = {'subject_ids':1,'user_name':1,'created_at':1,'updated_at':1,'expert':1,'annotations':1}
+
+# Keeps the server from closing a cursor that's read slowly; the option was renamed in pymongo 3
+
+no_timeout = {'no_cursor_timeout':True} if pymongo_version[0] >= 3 else {'timeout':False}
+
+# Methods available for the kernel density estimate of the IR host positions:
+#   'grid': evaluate scipy.stats.gaussian_kde directly at every pixel of the survey grid (original method)
+#   'fft':  bin the clicks onto the survey grid and convolve with the same Gaussian kernel via FFT
+#   'meanshift': no grid; find the modes of the same KDE by mean-shift, seeded from the clicks
+
+kde_engines = ('grid','fft','meanshift')
+
 # Local directory paths. Add paths below depending on your local source for:
 #   - raw FITS images of radio data (data_path)
 #   - PNG images of radio and IR subjects (data_path)
@@ -125,16 +156,642 @@ plot_path = "{0}/rgz/plots".format(data_path)
 
 pathdict = make_pathdict()
 
+# On-disk cache of the results of checksum(), so that scripts asking for the consensus of the same
+# subjects again don't have to redo it (see cached_consensus). The oldest results are thrown out
+# once it's bigger than cache_max_bytes. Change cache_format if the consensus itself changes.
+
+cache_path = '{0}/cache/consensus'.format(rgz_path) if rgz_path is not None else None
+cache_max_bytes = 2 * 1024**3
+cache_format = 3
+
+# Local store of the subject images downloaded by grab_image, and the number of decoded images kept
+# in memory. Set image_url_base to download the images from somewhere else (eg. a local test server)
+# instead of the URLs in the subjects.
+
+image_store_path = '{0}/cache/images'.format(rgz_path) if rgz_path is not None else None
+image_lru_size = 64
+image_url_base = None
+
 ########################################
 # Begin the actual code
 ########################################
 
-def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_data=True,weights=0,scheme='scaling'):
+# Pixel grids are identical for every subject in a survey, so only build them once
+_survey_grids = {}
+
+def survey_grid(survey):
+
+    # Return the grid of uniform coordinates (X,Y) over the IR pixel plane and the flattened
+    # list of positions, built from img_params and cached for the rest of the run
+
+    if not _survey_grids.has_key(survey):
+        xmin = 1.
+        xmax = img_params[survey]['IMG_HEIGHT_NEW']
+        ymin = 1.
+        ymax = img_params[survey]['IMG_WIDTH_NEW']
+
+        X, Y = np.mgrid[xmin:xmax, ymin:ymax]
+        positions = np.vstack([X.ravel(), Y.ravel()])
+
+        # Shared between all answers, so make sure nothing modifies them in place
+        for arr in (X,Y,positions):
+            arr.flags.writeable = False
+
+        _survey_grids[survey] = (X,Y,positions)
+
+    return _survey_grids[survey]
+
+def kde_bandwidth(values):
+
+    # Covariance of the Gaussian kernel chosen by scipy.stats.gaussian_kde (Scott's rule in 2 dimensions)
+
+    n = values.shape[1]
+    return np.cov(values) * n**(-2./6)
+
+def kernel_weights(dx,dy,inv):
+
+    # Unnormalized Gaussian kernel at offsets (dx,dy), given the inverse of its covariance matrix
+
+    return np.exp(-0.5*(inv[0,0]*dx**2 + 2*inv[0,1]*dx*dy + inv[1,1]*dy**2))
+
+def kde_grid(values,survey):
+
+    # Evaluate the kernel density estimate of the clicks at every pixel of the survey grid
+
+    X, Y, positions = survey_grid(survey)
+    kernel = stats.gaussian_kde(values)
+    kp = kernel(positions)
+
+    return np.reshape(kp.T, X.shape)
+
+def kde_fft(values,survey,nsigma=5,min_bandwidth=2.):
+
+    # Same density as kde_grid, but the clicks are linearly binned onto the survey grid and
+    # convolved with the Gaussian kernel via FFT. Cost no longer scales with (clicks x pixels).
+
+    X, Y, positions = survey_grid(survey)
+    nx,ny = X.shape
+    n = values.shape[1]
+
+    cov = kde_bandwidth(values)
+    det = np.linalg.det(cov)
+    if not det > 0:
+        # Co-linear points; gaussian_kde fails or returns NaNs in this case as well
+        return np.nan * np.ones(X.shape)
+    if np.linalg.eigvalsh(cov)[0] < min_bandwidth**2:
+        # Nearly co-linear points give a kernel only a pixel or so wide across the line, which
+        # can't be represented by binning. Evaluate the density directly instead.
+        return kde_grid(values,survey)
+    inv = np.linalg.inv(cov)
+
+    # Truncate the kernel at nsigma along each axis. Pad the grid by the same amount so that
+    # clicks just outside the image still contribute to the density at the edges.
+    hx = min(int(np.ceil(nsigma*np.sqrt(cov[0,0]))),nx)
+    hy = min(int(np.ceil(nsigma*np.sqrt(cov[1,1]))),ny)
+
+    # Share each click between the four nearest pixels (linear binning)
+    gx = values[0] - X[0,0] + hx
+    gy = values[1] - Y[0,0] + hy
+    ix = np.floor(gx).astype(int)
+    iy = np.floor(gy).astype(int)
+    fx = gx - ix
+    fy = gy - iy
+
+    counts = np.zeros((nx+2*hx,ny+2*hy))
+    for dx,wx in ((0,1-fx),(1,fx)):
+        for dy,wy in ((0,1-fy),(1,fy)):
+            xi = ix + dx
+            yi = iy + dy
+            inside = (xi >= 0) & (xi < counts.shape[0]) & (yi >= 0) & (yi < counts.shape[1])
+            np.add.at(counts,(xi[inside],yi[inside]),(wx*wy)[inside])
+
+    ddx,ddy = np.mgrid[-hx:hx+1,-hy:hy+1]
+    kernel = kernel_weights(ddx,ddy,inv) / (2*np.pi*np.sqrt(det)*n)
+
+    Z = fftconvolve(counts,kernel,mode='same')[hx:hx+nx,hy:hy+ny]
+
+    # Remove the FFT round-off noise far from the clicks, so it isn't mistaken for peaks
+    Z[Z < Z.max()*1e-10] = 0.
+
+    return Z
+
+def kde_peak_fft(Z,values,survey,tol=5e-2):
+
+    # Binning can swap the order of nearly equal modes. Re-evaluate the exact density on the
+    # pixels around every candidate within tol of the maximum, and keep the highest one.
+
+    X, Y, positions = survey_grid(survey)
+
+    candidates = binary_dilation(Z >= Z.max()*(1-tol), structure=np.ones((3,3)))
+    idx = np.flatnonzero(candidates)
+
+    inv = np.linalg.inv(kde_bandwidth(values))
+    dx = X.flat[idx][:,np.newaxis] - values[0]
+    dy = Y.flat[idx][:,np.newaxis] - values[1]
+    density = kernel_weights(dx,dy,inv).sum(axis=1)
+
+    best = idx[density.argmax()]
+
+    return float(X.flat[best]), float(Y.flat[best])
+
+def meanshift_peak(values,survey,tol=1e-4,max_iter=2000,merge_radius=0.5,min_bandwidth=1.,footprint=10):
+
+    # Find the modes of the kernel density estimate without evaluating it over the whole grid. Every
+    # distinct click is moved uphill by mean-shift (with the same kernel that gaussian_kde would use)
+    # until it converges on a mode. Returns the position of the highest peak and the number of peaks.
+    #
+    # Mean-shift slows down on the flat shoulders of the density, so each click is followed until
+    # its own step is below tol of the kernel width. Clicks that end up closer than merge_radius
+    # kernel widths (in the metric of the kernel) are on the same mode. As with the other engines,
+    # the peaks are pixels of the survey grid, and a mode is only counted as a peak if it's the
+    # highest pixel in the neighbourhood used by count_peaks.
+
+    X, Y, positions = survey_grid(survey)
+    nx, ny = X.shape
+
+    cov = kde_bandwidth(values)
+
+    # Co-linear clicks make the kernel singular. Give it a minimum width (in pixels) across the
+    # line, so the modes are still found along it instead of failing.
+    w, v = np.linalg.eigh(cov)
+    if not w[0] > w[1]*1e-10:
+        w[0] = max(w[0],min_bandwidth**2)
+        cov = np.dot(v*w,v.T)
+    inv = np.linalg.inv(cov)
+    step = tol * np.sqrt(w[0])
+
+    x, y = values
+    seeds = np.array(sorted(set(zip(x,y))))
+    xm, ym = seeds[:,0].copy(), seeds[:,1].copy()
+
+    active = np.arange(len(xm))
+    for i in range(max_iter):
+        weights = kernel_weights(xm[active,np.newaxis]-x,ym[active,np.newaxis]-y,inv)
+        norm = weights.sum(axis=1)
+        xnew = np.dot(weights,x)/norm
+        ynew = np.dot(weights,y)/norm
+        shift = np.hypot(xnew-xm[active],ynew-ym[active])
+        xm[active], ym[active] = xnew, ynew
+        active = active[shift >= step]
+        if len(active) == 0:
+            break
+
+    # Merge seeds that converged on the same mode, starting from the highest
+    density = kernel_weights(xm[:,np.newaxis]-x,ym[:,np.newaxis]-y,inv).sum(axis=1)
+    modes = []
+    for j in np.argsort(-density,kind='mergesort'):
+        dx, dy = xm[j]-xm[modes], ym[j]-ym[modes]
+        if not (inv[0,0]*dx**2 + 2*inv[0,1]*dx*dy + inv[1,1]*dy**2 < merge_radius**2).any():
+            modes.append(j)
+
+    # Climb from each mode to a pixel that's the highest in its neighbourhood, as the peaks are
+    # found by count_peaks on the grid (pixel (i,j) of the grid is at X = 1+i, Y = 1+j)
+    h = footprint//2
+    peaks, heights = [], []
+    for j in modes:
+        pixel = (min(max(int(round(xm[j]-X[0,0])),0),nx-1),min(max(int(round(ym[j]-Y[0,0])),0),ny-1))
+        while True:
+            ii, jj = np.mgrid[max(pixel[0]-h,0):min(pixel[0]-h+footprint,nx),max(pixel[1]-h,0):min(pixel[1]-h+footprint,ny)]
+            ii, jj = ii.ravel(), jj.ravel()
+            around = kernel_weights(X[ii,jj][:,np.newaxis]-x,Y[ii,jj][:,np.newaxis]-y,inv).sum(axis=1)
+            top = (int(ii[around.argmax()]),int(jj[around.argmax()]))
+            if top == pixel or around[(ii == pixel[0]) & (jj == pixel[1])][0] >= around.max():
+                break
+            pixel = top
+        if pixel not in peaks:
+            peaks.append(pixel)
+            heights.append(around.max())
+
+    best = peaks[int(np.argmax(heights))]
+
+    return float(X[best]), float(Y[best]), len(peaks)
+
+def peak_tile(Z,rel=1e-4):
+
+    # Crop the KDE over the survey grid to the region around the clicks (every pixel above rel of the
+    # peak), stored as float32. The pixel grid itself is the same for every subject, so instead of
+    # X and Y only the extent of the tile in image coordinates is kept, as used by imshow.
+
+    # A density that couldn't be found (eg. for co-linear clicks) is kept over the whole grid
+    if not np.isfinite(Z).all() or not Z.max() > 0:
+        return {'Z':Z.astype(np.float32),'extent':[1,1+Z.shape[0],1,1+Z.shape[1]]}
+
+    above = Z >= rel * Z.max()
+    rows = np.flatnonzero(above.any(axis=1))
+    cols = np.flatnonzero(above.any(axis=0))
+    i0,i1 = int(rows[0]),int(rows[-1])+1
+    j0,j1 = int(cols[0]),int(cols[-1])+1
+
+    # Pixel (i,j) of the survey grid is at X = 1+i, Y = 1+j (see survey_grid)
+    tile = {'Z':Z[i0:i1,j0:j1].astype(np.float32),
+            'extent':[1+i0,1+i1,1+j0,1+j1]}
+
+    return tile
+
+def meanshift_density(values,survey):
+
+    # The KDE over the survey grid, for the peak data of the mode finder (which doesn't need a grid
+    # itself). The FFT engine is used where it can find the density; for co-linear clicks the KDE
+    # is evaluated at every pixel instead, as with the grid engine, which may still give NaNs.
+
+    Z = kde_fft(values,survey)
+    if not np.isfinite(Z).all():
+        try:
+            Z = kde_grid(values,survey)
+        except LinAlgError:
+            pass
+
+    return Z
+
+def peak_density(pd,survey):
+
+    # Expand a tile of peak data back to the KDE over the whole survey grid (zero outside the tile)
+
+    X, Y, positions = survey_grid(survey)
+    x0,x1,y0,y1 = pd['extent']
+    Z = np.zeros(X.shape,dtype=np.float32)
+    Z[x0-1:x1-1,y0-1:y1-1] = pd['Z']
+
+    return Z
+
+def peak_data_json(pd):
+
+    # Peak data in a form that can be written to JSON
+
+    return {'Z':pd['Z'].tolist(),'extent':pd['extent'],'npeaks':int(pd['npeaks'])}
+
+def count_peaks(Z):
+
+    # Find the number of peaks in the kernel
+    # http://stackoverflow.com/questions/3684484/peak-detection-in-a-2d-array
+
+    neighborhood = np.ones((10,10))
+    local_max = maximum_filter(Z, footprint=neighborhood)==Z
+    background = (Z==0)
+    eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
+    detected_peaks = local_max ^ eroded_background
+
+    return detected_peaks.sum()
+
+# Agreement of each user with the science team, loaded from the user_weights collection the first
+# time it's needed, the parameters weight_users found it with, and the extra votes it gives them
+# under each weighting scheme
+_weight_table = None
+_weight_params = None
+_variant_tables = {}
+
+default_weight_params = {'min_gs':5,'min_agree':0.5}
+
+def get_user_weights(reload=False):
+
+    # Return a dictionary of (agreed, gs_seen, weight) for every user in the user_weights collection.
+    # It's loaded with a single query, rather than looking up each classification as it's counted.
+
+    global _weight_table, _weight_params
+
+    if _weight_table is None or reload:
+        _weight_table = {}
+        _variant_tables.clear()
+        for u in user_weights.find({},{'user_name':1,'agreed':1,'gs_seen':1,'weight':1}):
+            _weight_table[u['user_name']] = (u.get('agreed',0),u.get('gs_seen',0),u.get('weight',0))
+
+        # Weights saved before the parameters were recorded used the defaults
+        _weight_params = dict(default_weight_params)
+        saved = weight_params.find_one({'_id':'parameters'})
+        if saved is not None:
+            _weight_params.update([(k,saved[k]) for k in default_weight_params if saved.has_key(k)])
+
+    return _weight_table
+
+def get_weight_params():
+
+    # Thresholds (min_gs, min_agree) that weight_users used for the weights in the user_weights collection
+
+    get_user_weights()
+
+    return _weight_params
+
+def scheme_weights(agreed,gs_seen,scheme,scaling,min_gs=5,min_agree=0.5):
+
+    # Weights for arrays of users from the number of gold standard subjects they've seen and agreed
+    # with the science team on. 'threshold' gives 1 to users above the agreement level, and 'scaling'
+    # gives a weight proportional to the agreement.
+
+    agreed = np.asarray(agreed,dtype=int)
+    gs_seen = np.asarray(gs_seen,dtype=int)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        agreement = agreed / gs_seen.astype(float)
+        scaled = scaling * agreed / gs_seen.astype(float)
+    
+    if scheme == 'threshold':
+        weight = ((gs_seen > min_gs) & (agreement > min_agree)).astype(int)
+    elif scheme == 'scaling':
+        # Round half away from zero, as with the builtin round()
+        weight = np.where(gs_seen > min_gs, np.floor(scaled + 0.5), 0).astype(int)
+    else:
+        weight = np.zeros(len(agreed),dtype=int)
+
+    return weight
+
+def variant_weights(scheme,weights,recompute=False):
+
+    # Dictionary of the number of extra votes for each upweighted user under a weighting scheme. By
+    # default they come from the weight stored for each user by weight_users: 'threshold' gives
+    # weights extra votes to users with a weight of 1, and 'scaling' gives each user their weight.
+    # For the variants of a sweep (recompute=True), the weights are found again from each user's
+    # agreement with the science team, with the same thresholds as weight_users used.
+
+    key = (scheme,weights,recompute)
+
+    if not _variant_tables.has_key(key):
+        table = get_user_weights()
+        users = table.keys()
+        if recompute:
+            agreed = [table[u][0] for u in users]
+            gs_seen = [table[u][1] for u in users]
+            params = get_weight_params()
+            weight = scheme_weights(agreed,gs_seen,scheme,weights,params['min_gs'],params['min_agree'])
+        else:
+            weight = [table[u][2] for u in users]
+            if scheme == 'threshold':
+                weight = [int(w == 1) for w in weight]
+        if scheme == 'threshold':
+            weight = np.asarray(weight) * weights
+        _variant_tables[key] = dict([(u,int(w)) for u,w in zip(users,weight) if w > 0])
+
+    return _variant_tables[key]
+
+def ir_consensus(xv,yv,survey,zid=None,xk=0,include_peak_data=True,kde='grid'):
+
+    # Find the IR counterpart of a single radio source from the IR clicks of all users who agreed on
+    # the consensus (in Mongo coordinates; -99 for "No Sources"). Returns the fields to add to its answer.
+
+    ir = {}
+    pd = {}
+
+    scale_ir = img_params[survey]['IMG_HEIGHT_NEW'] * 1./img_params[survey]['IMG_HEIGHT_OLD']
+
+    # Convert into the same scale as the radio coordinates
+    x_exists = [xt * scale_ir for xt in xv if xt != -99.0]
+    y_exists = [yt * scale_ir for yt in yv if yt != -99.0]
+
+    # Find the most common IR coordinate. We want to skip the next steps
+    # if they said there was no IR counterpart (-99,-99)
+    ir_Counter = Counter([(xx,yy) for xx,yy in zip(xv,yv)])
+    most_common_ir = ir_Counter.most_common(1)[0][0]
+
+    xmin = 1.
+    xmax = img_params[survey]['IMG_HEIGHT_NEW']
+
+    # Check if there are enough IR points to attempt a kernel density estimate
+    if len(Counter(x_exists)) > 2 and len(Counter(y_exists)) > 2 and most_common_ir != (-99,-99):
+
+        try:
+            values = np.vstack([x_exists, y_exists])
+        except ValueError:
+            # Breaks on the tutorial subject. Find out why len(x) != len(y)
+            print zid
+            print 'Length of IR x array: {0:d}; Length of IR y array: {1:d}'.format(len(x_exists),len(y_exists))
+            logging.warning((zid, 'Length of IR x array: {0:d}; Length of IR y array: {1:d}'.format(len(x_exists),len(y_exists))))
+
+        if kde == 'meanshift':
+
+            # Gridless: follow each click uphill to a mode of the KDE. Co-linear clicks are
+            # handled by the mode finder itself, so no fallback to the mean is needed.
+            xpeak, ypeak, npeaks = meanshift_peak(values,survey)
+            Z = None
+
+        else:
+
+            # X,Y = grid of uniform coordinates over the IR pixel plane
+            X, Y, positions = survey_grid(survey)
+
+            try:
+                # Compute the kernel density estimate over the pixel grid
+                if kde == 'fft':
+                    Z = kde_fft(values,survey)
+                else:
+                    Z = kde_grid(values,survey)
+            except LinAlgError:
+                print 'LinAlgError in KD estimation for {0}'.format(zid,x_exists,y_exists)
+                logging.warning('LinAlgError in KD estimation for {0}'.format(zid,x_exists,y_exists))
+                Z = None
+
+            # Even if there are more than 2 sets of points, if they are mutually co-linear,
+            # matrix can't invert and kernel returns NaNs.
+
+            # Check to see if there are NaNs in the kernel (usually a sign of co-linear points).
+            if Z is not None and np.isnan(Z).sum() > 0:
+                acp = collinearity.collinear(x_exists,y_exists)
+                if len(acp) > 0:
+                    output = 'There are {0:d} unique points for {1} (source no. {2:d} in the field), but all are co-linear; KDE estimate does not work.'.format( \
+                        len(Counter(x_exists)),zid,xk)
+                else:
+                    output = 'There are NaNs in the KDE for {0} (source no. {1:d} in the field), but points are not co-linear.'.format(zid,xk)
+                logging.info(output)
+                Z = None
+
+            # Kernel is finite; should be able to get a position
+            if Z is not None:
+
+                # The number of peaks is only kept with the peak data; skip the
+                # (expensive) filtering over the full grid if it won't be saved
+                if include_peak_data:
+                    npeaks = count_peaks(Z)
+
+                try:
+                    # Peak values in the kernel are what we take as the final IR location
+                    if kde == 'fft':
+                        xpeak, ypeak = kde_peak_fft(Z,values,survey)
+                    else:
+                        xpeak = float(X[Z==Z.max()][0])
+                        ypeak = float(Y[Z==Z.max()][0])
+                except IndexError:
+                    # Print results to screen if it doesn't match
+                    print zid, x_exists, y_exists
+                    logging.warning((zid, x_exists, y_exists))
+
+        if kde == 'meanshift' or Z is not None:
+            ir['ir_peak'] = (xpeak,ypeak)
+            ir['ir_flag'] = 1
+            # Don't write to consensus for serializable JSON object
+            if include_peak_data:
+                # The mode finder doesn't need a grid; only evaluate one if it's going to be plotted
+                pd.update(peak_tile(Z if Z is not None else meanshift_density(values,survey)))
+                pd['npeaks'] = npeaks
+                ir['peak_data'] = pd
+                ir['ir_x'] = x_exists
+                ir['ir_y'] = y_exists
+        else:
+            xpeak, ypeak = np.mean(x_exists), np.mean(y_exists)
+            ir['ir'] = (xpeak, ypeak)
+            ir['ir_flag'] = 0
+
+    # Couldn't attempt a KDE; too few IR points in consensus
+
+    # Note: need to actually put a limit in if less than half of users selected IR counterpart.
+    # Right now it still IDs a source even if only, say, 1/10 users said it was there.
+
+    # Case 1: multiple users selected IR source, but not enough unique points to pinpoint peak
+    elif most_common_ir != (-99,-99) and len(x_exists) > 0 and len(y_exists) > 0:
+        xpeak, ypeak = np.mean(x_exists), np.mean(y_exists)
+        ir['ir'] = (xpeak, ypeak)
+        ir['ir_flag'] = 0
+
+    # Case 2: most users have selected No Sources
+    else:
+        ir['ir'] = (-99,-99)
+        ir['n_ir'] = xv.count(-99)
+        ir['ir_level'] = 1.0*xv.count(-99)/len(xv)
+        ir['ir_flag'] = 0
+        return ir
+
+    # Count the number of clicks within 3"
+    dist = np.sqrt(np.square(xpeak-np.array(x_exists))+np.square(ypeak-np.array(y_exists)))
+    agreed = int((dist <= (xmax-xmin)/60.).sum())
+    ir['n_ir'] = agreed
+    ir['ir_level'] = 1.0*agreed/len(xv)
+
+    return ir
+
+# One galaxy (radio source) marked in a classification:
+#   xmax: xmax coordinates of its radio components (None if there were no contours)
+#   bbox: bounding boxes of its radio components as (xmax,ymax,xmin,ymin)
+#   ir:   position of the first IR click; (-99,-99) for "No Sources" and None if there was no IR marking
+#   comps: exact key for its set of radio components (see component_key); () if there were no contours
+#   n_clicks: number of IR sources marked; 0 for "No Sources" and None if there was no IR marking
+
+Galaxy = namedtuple('Galaxy',('xmax','bbox','ir','comps','n_clicks'))
+
+class Classification(object):
+
+    # Compact version of a single classification. The annotations are parsed once when the
+    # record is built, so nothing downstream needs to look at the raw document again.
+
+    __slots__ = ('_id','subject_ids','user_name','created_at','updated_at','expert','galaxies','n_galaxies','checksum')
+
+    def __init__(self,c):
+
+        self._id = c.get('_id')
+        self.subject_ids = c.get('subject_ids',[])
+        self.user_name = c.get('user_name')         # None for anonymous users
+        self.created_at = c.get('created_at')
+        self.updated_at = c.get('updated_at')
+        self.expert = c.get('expert',False)
+
+        # Only keep data that was an actual marking, not metadata
+        self.galaxies = [parse_galaxy(ann) for ann in c['annotations'] if ann.keys()[0] not in bad_keys]
+        self.n_galaxies = len(self.galaxies)
+
+        # Key for the combination of radio components; -99 if there aren't any
+        self.checksum = combination_key(self.galaxies)
+
+def parse_galaxy(ann):
+
+    # Normalize a single annotation into a Galaxy
+
+    try:
+        radio_comps = ann['radio']
+        if radio_comps == 'No Contours':
+            xmax, bbox = None, None
+        else:
+            comps = radio_comps.values()
+            xmax = tuple([float(v['xmax']) for v in comps])
+            bbox = tuple([(v['xmax'],v['ymax'],v['xmin'],v['ymin']) for v in comps])
+    except KeyError:
+        # No radio data for this classification
+        xmax, bbox = None, None
+
+    comps = tuple(sorted([component_key(b) for b in bbox])) if bbox is not None else ()
+
+    if not ann.has_key('ir'):
+        ir, n_clicks = None, None
+    elif ann['ir'] == 'No Sources':
+        ir, n_clicks = (-99,-99), 0
+    else:
+        # Only takes the first IR source if there is more than one.
+        ir = (float(ann['ir']['0']['x']),float(ann['ir']['0']['y']))
+        n_clicks = len(ann['ir'])
+
+    return Galaxy(xmax,bbox,ir,comps,n_clicks)
+
+def component_key(bbox):
+
+    # Key for a single radio component from its bounding box (xmax,ymax,xmin,ymin). The annotations
+    # copy the bounding boxes from the contour files, sometimes as strings, so they're compared
+    # as floats rounded well below the size of a pixel.
+
+    return tuple([round(float(v),3) for v in bbox])
+
+def component_index(contours):
+
+    # Index of the radio components in a subject's contour file: their bounding boxes, as an array
+    # whose row i is component i (see find_component)
+
+    return np.array([[float(v) for v in comp[0]['bbox']] for comp in contours['contours']]).reshape(-1,4)
+
+def find_component(index,bbox,tol=1e-2):
+
+    # Position in the contour file of the radio component with a bounding box (xmax,ymax,xmin,ymin),
+    # from the index made by component_index. The copies of the bounding boxes in the annotations
+    # can differ in the last digits, so the closest component within tol (in pixels) is taken;
+    # None if there isn't one.
+
+    if len(index) == 0:
+        return None
+
+    diff = np.abs(index - [float(v) for v in bbox]).max(axis=1)
+    i = int(diff.argmin())
+
+    return i if diff[i] <= tol else None
 
-    # Find the consensus for all users who have classified a subject
+def combination_key(galaxies):
+
+    # Exact key for the combination of radio components marked in a classification: the component
+    # keys of each galaxy, in a fixed order. Classifications with no galaxies, or only one with no
+    # contours, get -99, which never counts as a consensus.
+
+    key = tuple(sorted([gal.comps for gal in galaxies]))
+    if key in ((),((),)):
+        return -99
+
+    return key
+
+def answer_key(gal):
+
+    # Key for a galaxy in the answer of a consensus: its radio components (see component_key), as
+    # a string so that it can be written to JSON. Two galaxies only get the same key if they have
+    # exactly the same components; -99 if there were no contours.
+
+    if gal.xmax is None:
+        return -99
+    return ';'.join([','.join(['{0:.3f}'.format(v) for v in comp]) for comp in gal.comps])
+
+def find_classifications(class_params):
+
+    # Query for classifications, returning only the fields needed as compact records
+
+    return [Classification(c) for c in classifications.find(class_params,classification_fields)]
+
+def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_data=True,weights=0,scheme='scaling',kde='grid',top_k=1,ir_count=False,cache=True):
+
+    # Find the consensus for all users who have classified a subject. With cache=True, a result
+    # saved by an earlier call with the same parameters is used if the classifications haven't
+    # changed since: the subject must have the same classification count, and none of its
+    # classifications can have been updated since (an edit doesn't change the count).
     sub = subjects.find_one({'zooniverse_id':zid})
     imgid = sub['_id']
-    survey = sub['metadata']['survey']
+
+    cache = cache and cache_path is not None
+    if cache:
+        params = (experts_only,sorted(excluded) if isinstance(excluded,list) else excluded,no_anonymous, \
+                  include_peak_data,weights,scheme,kde,top_k,ir_count)
+        path = cache_file(zid,params)
+        entry = read_cache(path)
+        latest = latest_update(imgid)
+        if fresh_cache(entry,sub,weights,scheme,latest=latest):
+            return unpack_cached(entry,path)
     
     # Classifications for this subject after launch date
     class_params = {"subject_ids": imgid, "updated_at": {"$gt": main_release_date}}
@@ -153,10 +810,197 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
         else:
             class_params['user_name'] = {"$exists":True}
     
-    _c = classifications.find(class_params)
-    
+    _c = find_classifications(class_params)
+
+    if cache:
+        # The classifications might be just the same, even if the subject's count has changed
+        fingerprint = classification_fingerprint(_c)
+        if fresh_cache(entry,sub,weights,scheme,fingerprint):
+            cons = unpack_cached(entry,path)
+        else:
+            cons = checksum_from_records(sub,_c,include_peak_data,weights,scheme,kde,top_k,ir_count)
+        write_cache(path,sub,_c,fingerprint,cons,weights,scheme,latest)
+        return cons
+
+    return checksum_from_records(sub,_c,include_peak_data,weights,scheme,kde,top_k,ir_count)
+
+def cache_file(zid,params):
+
+    # Path of the cached consensus for a subject, with the parameters it was found with
+
+    key = hashlib.sha1(repr((cache_format,version,params))).hexdigest()[:16]
+
+    return '{0}/{1}_{2}.pkl.z'.format(cache_path,zid,key)
+
+def classification_fingerprint(records):
+
+    # Fingerprint of the classifications a consensus was found from: their ids, and when each was last updated
+
+    ids = sorted(['{0}:{1}'.format(c._id,c.updated_at.isoformat() if c.updated_at is not None else '') for c in records])
+
+    return hashlib.sha1('\n'.join(ids)).hexdigest()
+
+def latest_update(imgid):
+
+    # When any classification of a subject was last updated (None if it hasn't any), without
+    # retrieving the classifications themselves
+
+    latest = list(classifications.find({'subject_ids':imgid},{'updated_at':1}).sort([('updated_at',DESCENDING)]).limit(1))
+
+    return latest[0]['updated_at'] if len(latest) > 0 else None
+
+def fresh_cache(entry,sub,weights=0,scheme='scaling',fingerprint=None,latest=None):
+
+    # Whether a cached consensus is still right for a subject: its classifiers must have the same
+    # weights as when it was found, and either the classifications have the same fingerprint or
+    # (if they haven't been retrieved) the subject has the same classification count and the
+    # same latest update of any classification (see latest_update)
+
+    if entry is None:
+        return False
+
+    weight_table = variant_weights(scheme,weights) if weights > 0 else {}
+    if entry['extra'] != [weight_table.get(u,0) for u in entry['users']]:
+        return False
+
+    if fingerprint is not None:
+        return entry['fingerprint'] == fingerprint
+    else:
+        return entry['classification_count'] == sub.get('classification_count') and \
+            latest is not None and entry.get('updated_at') == latest
+
+def read_cache(path):
+
+    # Load a cached consensus, or None if it isn't there (or can't be read)
+
+    try:
+        with open(path,'rb') as f:
+            entry = pickle.loads(zlib.decompress(f.read()))
+    except (IOError,EOFError,zlib.error,pickle.UnpicklingError):
+        return None
+
+    return entry
+
+def unpack_cached(entry,path):
+
+    # Consensus from a cache entry, marking it as recently used
+
+    os.utime(path,None)
+
+    return pickle.loads(entry['cons'])
+
+# Total size of the cache, found the first time anything is written to it
+_cache_size = None
+
+def write_cache(path,sub,records,fingerprint,cons,weights=0,scheme='scaling',latest=None):
+
+    # Save a consensus to the cache, along with what's needed to tell if it's still right later on
+
+    global _cache_size
+
+    packed = pickle.dumps(cons,pickle.HIGHEST_PROTOCOL)
+
+    users = sorted(set([c.user_name for c in records if c.user_name is not None]))
+    weight_table = variant_weights(scheme,weights) if weights > 0 else {}
+    entry = {'zid':sub['zooniverse_id'],
+             'classification_count':sub.get('classification_count'),
+             'updated_at':latest,
+             'fingerprint':fingerprint,
+             'users':users,
+             'extra':[weight_table.get(u,0) for u in users],
+             'cons':packed}
+
+    data = zlib.compress(pickle.dumps(entry,pickle.HIGHEST_PROTOCOL))
+
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    if _cache_size is None:
+        _cache_size = sum([os.path.getsize(os.path.join(cache_path,f)) for f in os.listdir(cache_path)])
+
+    # Written to a temporary file first, so other processes never see half of one
+    tmp = '{0}.{1:d}.tmp'.format(path,os.getpid())
+    with open(tmp,'wb') as f:
+        f.write(data)
+    os.rename(tmp,path)
+    _cache_size += len(data)
+
+    if _cache_size > cache_max_bytes:
+        evict_cache()
+
+    return None
+
+def evict_cache(fraction=0.9):
+
+    # Remove the least recently used results until the cache is down to a fraction of its maximum size
+
+    global _cache_size
+
+    files = []
+    for f in os.listdir(cache_path):
+        try:
+            st = os.stat(os.path.join(cache_path,f))
+        except OSError:
+            continue
+        files.append((st.st_mtime,st.st_size,f))
+    files.sort()
+
+    _cache_size = sum([size for mtime,size,f in files])
+    for mtime,size,f in files:
+        if _cache_size <= fraction * cache_max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_path,f))
+            _cache_size -= size
+        except OSError:
+            pass
+
+    return None
+
+def clear_consensus_cache(zooniverse_ids=None):
+
+    # Remove the cached results for some subjects, or for everything
+
+    global _cache_size
+
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+
+    zids = set(zooniverse_ids) if zooniverse_ids is not None else None
+    for f in os.listdir(cache_path):
+        if zids is None or f.split('_')[0] in zids:
+            try:
+                os.remove(os.path.join(cache_path,f))
+            except OSError:
+                pass
+    _cache_size = None
+
+    return None
+
+def checksum_from_records(sub,records,include_peak_data=True,weights=0,scheme='scaling',kde='grid',top_k=1,ir_count=False):
+
+    # Find the consensus for a subject from its classifications, which have already been
+    # retrieved (either by checksum() or in bulk by iter_subject_records()). If top_k > 1,
+    # the next most popular combinations are also recorded in the 'alternatives' list.
+
+    assert kde in kde_engines, 'KDE engine must be one of {0}, not {1}'.format(kde_engines,kde)
+
+    tally = vote_tally(sub,records,weights,scheme)
+
+    cons = consensus_from_tally(tally,include_peak_data,kde,ir_count=ir_count)
+    if cons is not None and top_k > 1:
+        cons['alternatives'] = consensus_alternatives(tally,top_k,include_peak_data,kde)
+
+    return cons
+
+def vote_tally(sub,records,weights=0,scheme='scaling'):
+
+    # Count the votes for every combination of radio components in a subject. The tally keeps
+    # track of who cast each vote, so that a single user can be removed later on without
+    # going back to the database (see tally_without_user).
+
     # Empty dicts and lists 
     cdict = {}
+    cowner = {}
     
     unique_users = set()
     
@@ -166,7 +1010,7 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
     
     # Compute the most popular combination for each NUMBER of galaxies identified in image
     
-    for c in _c:
+    for c in records:
         
         clist_all.append(c)
         clen_start += 1
@@ -174,10 +1018,7 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
         # Skip classification if they already did one. This assumes the latest classification
         # is always the best (or at least the one that will be recorded here).
         
-        try:
-            user_name = c['user_name']
-        except KeyError:
-            user_name = 'Anonymous'
+        user_name = c.user_name if c.user_name is not None else 'Anonymous'
         
         # Check the answer, as long as they haven't already done one.
         
@@ -186,104 +1027,102 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
             unique_users.add(user_name)
             listcount.append(True)
             
-            sumlist = []    # List of the checksums over all possible combinations
-            
-            # Only find data that was an actual marking, not metadata
-            goodann = [x for x in c['annotations'] if (x.keys()[0] not in bad_keys)]
-            n_galaxies = len(goodann)
-            
-            # There must be at least one galaxy!
-            if n_galaxies > 0:  
-                for idx,ann in enumerate(goodann):
-                    
-                    xmaxlist = []
-                    try:
-                        radio_comps = ann['radio']
-                        
-                        # loop over all the radio components within an galaxy
-                        if radio_comps != 'No Contours':
-                            for rc in radio_comps:
-                                xmaxlist.append(float(radio_comps[rc]['xmax']))
-                        # or make the value -99 if there are no contours
-                        else:
-                            xmaxlist.append(-99)
-                    except KeyError:
-                        # No radio data for this classification
-                        xmaxlist.append(-99)
-                    
-                    # To create a unique ID for the combination of radio components,
-                    # take the product of all the xmax coordinates and sum them together
-                    # as a crude hash. This is not an ideal method and is potentially
-                    # subject to rounding errors - could be significantly improved.
-                    
-                    product = reduce(operator.mul, xmaxlist, 1)
-                    sumlist.append(round(product,3))
-                    
-                checksum = sum(sumlist)
-            else:
-                # No galaxies in this classification
-                checksum = -99
-            
-            c['checksum'] = checksum
-            c['n_galaxies'] = n_galaxies
-            
             # Insert checksum into dictionary with number of galaxies as the index
-            if cdict.has_key(n_galaxies):
-                cdict[n_galaxies].append(checksum)
+            if cdict.has_key(c.n_galaxies):
+                cdict[c.n_galaxies].append(c.checksum)
+                cowner[c.n_galaxies].append(c.user_name)
             else:
-                cdict[n_galaxies] = [checksum]
+                cdict[c.n_galaxies] = [c.checksum]
+                cowner[c.n_galaxies] = [c.user_name]
             
         else:
             listcount.append(False)
     
     # Remove duplicates and classifications for "No Object"
     
-    clist = [c for lc,c in zip(listcount,clist_all) if lc and c['checksum'] != -99]
+    clist = [c for lc,c in zip(listcount,clist_all) if lc and c.checksum != -99]
     
     clist_debugged = []
+    n_removed = 0
     for ix, c in enumerate(clist):
-        if ix and 'user_name' not in c and 'user_name' not in clist[ix-1]:
+        if ix and c.user_name is None and clist[ix-1].user_name is None:
             c0 = clist[ix-1]
-            if ([anno for anno in c['annotations'] if 'ir' in anno] != [anno for anno in c0['annotations'] if 'ir' in anno]) or \
-               (abs(c['created_at']-c0['created_at']).seconds > 30):
+            if ([gal for gal in c.galaxies if gal.ir is not None] != [gal for gal in c0.galaxies if gal.ir is not None]) or \
+               (abs(c.created_at-c0.created_at).seconds > 30):
                 clist_debugged.append(c)
             else:
-                cdict[c['n_galaxies']].remove(c['checksum'])
+                i = cdict[c.n_galaxies].index(c.checksum)
+                del cdict[c.n_galaxies][i]
+                del cowner[c.n_galaxies][i]
+                n_removed += 1
         else:
             clist_debugged.append(c)
 
-    clist = clist_debugged
-    
-    # Implement the weighting scheme, if desired. Simply add duplicate classifications
-    # for users who have been upweighted based on their agreement with the science team
-    # on gold-standard subjects.
-    
+    tally = {}
+    tally['sub'] = sub
+    tally['records'] = records
+    tally['cdict'] = cdict
+    tally['cowner'] = cowner
+    tally['clist_nodup'] = clist
+    tally['clist'] = clist_debugged
+    tally['n_removed'] = n_removed
+
+    return weighted_tally(tally,weights,scheme)
+
+def weighted_tally(tally,weights=0,scheme='scaling',recompute=False):
+
+    # Implement the weighting scheme, if desired. Users who have been upweighted based on their
+    # agreement with the science team on gold-standard subjects get extra votes, counted the
+    # same way as if their classifications had been duplicated. The votes themselves are
+    # shared, so the same tally can be reweighted for several schemes (with recompute=True for
+    # the variants of a sweep; see variant_weights).
+
+    clist = tally['clist']
+
+    extra = [0] * len(clist)
     if weights > 0:
-        weighted_c = []
-        for c in clist:
-            if c.has_key('user_name'):
-            	try:
-            		weight = user_weights.find_one({'user_name':c['user_name']})['weight']
-                except TypeError:
-					weight = 0
-                if scheme == 'threshold' and weight == 1:
-                    for i in range(weights):
-                        weighted_c.append(c)
-                        cdict[c['n_galaxies']].append(c['checksum'])
-                elif scheme == 'scaling' and weight > 0:
-                    for i in range(weight):
-                        weighted_c.append(c)
-                        cdict[c['n_galaxies']].append(c['checksum'])
-        if len(weighted_c) > 0:
-            clist.extend(weighted_c)
-    
+        weight_table = variant_weights(scheme,weights,recompute)
+        for ix,c in enumerate(clist):
+            if c.user_name is not None:
+                extra[ix] = weight_table.get(c.user_name,0)
+
+    new = dict(tally)
+    new['weights'] = weights
+    new['scheme'] = scheme
+    new['extra'] = extra
+
+    return new
+
+def tally_winner(tally):
+
+    # Find the combination with the most votes, returning (number of votes, checksum). Ties between
+    # combinations with the same number of galaxies go to the one that was voted for first, so the
+    # winner doesn't depend on the order of the keys in a dictionary.
+
+    cdict = tally['cdict']
+
+    extra_votes = {}
+    for c,w in zip(tally['clist'],tally['extra']):
+        if w > 0:
+            extra_votes.setdefault(c.n_galaxies,[]).append((c.checksum,w))
+
     maxval=0
     mc_checksum = 0.
     
     # Find the number of sources in the image that has the highest number of consensus classifications
     
     for k,v in cdict.iteritems():
-        mc = Counter(v).most_common()
+        if len(v) == 0:
+            continue
+        votes = Counter(v)
+        # Extra votes only go to combinations already in the list, so the order (and
+        # tie-breaking) of the counts is the same as with duplicated classifications
+        for cs,w in extra_votes.get(k,[]):
+            votes[cs] += w
+        first = {}
+        for i,cs in enumerate(v):
+            first.setdefault(cs,i)
+        mc = sorted(votes.iteritems(),key=lambda (cs,n): (-n,first[cs]))
         # Check if the most common selection coordinate was for no radio contours
         if mc[0][0] == -99.0:
             if len(mc) > 1:
@@ -299,11 +1138,29 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
         if mc_best[1] > maxval:
             maxval = mc_best[1]
             mc_checksum = mc_best[0]
+
+    return maxval, mc_checksum
+
+def consensus_from_tally(tally,include_peak_data=True,kde='grid',include_ir=True,ir_cache=None,ir_count=False):
+
+    # Build the consensus answer from the vote tally. With include_ir=False only the winning
+    # combination of radio components is recorded, and the IR peaks are skipped. If an ir_cache
+    # dictionary is given, IR peaks are reused for any source with exactly the same clicks as before.
+    # With ir_count=True, each answer also gets the number of IR sources marked in every
+    # classification that voted for it ('ir_count'; 0 for "No Sources").
+
+    sub = tally['sub']
+    zid = sub['zooniverse_id']
+    survey = sub['metadata']['survey']
+    clist = tally['clist']
+    extra = tally['extra']
+
+    maxval,mc_checksum = tally_winner(tally)
     
     # Get a galaxy that matches the checksum so we can record the annotation data
     
     try:
-        cmatch = next(i for i in clist if i['checksum'] == mc_checksum)
+        cmatch = next(i for i in clist if i.checksum == mc_checksum)
     except StopIteration:
         # Necessary for objects like ARG0003par; 
         # one classifier recorded 22 "No IR","No Contours" in a short space.
@@ -312,11 +1169,7 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
         logging.info('No non-zero classifications recorded for {0}'.format(zid))
         return None
     
-    # Get the annotation data for galaxies that match the consensus
-    
-    goodann = [x for x in cmatch['annotations'] if x.keys()[0] not in bad_keys]
-    
-    # Find the sum of the xmax coordinates for each galaxy. This gives the index to search on.
+    # Key each galaxy by its radio components (see answer_key)
     
     cons = {}
     cons['zid'] = zid
@@ -325,69 +1178,57 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
     ir_x,ir_y = {},{}
     cons['answer'] = {}
     cons['n_votes'] = maxval
-    cons['n_total'] = len(clist)
+    cons['n_total'] = len(clist) + sum(extra)
+    n_clicks = {}
     
     # This will be where we store the consensus parameters
     answer = cons['answer']
+
+    # Position of each galaxy of the consensus in the winning classification
+    ind = {}
     
-    # Loop over the annotations and record the parameters of the bounding boxes
+    # Loop over the galaxies and record the parameters of the bounding boxes
     
-    for k,gal in enumerate(goodann):
-        xmax_temp = []
-        bbox_temp = []
-        try:
-            for v in gal['radio'].itervalues():
-                xmax_temp.append(float(v['xmax']))
-                bbox_temp.append((v['xmax'],v['ymax'],v['xmin'],v['ymin']))
-            checksum2 = round(sum(xmax_temp),3)
+    for k,gal in enumerate(cmatch.galaxies):
+        if gal.xmax is not None:
+            ind[gal.comps] = k
+            checksum2 = answer_key(gal)
             answer[checksum2] = {}
             answer[checksum2]['ind'] = k
-            answer[checksum2]['xmax'] = xmax_temp
-            answer[checksum2]['bbox'] = bbox_temp
-        except KeyError:
-            print gal, zid
-            logging.warning((gal, zid))
-        except AttributeError:
+            answer[checksum2]['xmax'] = list(gal.xmax)
+            answer[checksum2]['bbox'] = list(gal.bbox)
+        else:
             print 'No Sources, No IR recorded for {0}'.format(zid)
             logging.warning('No Sources, No IR recorded for {0}'.format(zid))
         
         # Make empty copy of next dict in same loop
         ir_x[k] = []
         ir_y[k] = []
+        n_clicks[k] = []
+
+    if not include_ir:
+        return cons
     
-    # Now loop over all sets of classifications to get their IR counterparts
+    # Now loop over all sets of classifications to get their IR counterparts. Upweighted
+    # classifications contribute their clicks again for each extra vote, after all the others.
     
-    for c in clist:
-        if c['checksum'] == mc_checksum:
+    ir_clist = clist + [c for c,w in zip(clist,extra) for i in range(w)]
+    for c in ir_clist:
+        if c.checksum == mc_checksum:
             
-            annlist = [ann for ann in c['annotations'] if ann.keys()[0] not in bad_keys]
-            for ann in annlist:
-                if 'ir' in ann.keys():
+            for gal in c.galaxies:
+                if gal.ir is not None:
                     # Find the index k that this corresponds to
                     try:
-                        xmax_checksum = round(sum([float(ann['radio'][a]['xmax']) for a in ann['radio']]),3)
-                    except TypeError:
-                        xmax_checksum = -99
-                    
-                    try:
-                        k = answer[xmax_checksum]['ind']
-                        
-                        if ann['ir'] == 'No Sources':
-                            ir_x[k].append(-99)
-                            ir_y[k].append(-99)
-                        else:
-                            # Only takes the first IR source if there is more than one.
-                            ir_x[k].append(float(ann['ir']['0']['x']))
-                            ir_y[k].append(float(ann['ir']['0']['y']))
+                        k = ind[gal.comps]
+                        ir_x[k].append(gal.ir[0])
+                        ir_y[k].append(gal.ir[1])
+                        n_clicks[k].append(gal.n_clicks)
                     except KeyError:
                         print '"No radio" still appearing as valid consensus option.'
                         logging.warning('"No radio" still appearing as valid consensus option.')
 
     # Perform a kernel density estimate on the data for each galaxy to find the IR peak (in pixel coordinates)
-    
-    scale_ir = img_params[survey]['IMG_HEIGHT_NEW'] * 1./img_params[survey]['IMG_HEIGHT_OLD']
-
-    peak_data = []
 
     # Remove any empty IR peaks recorded
 
@@ -403,172 +1244,183 @@ def checksum(zid,experts_only=False,excluded=[],no_anonymous=False,include_peak_
     assert len(ir_x) == len(ir_y),'Lengths of ir_x ({0:d}) and ir_y ({1:d}) are not the same'.format(len(ir_x),len(ir_y))
 
     for (xk,xv),(yk,yv) in zip(ir_x.iteritems(),ir_y.iteritems()):
-        
-        if len(xv) == 0:
-            irx
-        
-        pd = {}
-        
-        # Convert into the same scale as the radio coordinates
-        x_exists = [xt * scale_ir for xt in xv if xt != -99.0]
-        y_exists = [yt * scale_ir for yt in yv if yt != -99.0]
-        
-        x_all = [xt * scale_ir for xt in xv]
-        y_all = [yt * scale_ir for yt in yv]
-        
-        # Find the most common IR coordinate. We want to skip the next steps
-        # if they said there was no IR counterpart (-99,-99)
-        ir_Counter = Counter([(xx,yy) for xx,yy in zip(xv,yv)])
-        most_common_ir = ir_Counter.most_common(1)[0][0]
-        
-        xmin = 1.
-        xmax = img_params[survey]['IMG_HEIGHT_NEW']
-        ymin = 1.
-        ymax = img_params[survey]['IMG_WIDTH_NEW']
-        
-        # Check if there are enough IR points to attempt a kernel density estimate
-        if len(Counter(x_exists)) > 2 and len(Counter(y_exists)) > 2 and most_common_ir != (-99,-99):
-            
-            # X,Y = grid of uniform coordinates over the IR pixel plane
-            X, Y = np.mgrid[xmin:xmax, ymin:ymax]
-            positions = np.vstack([X.ravel(), Y.ravel()])
-            try:
-                values = np.vstack([x_exists, y_exists])
-            except ValueError:
-                # Breaks on the tutorial subject. Find out why len(x) != len(y)
-                print zid
-                print 'Length of IR x array: {0:d}; Length of IR y array: {1:d}'.format(len(x_exists),len(y_exists))
-                logging.warning((zid, 'Length of IR x array: {0:d}; Length of IR y array: {1:d}'.format(len(x_exists),len(y_exists))))
-            
-            try:
-                # Compute the kernel density estimate
-                kernel = stats.gaussian_kde(values)
-            except LinAlgError:
-                print 'LinAlgError in KD estimation for {0}'.format(zid,x_exists,y_exists)
-                logging.warning('LinAlgError in KD estimation for {0}'.format(zid,x_exists,y_exists))
-                for k,v in answer.iteritems():
-                    if v['ind'] == xk:
-                        xpeak, ypeak = np.mean(x_exists), np.mean(y_exists)
-                        answer[k]['ir'] = (xpeak, ypeak)
-                        # Count the number of clicks within 3"
-                        agreed = 0
-                        for x0, y0 in zip(x_exists, y_exists):
-                            if np.sqrt(np.square(xpeak-x0)+np.square(ypeak-y0)) <= (xmax-xmin)/60.:
-                                agreed += 1
-                        answer[k]['n_ir'] = agreed
-                        answer[k]['ir_level'] = 1.0*agreed/len(xv)
-                        answer[k]['ir_flag'] = 0
-                continue
-            
-            # Even if there are more than 2 sets of points, if they are mutually co-linear, 
-            # matrix can't invert and kernel returns NaNs. 
-            
-            kp = kernel(positions)
-            
-            # Check to see if there are NaNs in the kernel (usually a sign of co-linear points).
-            if np.isnan(kp).sum() > 0:
-                acp = collinearity.collinear(x_exists,y_exists)
-                if len(acp) > 0:
-                    output = 'There are {0:d} unique points for {1} (source no. {2:d} in the field), but all are co-linear; KDE estimate does not work.'.format( \
-                        len(Counter(x_exists)),zid,xk)
-                else:
-                    output = 'There are NaNs in the KDE for {0} (source no. {1:d} in the field), but points are not co-linear.'.format(zid,xk)
-                logging.info(output)
-                
-                for k,v in answer.iteritems():
-                    if v['ind'] == xk:
-                        xpeak, ypeak = np.mean(x_exists), np.mean(y_exists)
-                        answer[k]['ir'] = (xpeak, ypeak)
-                        # Count the number of clicks within 3"
-                        agreed = 0
-                        for x0, y0 in zip(x_exists, y_exists):
-                            if np.sqrt(np.square(xpeak-x0)+np.square(ypeak-y0)) <= (xmax-xmin)/60.:
-                                agreed += 1
-                        answer[k]['n_ir'] = agreed
-                        answer[k]['ir_level'] = 1.0*agreed/len(xv)
-                        answer[k]['ir_flag'] = 0
-            
-            # Kernel is finite; should be able to get a position
-            else:
-                
-                Z = np.reshape(kp.T, X.shape)
-                
-                # Find the number of peaks in the kernel
-                # http://stackoverflow.com/questions/3684484/peak-detection-in-a-2d-array
-                
-                neighborhood = np.ones((10,10))
-                local_max = maximum_filter(Z, footprint=neighborhood)==Z
-                background = (Z==0)
-                eroded_background = binary_erosion(background, structure=neighborhood, border_value=1)
-                detected_peaks = local_max ^ eroded_background
-                
-                npeaks = detected_peaks.sum()
-                
-                pd['X'] = X
-                pd['Y'] = Y
-                pd['Z'] = Z
-                pd['npeaks'] = npeaks
-                
-                try:
-                    # Peak values in the kernel are what we take as the final IR location
-                    xpeak = float(pd['X'][pd['Z']==pd['Z'].max()][0])
-                    ypeak = float(pd['Y'][pd['Z']==pd['Z'].max()][0])
-                    peak_height = Z[int(xpeak)-1, int(ypeak)-1]
-                except IndexError:
-                    # Print results to screen if it doesn't match
-                    print pd
-                    print zid, clist
-                    logging.warning((pd, zid, clist))
-                
-                # For each answer in this image, record the final IR peak
-                
-                for k,v in answer.iteritems():
-                    if v['ind'] == xk:
-                        answer[k]['ir_peak'] = (xpeak,ypeak)
-                        # Count the number of clicks within 3"
-                        agreed = 0
-                        for x0, y0 in zip(x_exists, y_exists):
-                            if np.sqrt(np.square(xpeak-x0)+np.square(ypeak-y0)) <= (xmax-xmin)/60.:
-                                agreed += 1
-                        answer[k]['n_ir'] = agreed
-                        answer[k]['ir_level'] = 1.0*agreed/len(xv)
-                        answer[k]['ir_flag'] = 1
-                        # Don't write to consensus for serializable JSON object 
-                        if include_peak_data:
-                            answer[k]['peak_data'] = pd
-                            answer[k]['ir_x'] = x_exists
-                            answer[k]['ir_y'] = y_exists
-        
-        # Couldn't attempt a KDE; too few IR points in consensus
+
+        if ir_cache is None:
+            ir = ir_consensus(xv,yv,survey,zid,xk,include_peak_data,kde)
         else:
-            
-            # Note: need to actually put a limit in if less than half of users selected IR counterpart.
-            # Right now it still IDs a source even if only, say, 1/10 users said it was there.
-            
-            for k,v in answer.iteritems():
-                if v['ind'] == xk:
-                    # Case 1: multiple users selected IR source, but not enough unique points to pinpoint peak
-                    if most_common_ir != (-99,-99) and len(x_exists) > 0 and len(y_exists) > 0:
-                        xpeak, ypeak = np.mean(x_exists), np.mean(y_exists)
-                        answer[k]['ir'] = (xpeak, ypeak)
-                        # Count the number of clicks within 3"
-                        agreed = 0
-                        for x0, y0 in zip(x_exists, y_exists):
-                            if np.sqrt(np.square(xpeak-x0)+np.square(ypeak-y0)) <= (xmax-xmin)/60.:
-                                agreed += 1
-                        answer[k]['n_ir'] = agreed
-                        answer[k]['ir_level'] = 1.0*agreed/len(xv)
-                        answer[k]['ir_flag'] = 0
-                    # Case 2: most users have selected No Sources
-                    else:
-                        answer[k]['ir'] = (-99,-99)
-                        answer[k]['n_ir'] = xv.count(-99)
-                        answer[k]['ir_level'] = 1.0*xv.count(-99)/len(xv)
-                        answer[k]['ir_flag'] = 0
+            key = (xk,tuple(xv),tuple(yv))
+            if not ir_cache.has_key(key):
+                ir_cache[key] = ir_consensus(xv,yv,survey,zid,xk,include_peak_data,kde)
+            ir = ir_cache[key]
+
+        # For each answer in this image, record the final IR peak
+        for k,v in answer.iteritems():
+            if v['ind'] == xk:
+                answer[k].update(ir)
+                if ir_count:
+                    answer[k]['ir_count'] = n_clicks[xk]
 
     # Final answer
    
     return cons
+
+def ranked_tallies(tally,top_k):
+
+    # Tallies where the winner is each of the top_k most popular combinations in turn: first the
+    # full tally, then with the winning combination dropped, and so on. There may be fewer than
+    # top_k if the classifiers didn't find that many different combinations.
+
+    ranked = [tally]
+    current = tally
+
+    for rank in range(1,top_k):
+
+        maxval,mc_checksum = tally_winner(current)
+        if maxval == 0:
+            break
+        best_k = next(k for k,v in current['cdict'].iteritems() if mc_checksum in v)
+
+        new = dict(current)
+        new['cdict'] = dict(current['cdict'])
+        new['cowner'] = dict(current['cowner'])
+        keep = [i for i,cs in enumerate(current['cdict'][best_k]) if cs != mc_checksum]
+        new['cdict'][best_k] = [current['cdict'][best_k][i] for i in keep]
+        new['cowner'][best_k] = [current['cowner'][best_k][i] for i in keep]
+        new['extra'] = [0 if c.n_galaxies == best_k and c.checksum == mc_checksum else w for c,w in zip(current['clist'],current['extra'])]
+
+        if tally_winner(new)[0] == 0:
+            break
+
+        ranked.append(new)
+        current = new
+
+    return ranked
+
+def consensus_alternatives(tally,top_k,include_peak_data=False,kde='grid'):
+
+    # Consensus for the runners-up (rank 2 to top_k) of a subject, from the same tally as the
+    # consensus itself. Each has its own number of votes and IR peaks.
+
+    n_total = len(tally['clist']) + sum(tally['extra'])
+
+    alternatives = []
+    for rank,ranked in enumerate(ranked_tallies(tally,top_k)[1:]):
+        alt = consensus_from_tally(ranked,include_peak_data,kde)
+        if alt is None:
+            break
+        alt['rank'] = rank + 2
+        alt['n_total'] = n_total
+        alternatives.append(alt)
+
+    return alternatives
+
+def tally_without_user(tally,user_name):
+
+    # Remove the votes of a single (registered) user from a tally. This gives the same tally as
+    # starting again from the classifications without that user, but only needs a pass over
+    # the votes rather than a new query.
+
+    assert user_name is not None, 'Only registered users can be removed from the tally'
+
+    if user_name not in [c.user_name for c in tally['records']]:
+        return tally
+
+    # Removing a classification between two anonymous ones changes which anonymous
+    # duplicates are dropped, and a duplicate may have been dropped against this user's vote.
+    # Both are rare, so just count the votes again for those subjects.
+
+    clist_nodup = tally['clist_nodup']
+    names = [c.user_name for c in clist_nodup]
+    if user_name in names:
+        ix = names.index(user_name)
+        sandwiched = 0 < ix < len(names)-1 and names[ix-1] is None and names[ix+1] is None
+    else:
+        sandwiched = False
+
+    if sandwiched or tally['n_removed'] > 0:
+        records = [c for c in tally['records'] if c.user_name != user_name]
+        return vote_tally(tally['sub'],records,tally['weights'],tally['scheme'])
+
+    new = dict(tally)
+    new['records'] = [c for c in tally['records'] if c.user_name != user_name]
+    new['cdict'],new['cowner'] = {},{}
+    for k in tally['cdict']:
+        keep = [i for i,u in enumerate(tally['cowner'][k]) if u != user_name]
+        if len(keep) > 0:
+            new['cdict'][k] = [tally['cdict'][k][i] for i in keep]
+            new['cowner'][k] = [tally['cowner'][k][i] for i in keep]
+    new['clist_nodup'] = [c for c in clist_nodup if c.user_name != user_name]
+    keep = [i for i,c in enumerate(tally['clist']) if c.user_name != user_name]
+    new['clist'] = [tally['clist'][i] for i in keep]
+    new['extra'] = [tally['extra'][i] for i in keep]
+
+    return new
+
+def consensus_without_user(tally,user_name,cons=None,include_ir=False,include_peak_data=False,kde='grid'):
+
+    # Consensus for a subject with a single user left out, from the tally of everyone's votes.
+    # If the full consensus (cons) is given and leaving the user out doesn't change the winning
+    # combination or any of its IR clicks, its IR peaks are reused rather than computed again.
+
+    reduced = tally_without_user(tally,user_name)
+
+    if not include_ir:
+        return consensus_from_tally(reduced,include_ir=False)
+
+    if cons is not None:
+        winner = tally_winner(tally)[1]
+        voted = [c.checksum for c in tally['clist'] if c.user_name == user_name]
+        maxval,mc_checksum = tally_winner(reduced)
+        if mc_checksum == winner and winner not in voted:
+            new = dict(cons)
+            new['answer'] = dict(cons['answer'])
+            new['n_votes'] = maxval
+            new['n_total'] = len(reduced['clist']) + sum(reduced['extra'])
+            return new
+
+    return consensus_from_tally(reduced,include_peak_data,kde)
+
+def leave_one_out_agreement(zooniverse_ids,experts_only=False,exclude_user=True,weights=0,scheme='scaling'):
+
+    # Compare every registered user's answer for each subject with the consensus of everyone
+    # else (or just the experts, if experts_only). The votes for each subject are counted once,
+    # and each user is then taken out of the tally in turn. Returns a dictionary with the number
+    # of subjects each user has seen and the number where they agreed with the consensus.
+
+    agreement = {}
+
+    for zid,sub,records in iter_subject_records(zooniverse_ids):
+
+        if experts_only:
+            tally = vote_tally(sub,[c for c in records if c.expert],weights,scheme)
+        else:
+            tally = vote_tally(sub,records,weights,scheme)
+
+        full = consensus_from_tally(tally,include_ir=False)
+        voters = set([c.user_name for c in tally['records']])
+
+        by_user = {}
+        for c in records:
+            if c.user_name is not None:
+                by_user.setdefault(c.user_name,[]).append(c)
+
+        for user_name,user_records in by_user.iteritems():
+
+            # Only users who voted in the tally change the consensus when they're left out
+            if exclude_user and user_name in voters:
+                cons = consensus_without_user(tally,user_name)
+            else:
+                cons = full
+            science_checksums = cons['answer'].keys() if cons is not None else []
+            their_checksums = one_answer_from_records(sub,user_records)['answer'].keys()
+
+            if not agreement.has_key(user_name):
+                agreement[user_name] = {'gs_seen':0,'agreed':0}
+            agreement[user_name]['gs_seen'] += 1
+            if set(their_checksums) == set(science_checksums):
+                agreement[user_name]['agreed'] += 1
+
+    return agreement
     
 def one_answer(zid,user_name):
 
@@ -579,45 +1431,30 @@ def one_answer(zid,user_name):
 
     # Classifications for this subject after launch date
     class_params = {"subject_ids": imgid, "updated_at": {"$gt": main_release_date},'user_name':user_name}
-    clist = list(classifications.find(class_params))
+    clist = find_classifications(class_params)
+
+    return one_answer_from_records(sub,clist)
+
+def one_answer_from_records(sub,clist):
+
+    # Find the result for just one user from their classifications of a subject
+
+    zid = sub['zooniverse_id']
   
     # Empty dicts and lists 
     cdict = {}
+    checksums = []
     
     for c in clist:
         # Want most popular combination for each NUMBER of galaxies identified in image
-        
-        sumlist = []    # List of the checksums over all possible combinations
-        # Only find data that was an actual marking, not metadata
-        goodann = [x for x in c['annotations'] if x.keys()[0] not in bad_keys]
-        n_galaxies = len(goodann)
-    
-        for idx,ann in enumerate(goodann):
-    
-            xmaxlist = []
-            radio_comps = ann['radio']
-    
-            # loop over all the radio components within an galaxy
-            if radio_comps != 'No Contours':
-                for rc in radio_comps:
-                    xmaxlist.append(float(radio_comps[rc]['xmax']))
-            # or make the value -99 if there are no contours
-            else:
-                xmaxlist.append(-99)
-    
-            # To create a unique ID for the combination of radio components,
-            # take the product of all the xmax coordinates and sum them together.
-            product = reduce(operator.mul, xmaxlist, 1)
-            sumlist.append(round(product,3))
-    
-        checksum = round(sum(sumlist),3)
-        c['checksum'] = checksum
+        checksum = c.checksum
+        checksums.append(checksum)
     
         # Insert checksum into dictionary with number of galaxies as the index
-        if cdict.has_key(n_galaxies):
-            cdict[n_galaxies].append(checksum)
+        if cdict.has_key(c.n_galaxies):
+            cdict[c.n_galaxies].append(checksum)
         else:
-            cdict[n_galaxies] = [checksum]
+            cdict[c.n_galaxies] = [checksum]
     
     maxval=0
     mc_checksum = 0.
@@ -645,17 +1482,13 @@ def one_answer(zid,user_name):
     # Find a galaxy that matches the checksum (easier to keep track as a list)
     
     try:
-        cmatch = next(i for i in clist if i['checksum'] == mc_checksum)
+        cmatch = next(c for c,cs in zip(clist,checksums) if cs == mc_checksum)
     except StopIteration:
         # Crude way to check for No Sources and No Contours (mc_checksum = 0.)
         cons = {'zid':zid,'answer':{}}
         return cons
    
-    # Find IR peak for the checksummed galaxies
-    
-    goodann = [x for x in cmatch['annotations'] if x.keys()[0] not in bad_keys]
-
-    # Find the sum of the xmax coordinates for each galaxy. This gives the index to search on.
+    # Key each galaxy by its radio components (see answer_key)
     
     cons = {}
     cons['zid'] = zid
@@ -665,92 +1498,241 @@ def one_answer(zid,user_name):
     answer = cons['answer']
 
     ir_x,ir_y = {},{}
-    for k,gal in enumerate(goodann):
-        xmax_temp = []
-        try:
-            for v in gal['radio'].itervalues():
-                xmax_temp.append(float(v['xmax']))
-        except AttributeError:
-            xmax_temp.append(-99)
-
-        checksum2 = round(sum(xmax_temp),3)
+    ind = {}
+    for k,gal in enumerate(cmatch.galaxies):
+        ind[gal.comps] = k
+        checksum2 = answer_key(gal)
         answer[checksum2] = {}
         answer[checksum2]['ind'] = k
-        answer[checksum2]['xmax'] = xmax_temp
+        answer[checksum2]['xmax'] = list(gal.xmax) if gal.xmax is not None else [-99]
     
         # Make empty copy of next dict in same loop
         ir_x[k] = []
         ir_y[k] = []
     
     # Now loop over the galaxies themselves
-    for c in clist:
-        if c['checksum'] == mc_checksum:
+    for c,cs in zip(clist,checksums):
+        if cs == mc_checksum:
     
-            annlist = [ann for ann in c['annotations'] if ann.keys()[0] not in bad_keys]
-            for ann in annlist:
-                if 'ir' in ann.keys():
+            for gal in c.galaxies:
+                if gal.ir is not None:
                     # Find the index k that this corresponds to
-                    try:
-                        xmax_checksum = round(sum([float(ann['radio'][a]['xmax']) for a in ann['radio']]),3)
-                    except TypeError:
-                        xmax_checksum = -99
-                    k = answer[xmax_checksum]['ind']
-    
-                    if ann['ir'] == 'No Sources':
-                        ir_x[k].append(-99)
-                        ir_y[k].append(-99)
-                    else:
-                        # Only takes the first IR source right now; NEEDS TO BE MODIFIED.
+                    k = ind[gal.comps]
     
-                        ir_x[k].append(float(ann['ir']['0']['x']))
-                        ir_y[k].append(float(ann['ir']['0']['y']))
-
+                    # Only takes the first IR source right now; NEEDS TO BE MODIFIED.
+                    ir_x[k].append(gal.ir[0])
+                    ir_y[k].append(gal.ir[1])
 
-                    for k,v in answer.iteritems():
-                        if v['ind'] == k:
-                            answer[k]['ir_peak'] = (xpeak,ypeak)
-        
     return cons
 
-def check_indices(index_names):
+def iter_subject_records(zooniverse_ids,chunk_size=2000,prefetch=False):
+
+    # Retrieve the subjects and their classifications in chunks, with a single query on
+    # subject_ids for each chunk rather than two queries per subject. Yields
+    # (zooniverse_id, subject, classifications) in the same order as zooniverse_ids. With
+    # prefetch=True, the images of each chunk are downloaded in the background for plotting.
+
+    for start in range(0,len(zooniverse_ids),chunk_size):
+
+        zid_chunk = zooniverse_ids[start:start+chunk_size]
+
+        subs = {}
+        for sub in subjects.find({'zooniverse_id':{'$in':zid_chunk}}):
+            subs[sub['zooniverse_id']] = sub
+
+        if prefetch:
+            prefetch_images(subs.itervalues())
+
+        imgids = [sub['_id'] for sub in subs.itervalues()]
+
+        # Group the classifications by subject. Sorting on the index keeps the classifications of
+        # each subject in the same order as a query on that subject alone.
+        records = {}
+        class_params = {"subject_ids": {"$in": imgids}, "updated_at": {"$gt": main_release_date}}
+        for c in classifications.find(class_params,classification_fields).sort([("subject_ids", ASCENDING)]):
+            c = Classification(c)
+            for imgid in c.subject_ids:
+                records.setdefault(imgid,[]).append(c)
+
+        for zid in zid_chunk:
+            try:
+                sub = subs[zid]
+            except KeyError:
+                print 'Subject {0} not found'.format(zid)
+                logging.warning('Subject {0} not found'.format(zid))
+                continue
+            yield zid, sub, records.pop(sub['_id'],[])
+
+def check_indices(index_names):
+
+    # See if additional indices have been created (improves run time drastically)
+    
+    indices = classifications.index_information()
+    for index_name in index_names:
+        if not indices.has_key("{0}_idx".format(index_name)):
+            classifications.create_index([(index_name,ASCENDING)],name='{0}_idx'.format(index_name))
+
+    return None
+
+# Decoded images, most recently used last, and the downloads in progress (see fetch_image)
+_image_lru = OrderedDict()
+_image_lock = threading.Lock()
+_image_fetching = {}
+_image_pool = None
+
+def image_url(subject,imgtype='standard'):
+
+    # URL of one of the images of a subject
+
+    url = subject['location'][imgtype]
+    if image_url_base is not None:
+        url = '{0}/{1}'.format(image_url_base.rstrip('/'),url.split('://')[-1].split('/',1)[-1])
+
+    return url
+
+def image_store_files(url):
+
+    # Files in the image store for an image: a pointer from its URL to its contents, and the contents
+    # themselves, named by their hash so that identical images are only kept once
+
+    urlhash = hashlib.sha1(url).hexdigest()
+    return '{0}/urls/{1}'.format(image_store_path,urlhash), '{0}/objects'.format(image_store_path)
+
+def fetch_image(url):
+
+    # Path of an image in the local image store, downloading it first if it isn't there yet. If it's
+    # already being downloaded by another thread, wait for that instead of downloading it again.
+
+    pointer,objects = image_store_files(url)
+
+    while True:
+        if os.path.exists(pointer):
+            with open(pointer,'r') as f:
+                return '{0}/{1}'.format(objects,f.read().strip())
+
+        with _image_lock:
+            fetching = _image_fetching.get(url)
+            if fetching is None:
+                fetching = _image_fetching[url] = threading.Event()
+                mine = True
+            else:
+                mine = False
 
-    # See if additional indices have been created (improves run time drastically)
-    
-    indices = classifications.index_information()
-    for index_name in index_names:
-        if not indices.has_key("{0}_idx".format(index_name)):
-            subindex = classifications.create_index([(index_name,ASCENDING)],name='{0}_idx'.format(index_name))
+        if not mine:
+            fetching.wait()
+            continue
 
-    return None
+        try:
+            response = urllib.urlopen(url)
+            if response.getcode() not in (None,200):
+                raise IOError('Could not download {0} (HTTP {1})'.format(url,response.getcode()))
+            data = response.read()
+            digest = hashlib.sha1(data).hexdigest()
+            for d in (os.path.dirname(pointer),objects):
+                if not os.path.exists(d):
+                    try:
+                        os.makedirs(d)
+                    except OSError:
+                        pass
+
+            # Contents first, then the pointer, each written whole; a crash never leaves a pointer to nothing
+            tmp = '.{0:d}.{1}.tmp'.format(os.getpid(),threading.current_thread().ident)
+            path = '{0}/{1}'.format(objects,digest)
+            if not os.path.exists(path):
+                with open(path+tmp,'wb') as f:
+                    f.write(data)
+                os.rename(path+tmp,path)
+            with open(pointer+tmp,'w') as f:
+                f.write(digest)
+            os.rename(pointer+tmp,pointer)
+        finally:
+            with _image_lock:
+                _image_fetching.pop(url,None)
+            fetching.set()
 
 def grab_image(subject,imgtype='standard'):
 
-    # Import a JPG from the RGZ subjects. Tries to find a local version before downloading over the web
+    # Import a JPG from the RGZ subjects. Tries to find a local version before downloading over the
+    # web; downloaded images are kept in the image store, and the last few are kept decoded in memory.
     
-    url = subject['location'][imgtype]
+    url = image_url(subject,imgtype)
+
+    with _image_lock:
+        if _image_lru.has_key(url):
+            im = _image_lru.pop(url)
+            _image_lru[url] = im
+            return im
+
     filename = "{0}/rgz/{1}/{2}".format(data_path,imgtype,url.split('/')[-1])
 
     if os.path.exists(filename):
         with open(filename) as f:
             im = Image.open(f)
             im.load()
+    elif image_store_path is not None:
+        with open(fetch_image(url),'rb') as f:
+            im = Image.open(f)
+            im.load()
     else:
         im = Image.open(cStringIO.StringIO(urllib.urlopen(url).read()))
 
+    with _image_lock:
+        _image_lru[url] = im
+        while len(_image_lru) > image_lru_size:
+            _image_lru.popitem(last=False)
+
     return im
 
-def plot_consensus(consensus,figno=1,savefig=False):
+def prefetch_images(subs,imgtypes=('standard','radio'),threads=8):
+
+    # Start downloading the images for some subjects into the image store in the background, so
+    # they're on disk by the time they're plotted. Returns the AsyncResult of the downloads.
+
+    global _image_pool
+
+    if image_store_path is None:
+        return None
+
+    urls = []
+    for sub in subs:
+        for imgtype in imgtypes:
+            url = image_url(sub,imgtype)
+            if url not in urls and not os.path.exists("{0}/rgz/{1}/{2}".format(data_path,imgtype,url.split('/')[-1])):
+                urls.append(url)
+
+    # Threads don't survive a fork, so each worker process needs its own pool
+    if _image_pool is None or _image_pool[0] != os.getpid():
+        _image_pool = (os.getpid(),ThreadPool(threads))
+
+    return _image_pool[1].map_async(fetch_image,urls)
+
+def consensus_axes(fig):
+
+    # Set up the four panels of a consensus plot (IR, radio, KDE estimate, and consensus) on a figure.
+    # The same axes can be drawn on again for each subject (see draw_consensus).
+
+    fig.clf()
+    ax3 = fig.add_subplot(143)
+    ax4 = fig.add_subplot(144)
+    ax1 = fig.add_subplot(141)
+    ax2 = fig.add_subplot(142)
+    fig.subplots_adjust(wspace=0.02)
+
+    return ax1,ax2,ax3,ax4
+
+def draw_consensus(axes,consensus,sub,contours,im_standard,im_radio):
+
+    # Draw the consensus for a subject on the axes made by consensus_axes, replacing anything
+    # drawn on them before
+
+    ax1,ax2,ax3,ax4 = axes
+    for ax in axes:
+        ax.cla()
 
-    # Plot a 4-panel image of IR, radio, KDE estimate, and consensus
-    
     zid = consensus['zid']
     answer = consensus['answer']
-    sub = subjects.find_one({'zooniverse_id':zid})
     survey = sub['metadata']['survey']
 
-    # Get contour data
-    contours = get_contours(sub,pathdict)
-    
     # Key bit that sets the difference between surveys.
     #   contours['width'] = img_params[survey]['FITS_WIDTH']
     #   contours['height'] = img_params[survey]['FITS_HEIGHT']
@@ -762,25 +1744,24 @@ def plot_consensus(consensus,figno=1,savefig=False):
     codes_all = []
     components = contours['contours']
 
-    for comp in components:
+    # Only plot radio components identified by the users as the consensus
+    index = component_index(contours)
+    chosen = set([find_component(index,bbox) for v in answer.itervalues() for bbox in v['bbox']])
+
+    for icomp,comp in enumerate(components):
     
-        # Order of bounding box components is (xmax,ymax,xmin,ymin)
-        comp_xmax,comp_ymax,comp_xmin,comp_ymin = comp[0]['bbox']
-        
-        # Only plot radio components identified by the users as the consensus;
-        # check on the xmax value to make sure
-        for v in answer.itervalues():
-            if comp_xmax in v['xmax']:
-    
-                for idx,level in enumerate(comp):
-                    verts = [((p['x'])*sf_x,(p['y']-1)*sf_y) for p in level['arr']]
-                    
-                    codes = np.ones(len(verts),int) * Path.LINETO
-                    codes[0] = Path.MOVETO
+        if icomp in chosen:
+    
+            for idx,level in enumerate(comp):
+                verts = [((p['x'])*sf_x,(p['y']-1)*sf_y) for p in level['arr']]
                 
-                    verts_all.extend(verts)
-                    codes_all.extend(codes)
+                codes = np.ones(len(verts),int) * Path.LINETO
+                codes[0] = Path.MOVETO
+            
+                verts_all.extend(verts)
+                codes_all.extend(codes)
     
+    patch_black = None
     try:
         path = Path(verts_all, codes_all)
         patch_black = patches.PathPatch(path, facecolor = 'none', edgecolor='black', lw=1)
@@ -789,11 +1770,6 @@ def plot_consensus(consensus,figno=1,savefig=False):
     
     # Plot the infrared results
     
-    fig = plt.figure(figno,(15,4))
-    fig.clf()
-    ax3 = fig.add_subplot(143)
-    ax4 = fig.add_subplot(144)
-    
     colormaparr = [cm.hot_r,cm.Blues,cm.RdPu,cm.Greens,cm.PuBu,cm.YlGn,cm.Greys][::-1]
     colorarr = ['r','b','m','g','c','y','k'][::-1]
     
@@ -807,13 +1783,9 @@ def plot_consensus(consensus,figno=1,savefig=False):
 
             if ans.has_key('peak_data'):
 
-                xmin = 1.
-                xmax = img_params[survey]['IMG_HEIGHT_NEW']
-                ymin = 1.
-                ymax = img_params[survey]['IMG_WIDTH_NEW']
-
                 # Plot the KDE map
                 colormap = colormaparr.pop()
+                xmin,xmax,ymin,ymax = ans['peak_data']['extent']
                 ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=[xmin, xmax, ymin, ymax])
         
                 # Plot individual sources
@@ -843,15 +1815,9 @@ def plot_consensus(consensus,figno=1,savefig=False):
     
     # Display IR and radio images
     
-    im_standard = grab_image(sub,imgtype='standard')
-
-    ax1 = fig.add_subplot(141)
     ax1.imshow(im_standard,origin='upper')
     ax1.set_title('WISE')
 
-    im_radio = grab_image(sub,imgtype='radio')
-
-    ax2 = fig.add_subplot(142)
     ax2.imshow(im_radio,origin='upper')
     ax2.set_title(sub['metadata']['source'])
     ax2.get_yaxis().set_ticklabels([])
@@ -859,7 +1825,7 @@ def plot_consensus(consensus,figno=1,savefig=False):
     ax3.get_yaxis().set_ticklabels([])
 
     # Plot contours identified as the consensus
-    if len(answer) > 0:
+    if len(answer) > 0 and patch_black is not None:
         ax4.add_patch(patch_black)
     ax4.yaxis.tick_right()
 
@@ -870,11 +1836,23 @@ def plot_consensus(consensus,figno=1,savefig=False):
     ax3.get_xaxis().set_ticks(np.arange(nticks)*img_params[survey]['IMG_WIDTH_NEW'] * 1./nticks)
     ax4.get_xaxis().set_ticks(np.arange(nticks+1)*img_params[survey]['IMG_WIDTH_NEW'] * 1./nticks)
 
-    plt.subplots_adjust(wspace=0.02)
+    return None
+
+def plot_consensus(consensus,figno=1,savefig=False):
+
+    # Plot a 4-panel image of IR, radio, KDE estimate, and consensus
+    
+    sub = subjects.find_one({'zooniverse_id':consensus['zid']})
+
+    fig = plt.figure(figno,(15,4))
+    axes = consensus_axes(fig)
+    draw_consensus(axes,consensus,sub,get_contours(sub,pathdict),grab_image(sub,imgtype='standard'),grab_image(sub,imgtype='radio'))
     
-    # Save hard copy of the figure
+    # Save hard copy of the figure (savefig can also be the name of the file)
     if savefig == True:
-        fig.savefig('{0}/{1}/{2}.pdf'.format(plot_path,consensus['survey'],zid))
+        fig.savefig(consensus_plot_file(consensus))
+    elif isinstance(savefig,basestring):
+        fig.savefig(consensus_plot_file(consensus,savefig))
     else:
         plt.show()
 
@@ -883,48 +1861,813 @@ def plot_consensus(consensus,figno=1,savefig=False):
 
     return None
 
+def consensus_plot_file(consensus,name=None):
+
+    # Where the plot of a consensus is saved; named after the subject unless another name is given
+
+    return '{0}/{1}/{2}.pdf'.format(plot_path,consensus['survey'],consensus['zid'] if name is None else name)
+
+# Figure and axes for saving consensus plots, made once in each process (see save_consensus_plot)
+_plot_axes = None
+
+def save_consensus_plot(consensus,sub=None,name=None):
+
+    # Save the plot of a consensus without going through pyplot, drawing on the same figure every
+    # time rather than making a new one for each subject
+
+    global _plot_axes
+
+    if _plot_axes is None:
+        fig = Figure(figsize=(15,4))
+        FigureCanvasAgg(fig)
+        _plot_axes = consensus_axes(fig)
+
+    if sub is None:
+        sub = subjects.find_one({'zooniverse_id':consensus['zid']})
+
+    draw_consensus(_plot_axes,consensus,sub,get_contours(sub,pathdict),grab_image(sub,imgtype='standard'),grab_image(sub,imgtype='radio'))
+    _plot_axes[0].figure.savefig(consensus_plot_file(consensus,name))
+
+    return None
+
+def plot_chunk(chunk):
+
+    # Save the plots for a chunk of (consensus, file name) pairs, reading all of their subjects at once
+
+    zids = [cons['zid'] for cons,name in chunk]
+    subs = dict([(sub['zooniverse_id'],sub) for sub in subjects.find({'zooniverse_id':{'$in':zids}})])
+    prefetch_images(subs.itervalues())
+
+    for cons,name in chunk:
+        save_consensus_plot(cons,subs[cons['zid']],name)
+
+    return len(chunk)
+
+def plot_consensus_batch(consensus_list,workers=1,chunk_size=50,names=None):
+
+    # Save the plots for a list of consensus results (with their peak data), shared out to a pool
+    # of processes if workers > 1. names is an optional list of file names to use in place of
+    # the zooniverse IDs, one for each consensus.
+
+    if names is None:
+        names = [None] * len(consensus_list)
+    pairs = [(cons,name) for cons,name in zip(consensus_list,names) if cons is not None]
+    chunks = [pairs[i:i+chunk_size] for i in range(0,len(pairs),chunk_size)]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers,initializer=connect_mongo)
+        try:
+            n_plots = sum(pool.imap_unordered(plot_chunk,chunks))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        n_plots = sum([plot_chunk(chunk) for chunk in chunks])
+
+    return n_plots
+
 def classifiers_per_image(zid):
 
     # Print list of the users who classified a particular subject
 
     sid = subjects.find_one({'zooniverse_id':zid})['_id']
-    c_all = classifications.find({'subject_ids':sid,'user_name':{'$exists':True,'$nin':expert_names()}}).sort([("updated_at", -1)])
-    clist = list(c_all)
+    list_classifiers(find_classifications({'subject_ids':sid,'user_name':{'$exists':True,'$nin':expert_names()}}))
+
+    return None
+
+def list_classifiers(records):
+
+    # Print the registered volunteers (not the science team) who made a set of classifications, latest first
+
+    ex = expert_names()
+    clist = sorted([c for c in records if c.user_name is not None and c.user_name not in ex],key=lambda c: c.updated_at,reverse=True)
+    for c in clist:
+        print '{0:25} {1}'.format(c.user_name,c.updated_at)
+
+    return None
+
+def in_population(c,experts_only=False,excluded=[],no_anonymous=False):
+
+    # Whether a classification would be selected by checksum() with the same options
+
+    if experts_only and not c.expert:
+        return False
+    if c.user_name in excluded:
+        return False
+    if no_anonymous and c.user_name is None:
+        return False
+
+    return True
+
+def expert_volunteer_views():
+
+    # Populations for comparing the science team with registered volunteers
+
+    return [('volunteers',{'excluded':expert_names(),'no_anonymous':True}),
+            ('experts',{'experts_only':True})]
+
+def checksum_views(zid,views,include_peak_data=True,weights=0,scheme='scaling',kde='grid'):
+
+    # Find the consensus for a subject for several populations of classifiers at once. Each view is
+    # given as (name, options), where the options are those of checksum() (experts_only, excluded,
+    # no_anonymous). The classifications are fetched and parsed once and then split up for each
+    # view. Returns a dictionary of the consensus for each view name.
+
+    sub = subjects.find_one({'zooniverse_id':zid})
+    records = find_classifications({"subject_ids": sub['_id'], "updated_at": {"$gt": main_release_date}})
+
+    return checksum_views_from_records(sub,records,views,include_peak_data,weights,scheme,kde)
+
+def checksum_views_from_records(sub,records,views,include_peak_data=True,weights=0,scheme='scaling',kde='grid',include_ir=True):
+
+    # Consensus for each view of a subject from classifications that have already been retrieved
+
+    assert kde in kde_engines, 'KDE engine must be one of {0}, not {1}'.format(kde_engines,kde)
+
+    results = {}
+    for name,options in views:
+        tally = vote_tally(sub,[c for c in records if in_population(c,**options)],weights,scheme)
+        results[name] = consensus_from_tally(tally,include_peak_data,kde,include_ir)
+
+    return results
+
+def iter_consensus_views(zooniverse_ids,views,include_peak_data=False,weights=0,scheme='scaling',kde='grid',include_ir=True):
+
+    # Consensus for each view of a list of subjects, fetched in bulk. Yields (zooniverse_id, results).
+
+    for zid,sub,records in iter_subject_records(zooniverse_ids):
+        yield zid, checksum_views_from_records(sub,records,views,include_peak_data,weights,scheme,kde,include_ir)
+
+def compare_views(zooniverse_ids,views=None):
+
+    # Compare the radio sources found by two views (by default the experts and the volunteers)
+    # for a list of subjects, such as the expert100 sample. Only the combinations of radio
+    # components are compared, so the IR peaks aren't computed.
+
+    if views is None:
+        views = expert_volunteer_views()
+    assert len(views) == 2, 'Comparisons need exactly two views'
+    name1,name2 = views[0][0],views[1][0]
+
+    comparison = []
+    for zid,results in iter_consensus_views(zooniverse_ids,views,include_ir=False):
+        keys1 = results[name1]['answer'].keys() if results[name1] is not None else []
+        keys2 = results[name2]['answer'].keys() if results[name2] is not None else []
+        comparison.append({'zid':zid,name1:len(keys1),name2:len(keys2),'match':set(keys1) == set(keys2)})
+
+    return comparison
+
+def tally_arrays(tally):
+
+    # The votes in a tally as arrays for resampling: the combination each vote went to (as an
+    # index into the list of checksums), in the order the classifications were made, and the
+    # weight of each vote (1 plus any extra votes from the weighting scheme).
+
+    clist = tally['clist']
+    order = sorted(range(len(clist)),key=lambda i: clist[i].created_at)
+
+    combos,index = [],{}
     for c in clist:
+        if not index.has_key(c.checksum):
+            index[c.checksum] = len(combos)
+            combos.append(c.checksum)
+
+    votes = np.array([index[clist[i].checksum] for i in order],dtype=int)
+    w = np.array([1 + tally['extra'][i] for i in order],dtype=float)
+
+    return votes,w,combos
+
+def winner_share(counts,iwin):
+
+    # How much of a win combination iwin gets from the vote counts in the last axis of counts.
+    # A tie for the most votes is shared equally between the tied combinations.
+
+    top = counts == counts.max(axis=-1)[...,np.newaxis]
+
+    return top[...,iwin] / top.sum(axis=-1)
+
+def bootstrap_tally(tally,n_boot=1000,n_sub=200,n_max=20,ci=0.95,rng=None):
+
+    # Uncertainty of the consensus for one subject from its vote tally, without looking at the
+    # classifications again. All of the resamples are counted at once with NumPy:
+    #
+    #   bootstrap:   n_boot resamples of the votes with replacement give the probability that the
+    #                same combination wins (p_winner) and a confidence interval on its vote
+    #                fraction (level_lo, level_hi; ci is the coverage).
+    #   subsample:   n_sub random orderings of the votes give the probability that the first n
+    #                votes pick the same combination as all of them, for n = 1 ... n_max.
+    #   chrono:      the same for the first n votes in the order they were actually made, ie.
+    #                the answer if the subject had been retired after n classifications.
+    #
+    # The convergence curves are NaN beyond the number of votes for the subject. Returns None if
+    # there are no votes for any radio components.
+
+    maxval,mc_checksum = tally_winner(tally)
+    if maxval == 0:
+        return None
+
+    if rng is None:
+        rng = np.random.RandomState()
+
+    votes,w,combos = tally_arrays(tally)
+    n,m = len(votes),len(combos)
+    iwin = combos.index(mc_checksum)
+
+    # Bootstrap resamples; the votes of each resample are counted with a single bincount
+    draw = rng.randint(0,n,size=(n_boot,n))
+    rows = np.repeat(np.arange(n_boot),n)
+    counts = np.bincount(rows*m + votes[draw].ravel(),weights=w[draw].ravel(),minlength=n_boot*m).reshape(n_boot,m)
+    level = counts[:,iwin] / counts.sum(axis=1)
+    lo,hi = np.percentile(level,[50.*(1-ci),100.-50.*(1-ci)])
+
+    # Resamples won by each of the other combinations, with ties shared as in winner_share
+    top = counts == counts.max(axis=1)[:,np.newaxis]
+    wins = (top / top.sum(axis=1)[:,np.newaxis].astype(float)).sum(axis=0)
+    wins[iwin] = 0
+
+    # Votes in random order and in the order they were made, counted cumulatively
+    k = min(n_max,n)
+    perm = np.argsort(rng.rand(n_sub,n),axis=1)[:,:k]
+    shuffled = np.zeros((n_sub,k,m))
+    shuffled[np.arange(n_sub)[:,np.newaxis],np.arange(k),votes[perm]] = w[perm]
+    chrono = np.zeros((k,m))
+    chrono[np.arange(k),votes[:k]] = w[:k]
+
+    stability_subsample = np.empty(n_max) * np.nan
+    stability_subsample[:k] = winner_share(shuffled.cumsum(axis=1),iwin).mean(axis=0)
+    stability_chrono = np.empty(n_max) * np.nan
+    stability_chrono[:k] = winner_share(chrono.cumsum(axis=0),iwin)
+
+    result = {}
+    result['zid'] = tally['sub']['zooniverse_id']
+    result['contour_count'] = tally['sub']['metadata'].get('contour_count')
+    result['n_votes'] = maxval
+    result['n_total'] = w.sum()
+    result['consensus_level'] = maxval / w.sum()
+    result['level_lo'] = lo
+    result['level_hi'] = hi
+    result['p_winner'] = winner_share(counts,iwin).mean()
+    result['n_winners'] = (wins > 0).sum() + 1
+    result['p_runner_up'] = wins.max() / n_boot
+    result['stability_subsample'] = stability_subsample
+    result['stability_chrono'] = stability_chrono
+
+    return result
+
+def iter_uncertainty(zooniverse_ids,weights=0,scheme='scaling',n_boot=1000,n_sub=200,n_max=20,ci=0.95,seed=None):
+
+    # Bootstrap uncertainty (see bootstrap_tally) for a list of subjects, fetched in bulk. Only
+    # the combinations of radio components are resampled, so the IR peaks aren't computed.
+    # Yields the result for each subject with any votes.
+
+    rng = np.random.RandomState(seed)
+
+    for zid,sub,records in iter_subject_records(zooniverse_ids):
+        tally = vote_tally(sub,records,weights,scheme)
+        result = bootstrap_tally(tally,n_boot,n_sub,n_max,ci,rng)
+        if result is not None:
+            yield result
+
+def run_uncertainty(survey,zooniverse_ids=None,weights=0,scheme='scaling',n_boot=1000,n_sub=200,n_max=20,ci=0.95,seed=None):
+
+    # Bootstrap uncertainty of the consensus for every completed subject in a survey (or just
+    # those in zooniverse_ids). Writes a CSV with the confidence interval of each subject's
+    # consensus level, and one with the convergence curves: the mean probability that the first
+    # n votes give the final answer, for subjects with one radio component and with more
+    # (retired after 5 and 20 classifications; see enddate.how_many_left).
+
+    if zooniverse_ids is None:
+        zooniverse_ids = [cz['zooniverse_id'] for cz in subjects.find({'state':'complete','metadata.survey':survey},{'zooniverse_id':1})]
+
+    filestem = 'consensus_rgz_{0}{1}'.format(survey,variant_suffix(scheme,weights))
+
+    groups = ('single','multiple')
+    curves = ('subsample','chrono')
+    sums = dict([((g,c),np.zeros(n_max)) for g in groups for c in curves])
+    nsubjects = dict([(g,np.zeros(n_max,dtype=int)) for g in groups])
+
+    with open('{0}/csv/{1}_uncertainty.csv'.format(rgz_path,filestem),'w') as f:
+        f.write('zooniverse_id,n_votes,n_total,consensus_level,level_lo,level_hi,p_winner,n_winners,p_runner_up\n')
+        for r in iter_uncertainty(zooniverse_ids,weights,scheme,n_boot,n_sub,n_max,ci,seed):
+            f.write('{0},{1:g},{2:g},{3:.3f},{4:.3f},{5:.3f},{6:.3f},{7:d},{8:.3f}\n'.format(r['zid'],r['n_votes'],r['n_total'],
+                r['consensus_level'],r['level_lo'],r['level_hi'],r['p_winner'],r['n_winners'],r['p_runner_up']))
+            g = 'single' if r['contour_count'] == 1 else 'multiple'
+            have = np.isfinite(r['stability_chrono'])
+            nsubjects[g] += have
+            for c in curves:
+                sums[(g,c)][have] += r['stability_{0}'.format(c)][have]
+
+    with open('{0}/csv/{1}_convergence.csv'.format(rgz_path,filestem),'w') as f:
+        f.write('n_votes,{0}\n'.format(','.join(['{0}_{1}'.format(group,curve) for group in groups for curve in curves + ('n',)])))
+        for i in range(n_max):
+            row = [str(i+1)]
+            for g in groups:
+                for c in curves:
+                    row.append('{0:.4f}'.format(sums[(g,c)][i] / nsubjects[g][i]) if nsubjects[g][i] > 0 else '')
+                row.append(str(nsubjects[g][i]))
+            f.write('{0}\n'.format(','.join(row)))
+
+    return None
+
+def rc(zid):
+
+    # Visually compare the expert and volunteer consensus for a subject
+    
+    plt.ion()
+
+    # Get all of the classifications once, for both the list of classifiers and the consensus
+    sub = subjects.find_one({'zooniverse_id':zid})
+    records = find_classifications({'subject_ids':sub['_id']})
+    list_classifiers(records)
+
+    current = [c for c in records if c.updated_at > main_release_date]
+    views = checksum_views_from_records(sub,current,expert_volunteer_views())
+
+    cons = views['volunteers']
+    plot_consensus(cons,figno=1,savefig=False)
+    print '\nVolunteers: {0:d} sources'.format(len(cons['answer']))
+
+    cons_ex = views['experts']
+    plot_consensus(cons_ex,figno=2,savefig=False)
+    print '   Experts: {0:d} sources'.format(len(cons_ex['answer']))
+
+    return None
+
+def connect_mongo():
+
+    # Open a new connection to the Mongo collections. MongoClient can't be shared across a fork,
+    # so this is run once in every worker process.
+
+    global client, db, subjects, classifications, consensus, user_weights, weight_params
+
+    client = MongoClient('localhost', 27017)
+    db = client['radio']
+    subjects = db['radio_subjects']
+    classifications = db['radio_classifications']
+    consensus = db['consensus{}'.format(version)]
+    user_weights = db['user_weights{}'.format(version)]
+    weight_params = db['user_weights{}_params'.format(version)]
+
+    return None
+
+def consensus_chunk(args):
+
+    # Run the consensus on a chunk of subjects and prepare the results for output. The votes for
+    # each subject are counted once, and then weighted for each of the (scheme, weights) variants.
+    # Variants that end up with the same winning combination and IR clicks share the same KDE.
+
+    zooniverse_ids,do_plot,variants,kde,top_k,run_started,ir_count,sweep = args
+
+    results = []
+    for zid,sub,records in iter_subject_records(zooniverse_ids,chunk_size=len(zooniverse_ids),prefetch=do_plot):
+
+        tally = vote_tally(sub,records)
+        ir_cache = {}
+
+        subject_results = []
+        for iv,(scheme,weights) in enumerate(variants):
+
+            wtally = weighted_tally(tally,weights,scheme,recompute=sweep)
+            cons = consensus_from_tally(wtally,include_peak_data=do_plot,kde=kde,ir_cache=ir_cache,ir_count=ir_count)
+
+            if cons is not None:
+
+                # Plots are only made for the first variant, since they'd all be saved to the same file
+                if do_plot and iv == 0:
+                    save_consensus_plot(cons,sub)
+
+                if top_k > 1:
+                    cons['alternatives'] = consensus_alternatives(wtally,top_k,kde=kde)
+
+                cons['watermark'] = subject_watermark(sub,records,run_started)
+
+                for c in [cons] + cons.get('alternatives',[]):
+
+                    c['consensus_level'] = (c['n_votes']/c['n_total'])
+
+                    # Remove peak data from saved catalog; numpy arrays are not JSON serializable (may want to adjust later).
+                    # http://stackoverflow.com/questions/3488934/simplejson-and-numpy-array/24375113#24375113
+                    for ans in c['answer']:
+                        if c['answer'][ans].has_key('peak_data'):
+                            c['answer'][ans].pop('peak_data',None)
+
+            subject_results.append(cons)
+
+        results.append(subject_results)
+
+    return results
+
+def iter_consensus_variants(zooniverse_ids,variants,do_plot=False,kde='grid',workers=1,chunk_size=500,top_k=1,run_started=None,ir_count=False,sweep=False):
+
+    # Run the consensus on a list of subjects for several weighting schemes at once, given as a list
+    # of (scheme, weights). Yields a list with the consensus for each variant, for each subject in
+    # the same order as the list. With workers > 1 the chunks are shared out to a pool of processes,
+    # each with its own Mongo connection. imap returns them in order, so the output doesn't depend
+    # on the number of workers. With top_k > 1, each consensus also has the runners-up in its
+    # 'alternatives' list. With sweep=True the user weights for each variant are found again
+    # rather than taken from the user_weights collection (see variant_weights).
+
+    # Time this run started, recorded in the watermark of each subject (see subject_watermark)
+    if run_started is None:
+        run_started = datetime.datetime.utcnow().isoformat()
+
+    chunks = [(zooniverse_ids[i:i+chunk_size],do_plot,variants,kde,top_k,run_started,ir_count,sweep) for i in range(0,len(zooniverse_ids),chunk_size)]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers,initializer=connect_mongo)
+        try:
+            for results in pool.imap(consensus_chunk,chunks):
+                for cons in results:
+                    yield cons
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for chunk in chunks:
+            for cons in consensus_chunk(chunk):
+                yield cons
+
+def iter_consensus(zooniverse_ids,do_plot=False,weights=0,scheme='scaling',kde='grid',workers=1,chunk_size=500,top_k=1,run_started=None,ir_count=False):
+
+    # Run the consensus on a list of subjects with a single weighting scheme, yielding the results
+    # in the same order as the list
+
+    for cons in iter_consensus_variants(zooniverse_ids,[(scheme,weights)],do_plot,kde,workers,chunk_size,top_k,run_started,ir_count):
+        yield cons[0]
+
+def subject_watermark(sub,records,run_started):
+
+    # State of the classifications of a subject when its consensus was found: the latest update of
+    # any of them, and the classification count of the subject. An incremental run (see
+    # changed_subjects) only redoes subjects where either of these has changed since.
+
+    if len(records) > 0:
+        latest = max([c.updated_at for c in records]).isoformat()
+    else:
+        latest = None
+
+    watermark = {'updated_at':latest,
+                 'classification_count':sub.get('classification_count'),
+                 'run_started':run_started}
+
+    return watermark
+
+def parse_watermark(timestamp):
+
+    # Convert a timestamp saved in a watermark back to a datetime
+
+    try:
+        return datetime.datetime.strptime(timestamp,'%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.datetime.strptime(timestamp,'%Y-%m-%dT%H:%M:%S')
+
+def changed_subjects(master,counts):
+
+    # Find the subjects in a consensus catalog (read in a single pass, see iter_master) whose classifications have changed since their
+    # consensus was found, given the current classification count of each subject. Subjects are
+    # included if their count has changed, or if any classification has been updated since their
+    # watermark. Only classifications updated since the start of the latest run need to be checked,
+    # since everything before that was already picked up by that run; this is a query on the
+    # updated_at index. Subjects without a watermark (from older catalogs) are always included.
+
+    changed = set()
+    latest = {}
+    since = None
+    order = []
+
+    for gal in master:
+        zid = gal['zid']
+        order.append(zid)
+        wm = gal.get('watermark')
+        if wm is None or wm['updated_at'] is None or counts.get(zid,wm['classification_count']) != wm['classification_count']:
+            changed.add(zid)
+        else:
+            latest[zid] = parse_watermark(wm['updated_at'])
+            run_started = parse_watermark(wm['run_started'])
+            if since is None or run_started > since:
+                since = run_started
+
+    if since is not None:
+
+        check_indices(('updated_at',))
+
+        updated = {}
+        for c in classifications.find({'updated_at':{'$gt':since}},{'subject_ids':1,'updated_at':1}):
+            for imgid in c['subject_ids']:
+                if not updated.has_key(imgid) or c['updated_at'] > updated[imgid]:
+                    updated[imgid] = c['updated_at']
+
+        for sub in subjects.find({'_id':{'$in':updated.keys()}},{'zooniverse_id':1}):
+            zid = sub['zooniverse_id']
+            if latest.has_key(zid) and updated[sub['_id']] > latest[zid]:
+                changed.add(zid)
+
+    # Keep the order of the catalog
+    return [z for z in order if z in changed]
+
+def same_consensus(old,new):
+
+    # Whether two consensus results for a subject have the same answer, ignoring the watermark.
+    # The new one goes through JSON first so that it can be compared with one read from a file.
+
+    if old is None or new is None:
+        return old is None and new is None
+
+    old = dict(old)
+    new = json.loads(json.dumps(new))
+    old.pop('watermark',None)
+    new.pop('watermark',None)
+
+    return old == new
+
+def variant_suffix(scheme,weights):
+
+    # Suffix for the output files and Mongo collection of a weighting scheme in a sweep
+
+    if weights == 0:
+        return ''
+    return '_{0}{1}'.format(scheme,weights)
+
+def csv_rows(cons):
+
+    # Rows of the consensus CSV file for a single subject (one per radio source, in label order so
+    # they don't depend on the order of the answer dictionary)
+
+    rows = []
+    for ans in sorted(cons['answer'].itervalues(),key=lambda ans: ans['ind']):
+        try:
+            ir_peak = ans['ir_peak']
+        except KeyError:
+            ir_peak = ans['ir'] if ans.has_key('ir') else (-99,-99)
+
+        try:
+            rows.append('{0},{1},{2:4d},{3:4d},{4:.3f},{5:2d},{6},"{7}","{8}",{9:.3f}\n'.format( \
+                    cons['zid'],cons['source'],cons['n_votes'],cons['n_total'],cons['consensus_level'], \
+                    len(ans['xmax']),alphabet(ans['ind']),bbox_unravel(ans['bbox']),ir_peak,ans['ir_level'],ans['ir_flag'],ans['n_ir']))
+        except KeyError:
+            print cons['zid']
+            print cons
+            logging.warning((cons['zid'], cons))
+
+    return rows
+
+def mongo_rows(cons,survey):
+
+    # Documents for the consensus collection for a single subject (one per radio source)
+
+    rows = []
+    for ans in sorted(cons['answer'].itervalues(),key=lambda ans: ans['ind']):
+        try:
+            ir_peak = ans['ir_peak']
+        except KeyError:
+            ir_peak = ans['ir'] if ans.has_key('ir') else (-99,-99)
+        
         try:
-            name = c['user_name']
+            new_con = {'zooniverse_id':cons['zid'], '{0}_id'.format(survey):cons['source'], 'n_votes':cons['n_votes'], \
+                       'n_total':cons['n_total'], 'consensus_level':cons['consensus_level'], 'n_radio':len(ans['xmax']), \
+                       'label':alphabet(ans['ind']), 'bbox':bbox_unravel(ans['bbox']), 'ir_peak':ir_peak, 'ir_level':ans['ir_level'], \
+                       'ir_flag':ans['ir_flag'], 'n_ir':ans['n_ir']}
+            if ans.has_key('ir_count'):
+                new_con['ir_count'] = ans['ir_count']
+            rows.append(new_con)
         except KeyError:
-            name = '<<< Anonymous >>>'
-        print '{0:25} {1}'.format(name,c['updated_at'])
+            print cons['zid']
+            print cons
+            logging.warning((cons['zid'], cons))
+
+    return rows
+
+class OutputSink(object):
+
+    # Write consensus results to the CSV file, JSON catalog and consensus collection in a background
+    # thread, so the consensus can carry on while they're written. Results are passed through a
+    # bounded queue, which stops the consensus from getting too far ahead of the output. CSV rows
+    # are buffered and Mongo documents are inserted in batches. Any of the outputs can be left out.
+
+    def __init__(self,survey,fc=None,store=None,collection=None,maxsize=1000,batch_size=1000):
+
+        self.survey = survey
+        self.fc = fc
+        self.store = store
+        self.collection = collection
+        self.batch_size = batch_size
+
+        self.queue = Queue.Queue(maxsize)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self,cons):
+
+        # Queue a consensus to be written. This blocks if the writer has fallen too far behind.
+
+        if self.error is not None:
+            self.raise_error()
+        self.queue.put(cons)
+
+    def flush(self):
+
+        # Wait until everything queued so far has been written and is safely on disk
+
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+        if self.error is not None:
+            self.raise_error()
+
+    def close(self):
+
+        # Write everything still in the queue and wait for the writer to finish
+
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            self.raise_error()
+
+    def raise_error(self):
+
+        # Raise an error from the writer in the main thread, with its original traceback
+
+        exc_type,exc_value,exc_tb = self.error
+        raise exc_type, exc_value, exc_tb
+
+    def run(self):
+
+        rows,docs = [],[]
+        done = False
+
+        try:
+            while True:
+                cons = self.queue.get()
+                if cons is None:
+                    done = True
+                    break
+
+                # Anything other than a consensus is an event to set once the output is flushed
+                if not isinstance(cons,dict):
+                    if len(rows) > 0:
+                        self.fc.writelines(rows)
+                        rows = []
+                    if len(docs) > 0:
+                        self.collection.insert(docs)
+                        docs = []
+                    if self.fc is not None:
+                        self.fc.flush()
+                        os.fsync(self.fc.fileno())
+                    if self.store is not None:
+                        flush_master(self.store)
+                    cons.set()
+                    continue
+
+                if self.store is not None:
+                    write_master(self.store,cons)
+                if self.fc is not None:
+                    rows.extend(csv_rows(cons))
+                if self.collection is not None:
+                    docs.extend(mongo_rows(cons,self.survey))
+
+                if len(rows) >= self.batch_size:
+                    self.fc.writelines(rows)
+                    rows = []
+                if len(docs) >= self.batch_size:
+                    self.collection.insert(docs)
+                    docs = []
+
+            if len(rows) > 0:
+                self.fc.writelines(rows)
+            if len(docs) > 0:
+                self.collection.insert(docs)
+
+        except BaseException:
+            # Keep emptying the queue, so the consensus isn't left waiting to put results on it
+            self.error = sys.exc_info()
+            while not done:
+                cons = self.queue.get()
+                done = cons is None
+                if not done and not isinstance(cons,dict):
+                    cons.set()
+
+def verify_workers(zooniverse_ids,workers=4,**kwargs):
+
+    # Check that a parallel run gives exactly the same CSV, JSON and Mongo output as a serial one
+
+    # Both runs get the same start time, so that their watermarks match
+    run_started = datetime.datetime.utcnow().isoformat()
+
+    outputs = []
+    for w in (1,workers):
+        output = []
+        for cons in iter_consensus(zooniverse_ids,workers=w,run_started=run_started,**kwargs):
+            if cons is not None:
+                output.append(json.dumps(cons,sort_keys=True))
+                output.extend(csv_rows(cons))
+                output.extend([repr(sorted(row.items())) for row in mongo_rows(cons,cons['survey'])])
+        outputs.append(output)
+
+    assert outputs[0] == outputs[1], 'Output with {0:d} workers differs from the serial run'.format(workers)
+
+    print 'Output with {0:d} workers is identical to the serial run for {1:d} subjects'.format(workers,len(zooniverse_ids))
+
+    return True
+
+def checkpoint_file(filestem):
+
+    # Path of the checkpoint for a run of the consensus
+
+    return '{0}/json/{1}.checkpoint.json'.format(rgz_path,filestem)
+
+def write_checkpoint(filestem,state):
+
+    # Save the state of a run, replacing the last checkpoint in a single step so that there's
+    # always a complete one on disk
+
+    path = checkpoint_file(filestem)
+    state['saved_at'] = datetime.datetime.now().isoformat()
+    with open(path+'.tmp','w') as f:
+        json.dump(state,f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path+'.tmp',path)
 
     return None
 
-def rc(zid):
+def read_checkpoint(filestem):
+
+    # Load the checkpoint of an unfinished run, if there is one
+
+    path = checkpoint_file(filestem)
+    if not os.path.exists(path):
+        return None
+
+    with open(path,'r') as f:
+        state = json.load(f)
+
+    return state
 
-    # Visually compare the expert and volunteer consensus for a subject
-    
-    plt.ion()
+def truncate_file(path,size):
 
-    classifiers_per_image(zid)
-    cons = checksum(zid,excluded=expert_names(),no_anonymous=True)
-    plot_consensus(cons,figno=1,savefig=False)
-    print '\nVolunteers: {0:d} sources'.format(len(cons['answer']))
+    # Open a file to carry on writing it from a checkpoint, throwing away anything after size bytes
 
-    cons_ex = checksum(zid,experts_only=True)
-    plot_consensus(cons_ex,figno=2,savefig=False)
-    print '   Experts: {0:d} sources'.format(len(cons_ex['answer']))
+    f = open(path,'r+')
+    f.truncate(size)
+    f.seek(0,os.SEEK_END)
 
-    return None
+    return f
 
-def run_sample(survey,update=True,subset=None,do_plot=False,weights=0,scheme='scaling'):
+def run_sample(survey,update=True,subset=None,do_plot=False,weights=0,scheme='scaling',kde='grid',workers=1,shard=None,schemes=None,resume=False,checkpoint_every=1000,ir_count=False):
 
-    # Run the consensus algorithm on the RGZ classifications
+    # Run the consensus algorithm on the RGZ classifications. If schemes is given as a list of
+    # (scheme, weights), a catalog is made for each of these weighting schemes in the same run;
+    # the outputs for each one are labelled by variant_suffix. With ir_count=True, the number of
+    # IR sources marked in each classification is saved with every answer (see consensus_from_tally).
+    #
+    # Every checkpoint_every subjects the outputs are flushed to disk and a checkpoint is saved. With
+    # resume=True, a run that was stopped part way through carries on from its last checkpoint.
     
     check_indices(('subject_ids','updated_at','zooniverse_id'))
 
+    # Shards are combined into a complete new catalog by merge_shards, so they can't be used to update one
+    assert shard is None or not update, 'Sharded runs must be run with update=False'
+    assert shard is None or not resume, 'Sharded runs are resumed by running the unfinished shards again'
+
+    if schemes is None:
+        variants = [(scheme,weights)]
+        vsuffixes = ['']
+    else:
+        assert not update and shard is None, 'Weighting scheme sweeps must be run with update=False and without shards'
+        variants = list(schemes)
+        vsuffixes = [variant_suffix(sch,w) for sch,w in variants]
+        assert len(set(vsuffixes)) == len(vsuffixes), 'Weighting schemes in a sweep must all be different'
+
     filestem = "consensus_rgz_{0}".format(survey)
+    suffix = '' if subset is None else '_{0}'.format(subset)
+
+    checkpoint = read_checkpoint(filestem+suffix) if resume else None
+    if checkpoint is not None:
+        assert checkpoint['survey'] == survey and checkpoint['update'] == update and \
+            [tuple(v) for v in checkpoint['variants']] == variants and checkpoint.get('ir_count',False) == ir_count, \
+            'Checkpoint for {0} was saved by a run with different settings'.format(filestem+suffix)
+
+        if checkpoint['finished']:
+            print '\nConsensus for {0} already completed.'.format(survey)
+            logging.info('\nConsensus for {0} already completed.'.format(survey))
+            return None
+
+    # Subjects already in the catalog which have to be done again
+    changed_zids = []
     
-    if subset is not None:
+    if checkpoint is not None:
+
+        # Carry on with the same list of subjects as the run that was stopped
+        zooniverse_ids = checkpoint['zooniverse_ids']
+        changed_zids = checkpoint['changed_zids']
+
+        print '\nResuming consensus for {0} after {1:d} of {2:d} subjects'.format(survey,checkpoint['n_done'],len(zooniverse_ids))
+        logging.info('\nResuming consensus for {0} after {1:d} of {2:d} subjects'.format(survey,checkpoint['n_done'],len(zooniverse_ids)))
+
+    elif subset is not None:
 
         '''
         Only run consensus for classifications of 
@@ -946,25 +2689,22 @@ def run_sample(survey,update=True,subset=None,do_plot=False,weights=0,scheme='sc
         with open('{0}/{1}'.format(rgz_path,pathd[subset]),'rb') as f:
             zooniverse_ids = [line.rstrip() for line in f]
 
-        suffix = '_{0}'.format(subset)
-
     else:
-        all_completed_zids = [cz['zooniverse_id'] for cz in subjects.find({'state':'complete','metadata.survey':survey})]
+        all_completed = list(subjects.find({'state':'complete','metadata.survey':survey},{'zooniverse_id':1,'classification_count':1}))
+        all_completed_zids = [cz['zooniverse_id'] for cz in all_completed]
 
         if update:
             '''
             Check to see which subjects have already been completed --
-                only run on subjects without an existing consensus.
+                only run on subjects without an existing consensus, or whose
+                classifications have changed since their consensus was found.
             '''
 
-            master_json = '{0}/json/{1}.json'.format(rgz_path,filestem)
+            # Only the index of the master catalog is needed to find the subjects already in it
+            master_idx = master_index(filestem)
+            master_json = master_files(filestem)['jsonl']
 
-            with open(master_json,'r') as fm:
-                jmaster = json.load(fm)
-
-            already_finished_zids = []
-            for gal in jmaster:
-                already_finished_zids.append(gal['zid'])
+            already_finished_zids = master_idx.keys()
 
             zooniverse_ids = list(set(all_completed_zids) - set(already_finished_zids))
 
@@ -974,165 +2714,804 @@ def run_sample(survey,update=True,subset=None,do_plot=False,weights=0,scheme='sc
             logging.info("{0:d} RGZ subjects completed since last consensus catalog generation on {1}".format(len(zooniverse_ids), \
                                                                                                               time.ctime(os.path.getmtime(master_json))))
 
+            counts = dict([(cz['zooniverse_id'],cz.get('classification_count')) for cz in all_completed])
+            changed_zids = changed_subjects(iter_master(filestem,index=master_idx),counts)
+            zooniverse_ids.extend(changed_zids)
+
+            # Cached results can't tell when a classification has been edited without changing the count
+            clear_consensus_cache(changed_zids)
+
+            print "{0:d} RGZ subjects in master catalog with new or changed classifications".format(len(changed_zids))
+            logging.info("{0:d} RGZ subjects in master catalog with new or changed classifications".format(len(changed_zids)))
+
         else:
 
             # Rerun consensus for every completed subject in RGZ.
             zooniverse_ids = all_completed_zids
 
-        suffix = ''
-
     # Remove the tutorial subject
     tutorial_zid = "ARG0003r15"
     try:
         zooniverse_ids.remove(tutorial_zid)
     except ValueError:
-        print '\nTutorial subject {0} not in list.'.format(tutorial_zid)
-        logging.info('\nTutorial subject {0} not in list.'.format(tutorial_zid))
+        if checkpoint is None:
+            print '\nTutorial subject {0} not in list.'.format(tutorial_zid)
+            logging.info('\nTutorial subject {0} not in list.'.format(tutorial_zid))
     
     print '\nLoaded data; running consensus algorithm on {0:d} completed RGZ subjects'.format(len(zooniverse_ids))
     logging.info('\nLoaded data; running consensus algorithm on {0:d} completed RGZ subjects'.format(len(zooniverse_ids)))
 
-    # Empty files and objects for CSV, JSON output
-    json_output = []
+    if shard is not None:
+        run_shard(survey,zooniverse_ids,shard,filestem+suffix,do_plot,weights,scheme,kde,workers,ir_count)
+        return None
 
-    # CSV header
-    if update:
-        fc = open('{0}/csv/{1}{2}.csv'.format(rgz_path,filestem,suffix),'a')
+    # Files and collections for CSV, JSON and Mongo output, for each weighting scheme. They're all
+    # written in the background by an OutputSink.
+    stores = []
+    fcs = []
+    sinks = []
+
+    if checkpoint is None:
+        state = {'survey':survey,
+                 'update':update,
+                 'variants':variants,
+                 'ir_count':ir_count,
+                 'zooniverse_ids':zooniverse_ids,
+                 'changed_zids':changed_zids,
+                 'run_started':datetime.datetime.utcnow().isoformat(),
+                 'n_done':0,
+                 'redone':[],
+                 'n_different':0,
+                 'finished':False}
     else:
-        fc = open('{0}/csv/{1}{2}.csv'.format(rgz_path,filestem,suffix),'w')
-        fc.write('zooniverse_id,{0}_id,n_votes,n_total,consensus_level,n_radio,label,bbox,ir_peak,ir_level,ir_flag,n_ir\n'.format(survey))
+        state = checkpoint
+
+    changed = set(changed_zids)
+    redone = set(state['redone'])
+    n_different = state['n_different']
+    n_done = state['n_done']
+
+    for ivar,vsuffix in enumerate(vsuffixes):
+
+        # Anything written after the checkpoint is thrown away, so that it isn't there twice
+        sizes = None if checkpoint is None else checkpoint['master'][ivar]
+        stores.append(open_master(filestem+suffix+vsuffix,update,sizes))
+
+        # CSV header
+        csvfile = '{0}/csv/{1}{2}{3}.csv'.format(rgz_path,filestem,suffix,vsuffix)
+        if checkpoint is not None:
+            fc = truncate_file(csvfile+'.tmp' if update else csvfile,checkpoint['csv'][ivar])
+        elif update:
+            # Copy over the rows of the subjects that aren't being done again; the new ones go at the end
+            with open(csvfile,'r') as f:
+                old_rows = f.readlines()
+            fc = open(csvfile+'.tmp','w')
+            fc.write(csv_header(survey))
+            for row in old_rows[1:]:
+                if row.split(',')[0] not in changed:
+                    fc.write(row)
+        else:
+            fc = open(csvfile,'w')
+            fc.write(csv_header(survey))
+        fcs.append(fc)
+
+        collection = db['consensus{0}{1}'.format(version,vsuffix)]
+        if checkpoint is not None:
+            collection.remove({'zooniverse_id':{'$in':zooniverse_ids[n_done:]}})
+        elif len(changed) > 0:
+            collection.remove({'zooniverse_id':{'$in':changed_zids}})
+
+        sinks.append(OutputSink(survey,fc,stores[-1],collection))
+
+    # The index of a resumed update can only be read once the catalog has been cut back to the
+    # checkpoint; anything past that point is no longer in the file
+    if checkpoint is not None and update:
+        master_idx = master_index(filestem)
+
+    def save_checkpoint(n_done,finished=False):
 
-    for idx,zid in enumerate(zooniverse_ids):
+        # Flush everything written so far, and record how far the run has got
+
+        for sink in sinks:
+            sink.flush()
+
+        state['n_done'] = n_done
+        state['redone'] = sorted(redone)
+        state['n_different'] = n_different
+        state['finished'] = finished
+        state['csv'] = [fc.tell() for fc in fcs]
+        state['master'] = [master_sizes(store) for store in stores]
+        write_checkpoint(filestem+suffix,state)
+
+        return None
+
+    save_checkpoint(n_done)
+
+    for idx,results in enumerate(iter_consensus_variants(zooniverse_ids[n_done:],variants,do_plot,kde,workers,run_started=state['run_started'],ir_count=ir_count,sweep=schemes is not None),n_done):
     
         # Check progress to screen
         if not idx % 100:
             print idx, datetime.datetime.now().strftime('%H:%M:%S.%f')
 
-        cons = checksum(zid,include_peak_data=do_plot,weights=weights,scheme=scheme)
-        if do_plot:
+        # Save results to files
 
-            plot_consensus(cons,savefig=True)
+        for cons,sink in zip(results,sinks):
 
-        # Save results to files
+            if cons is not None:
 
-        if cons is not None:
+                # Subjects that are being done again replace their old consensus
 
-            cons['consensus_level'] = (cons['n_votes']/cons['n_total'])
+                if cons['zid'] in changed:
+                    redone.add(cons['zid'])
+                    if not same_consensus(read_master(filestem+suffix,cons['zid'],master_idx),cons):
+                        n_different += 1
 
-            # JSON
+                sink.put(cons)
 
-            # Remove peak data from saved catalog; numpy arrays are not JSON serializable (may want to adjust later).
-            # http://stackoverflow.com/questions/3488934/simplejson-and-numpy-array/24375113#24375113
-            for ans in cons['answer']:
-                if cons['answer'][ans].has_key('peak_data'):
-                    popvar = cons['answer'][ans].pop('peak_data',None)
+        if not (idx+1) % checkpoint_every:
+            save_checkpoint(idx+1)
 
-            json_output.append(cons)
+    for sink in sinks:
+        sink.close()
 
-            # CSV
+    if update:
+        # Subjects which no longer have a consensus are taken out of the catalog
+        for zid in changed_zids:
+            if zid not in redone:
+                remove_master(stores[0],zid)
+                n_different += 1
+        print "Consensus changed for {0:d} of {1:d} subjects that were done again".format(n_different,len(changed_zids))
+        logging.info("Consensus changed for {0:d} of {1:d} subjects that were done again".format(n_different,len(changed_zids)))
+
+    for store,fc,vsuffix in zip(stores,fcs,vsuffixes):
+
+        # Close the new CSV file
+        fc.close()
+        if update:
+            os.rename(fc.name,fc.name[:-len('.tmp')])
 
-            for ans in cons['answer'].itervalues():
-                try:
-                    ir_peak = ans['ir_peak']
-                except KeyError:
-                    ir_peak = ans['ir'] if ans.has_key('ir') else (-99,-99)
+        # Close the JSON catalog
+        close_master(store)
 
-                try:
-                    fc.write('{0},{1},{2:4d},{3:4d},{4:.3f},{5:2d},{6},"{7}","{8}",{9:.3f}\n'.format( \
-                            cons['zid'],cons['source'],cons['n_votes'],cons['n_total'],cons['consensus_level'], \
-                            len(ans['xmax']),alphabet(ans['ind']),bbox_unravel(ans['bbox']),ir_peak,ans['ir_level'],ans['ir_flag'],ans['n_ir']))
-                except KeyError:
-                    print zid
-                    print cons
-                    logging.warning((zid, cons))
+        # Make 75% version for full catalog
 
-            # Mongo collection
+        if subset is None:
+            write_consensus_75(filestem+vsuffix)
 
-            for ans in cons['answer'].itervalues():
-                try:
-                    ir_peak = ans['ir_peak']
-                except KeyError:
-                    ir_peak = ans['ir'] if ans.has_key('ir') else (-99,-99)
-                
-                try:
-                    new_con = {'zooniverse_id':cons['zid'], '{0}_id'.format(survey):cons['source'], 'n_votes':cons['n_votes'], \
-                               'n_total':cons['n_total'], 'consensus_level':cons['consensus_level'], 'n_radio':len(ans['xmax']), \
-                               'label':alphabet(ans['ind']), 'bbox':bbox_unravel(ans['bbox']), 'ir_peak':ir_peak, 'ir_level':ans['ir_level'], \
-                               'ir_flag':ans['ir_flag'], 'n_ir':ans['n_ir']}
-                    consensus.insert(new_con)
-                except KeyError:
-                    print zid
-                    print cons
-                    logging.warning((zid, cons))
-
-    # Close the new CSV file
-    fc.close()
+    # Mark the run as finished, so it isn't started again by resuming
+    state['finished'] = True
+    write_checkpoint(filestem+suffix,state)
+        
+    print '\nCompleted consensus for {0}.'.format(survey)
+    logging.info('\nCompleted consensus for {0}.'.format(survey))
 
-    # Write and close the new JSON file
-    if update:
-        jmaster.extend(json_output)
-        jfinal = jmaster
-    else:
-        jfinal = json_output
+    return None
+
+def master_files(filestem):
+
+    # Paths of the master consensus catalog: the consensus for each subject on its own line, and a
+    # small index with the position of the latest consensus for each subject in the file
+
+    files = {'jsonl':'{0}/json/{1}.jsonl'.format(rgz_path,filestem),
+             'index':'{0}/json/{1}.jsonl.idx'.format(rgz_path,filestem)}
+
+    return files
+
+def master_index(filestem):
+
+    # Read the index of the master catalog into a dictionary of (offset, consensus_level) for each
+    # subject. Each line of the index is "zid<tab>offset<tab>consensus_level"; later lines replace
+    # earlier ones for the same subject, and an offset of -1 means the subject has been removed.
+
+    files = master_files(filestem)
+
+    if not os.path.exists(files['index']) and os.path.exists('{0}/json/{1}.json'.format(rgz_path,filestem)):
+        convert_master_json(filestem)
+
+    index = {}
+    with open(files['index'],'r') as f:
+        for line in f:
+            zid,offset,level = line.rstrip('\n').split('\t')
+            if int(offset) < 0:
+                index.pop(zid,None)
+            else:
+                index[zid] = (int(offset),float(level))
+
+    return index
+
+def iter_master(filestem,min_level=None,index=None):
+
+    # Stream the current consensus for each subject in the master catalog, in the order they were
+    # written. With min_level, subjects below that consensus level are skipped using the index,
+    # without reading them from the file.
+
+    if index is None:
+        index = master_index(filestem)
+
+    live = sorted([(offset,zid) for zid,(offset,level) in index.iteritems() if min_level is None or level >= min_level])
+
+    with open(master_files(filestem)['jsonl'],'rb') as f:
+        for offset,zid in live:
+            f.seek(offset)
+            yield json.loads(f.readline())
+
+def read_master(filestem,zid,index):
+
+    # Read the current consensus for one subject from the master catalog
+
+    with open(master_files(filestem)['jsonl'],'rb') as f:
+        f.seek(index[zid][0])
+        return json.loads(f.readline())
+
+def open_master(filestem,update=True,sizes=None):
+
+    # Open the master catalog for writing. With update=True new results are appended to it (replacing
+    # any older ones for the same subjects); otherwise a new catalog is written to temporary files,
+    # which replace the old one when it's closed. To carry on writing after a checkpoint, sizes are
+    # those given by master_sizes at the checkpoint; anything written after it is thrown away.
+
+    files = master_files(filestem)
+    tmp = '' if update else '.tmp'
+
+    if sizes is not None:
+        truncate_file(files['jsonl']+tmp,sizes['jsonl']).close()
+        truncate_file(files['index']+tmp,sizes['index']).close()
+    elif not update or not os.path.exists(files['index']):
+        open(files['index']+tmp,'w').close()
+
+    fj = open(files['jsonl']+tmp,'ab' if update or sizes is not None else 'wb')
+    fj.seek(0,os.SEEK_END)
+
+    # The index lines are only written once the data they point to is safely on disk
+    store = {'files':files,'tmp':tmp,'json':fj,'index':[]}
+
+    return store
+
+def write_master(store,cons):
+
+    # Add the consensus for one subject to the master catalog
+
+    offset = store['json'].tell()
+    store['json'].write(json.dumps(cons,sort_keys=True)+'\n')
+    level = cons['consensus_level'] if cons.has_key('consensus_level') else cons['n_votes']/cons['n_total']
+    store['index'].append('{0}\t{1:d}\t{2!r}\n'.format(cons['zid'],offset,level))
+
+    return None
+
+def remove_master(store,zid):
+
+    # Remove a subject from the master catalog
+
+    store['index'].append('{0}\t-1\t0.0\n'.format(zid))
+
+    return None
+
+def flush_master(store):
+
+    # Make sure everything written to the master catalog so far is on disk, and add it to the index
+
+    store['json'].flush()
+    os.fsync(store['json'].fileno())
+
+    with open(store['files']['index']+store['tmp'],'a') as fi:
+        fi.writelines(store['index'])
+        fi.flush()
+        os.fsync(fi.fileno())
+    store['index'] = []
+
+    return None
+
+def master_sizes(store):
+
+    # Sizes of the master catalog files after the last flush, for a checkpoint
+
+    sizes = {'jsonl':store['json'].tell(),
+             'index':os.path.getsize(store['files']['index']+store['tmp'])}
+
+    return sizes
+
+def close_master(store):
+
+    # Finish writing the master catalog, and write the index
+
+    files = store['files']
+
+    flush_master(store)
+    store['json'].close()
+
+    if store['tmp'] != '':
+        os.rename(files['jsonl']+store['tmp'],files['jsonl'])
+        os.rename(files['index']+store['tmp'],files['index'])
+
+    return None
+
+def compact_master(filestem):
+
+    # Rewrite the master catalog with only the current consensus for each subject, dropping the
+    # older versions left behind by incremental runs
+
+    index = master_index(filestem)
+    store = open_master(filestem,update=False)
+    for cons in iter_master(filestem,index=index):
+        write_master(store,cons)
+    close_master(store)
+
+    return None
+
+def convert_master_json(filestem):
+
+    # Convert a master catalog from a single JSON list (as written before the catalog was kept as
+    # JSON lines) into the new format. This only needs to be done once.
+
+    print 'Converting {0}.json to JSON lines'.format(filestem)
+    logging.info('Converting {0}.json to JSON lines'.format(filestem))
+
+    with open('{0}/json/{1}.json'.format(rgz_path,filestem),'r') as fm:
+        jmaster = json.load(fm)
+
+    store = open_master(filestem,update=False)
+    for cons in jmaster:
+        write_master(store,cons)
+    close_master(store)
+
+    return None
+
+def write_consensus_75(filestem):
+
+    # Write the versions of the JSON and CSV catalogs with at least 75% consensus. Both are filtered
+    # as they're read, so the full catalog never has to be held in memory.
+
+    # JSON
+    with open('{0}/json/{1}_75.json'.format(rgz_path,filestem),'w') as fj:
+        fj.write('[')
+        for idx,cons in enumerate(iter_master(filestem,min_level=0.75)):
+            if idx:
+                fj.write(', ')
+            fj.write(json.dumps(cons))
+        fj.write(']')
+
+    # CSV
+    with open('{0}/csv/{1}.csv'.format(rgz_path,filestem),'r') as fc, open('{0}/csv/{1}_75.csv'.format(rgz_path,filestem),'w') as fc75:
+        fc75.write(fc.readline())
+        for row in fc:
+            if float(row.split(',')[4]) >= 0.75:
+                fc75.write(row)
+
+    return None
+
+def shard_of(zid,nshards):
+
+    # Shard that a subject belongs to. Uses md5 rather than hash() so that it's the same on every machine.
 
-    with open('{0}/json/{1}{2}.json'.format(rgz_path,filestem,suffix),'w') as fj:
-        json.dump(jfinal,fj)
+    return int(hashlib.md5(zid).hexdigest(),16) % nshards
 
-    # Make 75% version for full catalog
+def shard_files(stem,ishard,nshards):
+
+    # Paths of the partial outputs written for a single shard
+
+    shardstem = '{0}/shards/{1}.shard{2:03d}of{3:03d}'.format(rgz_path,stem,ishard,nshards)
+    files = {'csv':'{0}.csv'.format(shardstem),             # rows of the CSV catalog
+             'json':'{0}.json'.format(shardstem),           # one consensus per line
+             'mongo':'{0}.mongo.json'.format(shardstem),    # one document per line for the consensus collection
+             'meta':'{0}.meta.json'.format(shardstem)}      # which subjects the shard covers
+
+    return files
+
+def run_shard(survey,zooniverse_ids,shard,stem,do_plot=False,weights=0,scheme='scaling',kde='grid',workers=1,ir_count=False):
+
+    # Run the consensus for only the subjects in one shard (i,N) of the full list, and write partial
+    # outputs to be combined by merge_shards. Nothing is written to the consensus collection here.
+
+    ishard,nshards = shard
+    assert 0 <= ishard < nshards, 'Shard must be between 0 and {0:d}, not {1:d}'.format(nshards-1,ishard)
+
+    if not os.path.exists('{0}/shards'.format(rgz_path)):
+        os.makedirs('{0}/shards'.format(rgz_path))
+    files = shard_files(stem,ishard,nshards)
+
+    # Keep the position of each subject in the full list, so the merged output has the same order as a single run
+    assigned = [(idx,zid) for idx,zid in enumerate(zooniverse_ids) if shard_of(zid,nshards) == ishard]
+
+    print 'Shard {0:d}/{1:d}: {2:d} of {3:d} subjects'.format(ishard,nshards,len(assigned),len(zooniverse_ids))
+    logging.info('Shard {0:d}/{1:d}: {2:d} of {3:d} subjects'.format(ishard,nshards,len(assigned),len(zooniverse_ids)))
+
+    completed = []
+    with open(files['csv'],'w') as fc, open(files['json'],'w') as fj, open(files['mongo'],'w') as fm:
+
+        fc.write(csv_header(survey))
+
+        for idx,cons in enumerate(iter_consensus([zid for pos,zid in assigned],do_plot,weights,scheme,kde,workers,ir_count=ir_count)):
+
+            if not idx % 100:
+                print idx, datetime.datetime.now().strftime('%H:%M:%S.%f')
+
+            if cons is not None:
+                completed.append(cons['zid'])
+                fj.write(json.dumps(cons,sort_keys=True)+'\n')
+                for row in csv_rows(cons):
+                    fc.write(row)
+                for new_con in mongo_rows(cons,survey):
+                    fm.write(json.dumps(new_con,sort_keys=True)+'\n')
+
+    # The metadata is written last, so that its presence marks the shard as finished
+    meta = {'survey':survey,
+            'version':version,
+            'shard':ishard,
+            'nshards':nshards,
+            'n_subjects':len(zooniverse_ids),
+            'subjects_md5':hashlib.md5('\n'.join(zooniverse_ids)).hexdigest(),
+            'assigned':assigned,
+            'completed':completed,
+            'created_at':datetime.datetime.now().isoformat()}
+    with open(files['meta']+'.tmp','w') as f:
+        json.dump(meta,f)
+    os.rename(files['meta']+'.tmp',files['meta'])
+
+    print 'Finished shard {0:d}/{1:d} for {2}'.format(ishard,nshards,survey)
+    logging.info('Finished shard {0:d}/{1:d} for {2}'.format(ishard,nshards,survey))
+
+    return None
+
+def merge_shards(survey,nshards,subset=None):
+
+    # Combine the partial outputs of all N shards into the usual CSV and JSON catalogs and the
+    # consensus collection, checking that every subject was processed exactly once.
+
+    filestem = "consensus_rgz_{0}".format(survey)
+    suffix = '' if subset is None else '_{0}'.format(subset)
+
+    position = {}
+    completed = set()
+    metas = []
+    for ishard in range(nshards):
+        files = shard_files(filestem+suffix,ishard,nshards)
+        assert os.path.exists(files['meta']), 'Shard {0:d}/{1:d} for {2} has not finished'.format(ishard,nshards,survey)
+        with open(files['meta'],'r') as f:
+            meta = json.load(f)
+        metas.append(meta)
+
+        assert meta['survey'] == survey and meta['nshards'] == nshards and meta['shard'] == ishard, \
+            'Shard {0} does not belong to this set'.format(files['meta'])
+        assert meta['subjects_md5'] == metas[0]['subjects_md5'], \
+            'Shards {0:d} and 0 were run on different lists of subjects'.format(ishard)
+
+        for pos,zid in meta['assigned']:
+            assert not position.has_key(zid), 'Subject {0} is in more than one shard'.format(zid)
+            position[zid] = pos
+        completed.update(meta['completed'])
+
+    assert len(position) == metas[0]['n_subjects'], \
+        '{0:d} subjects are missing from the shards'.format(metas[0]['n_subjects'] - len(position))
+
+    # Collect the outputs of every shard, keyed by subject
+    jrows,crows,mrows = {},{},{}
+    for ishard in range(nshards):
+        files = shard_files(filestem+suffix,ishard,nshards)
+        with open(files['json'],'r') as f:
+            for line in f:
+                cons = json.loads(line)
+                assert not jrows.has_key(cons['zid']), 'Subject {0} appears more than once'.format(cons['zid'])
+                jrows[cons['zid']] = cons
+        with open(files['csv'],'r') as f:
+            f.readline()
+            for line in f:
+                crows.setdefault(line.split(',')[0],[]).append(line)
+        with open(files['mongo'],'r') as f:
+            for line in f:
+                new_con = json.loads(line)
+                mrows.setdefault(new_con['zooniverse_id'],[]).append(new_con)
+
+    assert set(jrows.keys()) == completed, 'Consensus output of the shards does not match their metadata'
+
+    # The shards were started at different times; the watermarks should all have the earliest, so
+    # that the next incremental run checks for anything classified while any of them were running
+    started = [row['watermark']['run_started'] for row in jrows.itervalues() if row.has_key('watermark')]
+    if len(started) > 0:
+        run_started = min(started,key=parse_watermark)
+        for cons in jrows.itervalues():
+            if cons.has_key('watermark'):
+                cons['watermark']['run_started'] = run_started
+
+    merged = sorted(jrows.keys(),key=lambda zid: position[zid])
+
+    with open('{0}/csv/{1}{2}.csv'.format(rgz_path,filestem,suffix),'w') as fc:
+        fc.write(csv_header(survey))
+        for zid in merged:
+            for row in crows.get(zid,[]):
+                fc.write(row)
+
+    store = open_master(filestem+suffix,update=False)
+    for zid in merged:
+        write_master(store,jrows[zid])
+    close_master(store)
+
+    docs = [doc for z in merged for doc in mrows.get(z,[])]
+    for i in range(0,len(docs),1000):
+        consensus.insert(docs[i:i+1000])
 
     if subset is None:
-        # JSON
-        json75 = filter(lambda a: (a['n_votes']/a['n_total']) >= 0.75, jfinal)
-        with open('{0}/json/{1}_75.json'.format(rgz_path,filestem),'w') as fj:
-            json.dump(json75,fj)
-        # CSV
-        import pandas as pd
-        cmaster = pd.read_csv('{0}/csv/{1}.csv'.format(rgz_path,filestem))
-        cmaster75 = cmaster[cmaster['consensus_level'] >= 0.75]
-        cmaster75.to_csv('{0}/csv/{1}_75.csv'.format(rgz_path,filestem),index=False)
-        
-    print '\nCompleted consensus for {0}.'.format(survey)
-    logging.info('\nCompleted consensus for {0}.'.format(survey))
+        write_consensus_75(filestem)
+
+    print 'Merged {0:d} shards: {1:d} subjects with consensus for {2}'.format(nshards,len(merged),survey)
+    logging.info('Merged {0:d} shards: {1:d} subjects with consensus for {2}'.format(nshards,len(merged),survey))
+
+    return None
+
+def retirement_limit(sub):
+
+    # Number of classifications after which a subject is retired (see enddate.how_many_left)
+
+    return 5 if sub['metadata'].get('contour_count') == 1 else 20
+
+def replay_consensus(survey,cutoffs,weights=0,scheme='scaling',kde='grid',ir_count=False,retired_only=True):
+
+    # Catalogs of the consensus as it would have been at each of a list of past dates (cutoffs),
+    # without restoring old database dumps. The classifications are read once, in the order
+    # they were last updated, and kept for each subject as they arrive. At each cutoff, the
+    # consensus is only found again for the subjects with new classifications since the
+    # previous one; the rest are carried over. IR peaks are also reused for any source whose
+    # clicks haven't changed. With retired_only=True, a catalog only has the subjects with
+    # enough classifications by then to have been retired.
+    #
+    # Each catalog is written as CSV and JSON, labelled with the date of its cutoff.
+
+    check_indices(('updated_at',))
+
+    cutoffs = sorted(cutoffs)
+    datestems = ['consensus_rgz_{0}{1}_{2}'.format(survey,variant_suffix(scheme,weights),cutoff.strftime('%Y%m%d')) for cutoff in cutoffs]
+    assert len(set(datestems)) == len(datestems), 'Cutoffs for a replay must be on different days'
+
+    subs = {}
+    for sub in subjects.find({'metadata.survey':survey}):
+        subs[sub['_id']] = sub
+
+    records = {}
+    touched = set()
+    latest = {}
+    ir_caches = {}
+
+    def snapshot(cutoff,filestem):
+
+        # Update the consensus of every subject with new classifications, and write the catalog
+
+        for imgid in touched:
+            sub = subs[imgid]
+            tally = vote_tally(sub,sorted(records[imgid],key=lambda c: c._id),weights,scheme)
+            latest[imgid] = consensus_from_tally(tally,include_peak_data=False,kde=kde,ir_cache=ir_caches.setdefault(imgid,{}),ir_count=ir_count)
+        n_updated = len(touched)
+        touched.clear()
+
+        fc = open('{0}/csv/{1}.csv'.format(rgz_path,filestem),'w')
+        fc.write(csv_header(survey))
+        store = open_master(filestem,update=False)
+        sink = OutputSink(survey,fc=fc,store=store)
+
+        n_written = 0
+        for imgid,cons in latest.iteritems():
+            if cons is None:
+                continue
+            if retired_only and len(records[imgid]) < retirement_limit(subs[imgid]):
+                continue
+            cons['consensus_level'] = cons['n_votes']/cons['n_total']
+            sink.put(cons)
+            n_written += 1
+
+        sink.close()
+        close_master(store)
+        fc.close()
+
+        print 'Consensus for {0} as of {1}: {2:d} subjects ({3:d} updated)'.format(survey,cutoff,n_written,n_updated)
+        logging.info('Consensus for {0} as of {1}: {2:d} subjects ({3:d} updated)'.format(survey,cutoff,n_written,n_updated))
+
+    icut = 0
+    class_params = {"updated_at": {"$gt": main_release_date, "$lte": cutoffs[-1]}}
+    for c in classifications.find(class_params,classification_fields,**no_timeout).sort([("updated_at", ASCENDING)]):
+
+        while c['updated_at'] > cutoffs[icut]:
+            snapshot(cutoffs[icut],datestems[icut])
+            icut += 1
+
+        imgids = [imgid for imgid in c.get('subject_ids',[]) if subs.has_key(imgid)]
+        if len(imgids) == 0:
+            continue
+
+        c = Classification(c)
+        for imgid in imgids:
+            records.setdefault(imgid,[]).append(c)
+            touched.add(imgid)
+
+    for cutoff,filestem in zip(cutoffs[icut:],datestems[icut:]):
+        snapshot(cutoff,filestem)
+
+    return None
+
+def parse_stream_record(line):
+
+    # A classification from one line of a JSON feed, in the same form as a document from the
+    # classifications collection. Mongo extended JSON ({"$oid": ...}, {"$date": ...}) is
+    # understood; subject IDs and dates can also be given as plain strings.
+
+    c = json.loads(line,object_hook=json_util.object_hook)
+
+    c['subject_ids'] = [ObjectId(s) if isinstance(s,basestring) and ObjectId.is_valid(s) else s for s in c.get('subject_ids',[])]
+
+    # Dates in the database are naive UTC
+    for field in ('created_at','updated_at'):
+        value = c.get(field)
+        if isinstance(value,basestring):
+            c[field] = datetime.datetime.strptime(value[:19],'%Y-%m-%dT%H:%M:%S')
+        elif isinstance(value,datetime.datetime) and value.tzinfo is not None:
+            c[field] = value.replace(tzinfo=None) - value.utcoffset()
+
+    return c
+
+def follow_lines(f,poll=1.):
+
+    # Lines of a file as they're written to it, like tail -f. Partial lines are held back until
+    # they're finished. Never stops by itself.
+
+    partial = ''
+    while True:
+        line = f.readline()
+        if line == '':
+            time.sleep(poll)
+            continue
+        partial += line
+        if partial.endswith('\n'):
+            yield partial
+            partial = ''
+
+def stream_update(state,weights=0,scheme='scaling',kde='grid',ir_count=False,precision=3):
+
+    # Count the votes again for a subject in a stream after a new classification, and return its
+    # updated consensus if the winning combination, the consensus level (to the given precision)
+    # or whether it's stable have changed; otherwise None. The answer is 'stable' once the
+    # runner-up can't catch up in the votes left before the subject retires. At retirement the
+    # consensus is found with checksum_from_records, as in a batch run, and marked 'final'.
+
+    sub = state['sub']
+    records = state['records']
+
+    tally = vote_tally(sub,records,weights,scheme)
+    maxval,mc_checksum = tally_winner(tally)
+    if maxval == 0:
+        return None
+
+    n_total = len(tally['clist']) + sum(tally['extra'])
+    level = round(maxval/n_total,precision)
+
+    limit = retirement_limit(sub)
+    final = len(records) >= limit
+
+    ranked = ranked_tallies(tally,2)
+    runner_up = tally_winner(ranked[1])[0] if len(ranked) > 1 else 0
+    stable = final or maxval - runner_up > (limit - len(records)) * (1 + weights)
+
+    key = (mc_checksum,level,stable)
+    if key == state['last'] and not final:
+        return None
+    state['last'] = key
+
+    if final:
+        cons = checksum_from_records(sub,records,False,weights,scheme,kde,ir_count=ir_count)
+    else:
+        cons = consensus_from_tally(tally,include_peak_data=False,kde=kde,ir_cache=state['ir_cache'],ir_count=ir_count)
+    if cons is None:
+        return None
+
+    cons['consensus_level'] = cons['n_votes']/cons['n_total']
+    cons['n_classifications'] = len(records)
+    cons['stable'] = stable
+    cons['final'] = final
+
+    return cons
+
+def stream_consensus(lines,out,weights=0,scheme='scaling',kde='grid',ir_count=False,max_subjects=100000,precision=3):
+
+    # Online consensus for a live feed of classifications, given as lines of JSON (see
+    # parse_stream_record), eg. from sys.stdin or follow_lines. The votes for each subject are
+    # kept in memory and counted again as each classification arrives, and the consensus is
+    # written to out as a line of JSON whenever it changes (see stream_update). IR peaks are
+    # only found again when the clicks for a source have changed.
+    #
+    # State is only kept for subjects that haven't retired, and for at most max_subjects of
+    # those; the least recently classified are dropped beyond that. The subjects that have been
+    # finalised are remembered, up to the same number, so that late classifications of them can
+    # be ignored. A subject that isn't in either starts again from its earlier votes in the
+    # classifications collection (they're only there if the feed is also being written to the
+    # database); this covers subjects dropped from the state, classifications made before the
+    # stream started, and subjects finalised too long ago to be remembered, which are ignored
+    # once they're found to have retired.
+
+    active = OrderedDict()
+    finished = OrderedDict()
+    n_read,n_written,n_finished,n_dropped,n_restarted = 0,0,0,0,0
+
+    for line in lines:
+
+        if line.strip() == '':
+            continue
+        c = parse_stream_record(line)
+        n_read += 1
+
+        if c.get('updated_at') is not None and c['updated_at'] <= main_release_date:
+            continue
+
+        record = None
+        for imgid in c['subject_ids']:
+
+            if finished.has_key(imgid):
+                logging.info('Classification of finished subject {0} ignored'.format(imgid))
+                continue
+
+            state = active.pop(imgid,None)
+            if state is None:
+                sub = subjects.find_one({'_id':imgid})
+                if sub is None:
+                    logging.warning('Subject {0} not found'.format(imgid))
+                    continue
+                state = {'sub':sub,'records':[],'last':None,'ir_cache':{}}
+                class_params = {'subject_ids':imgid,'updated_at':{'$gt':main_release_date}}
+                if c.get('created_at') is not None:
+                    class_params['created_at'] = {'$lt':c['created_at']}
+                state['records'] = [r for r in find_classifications(class_params) if str(r._id) != str(c.get('_id'))]
+                state['records'].sort(key=lambda r: r.created_at)
+                if len(state['records']) >= retirement_limit(sub):
+                    logging.info('Classification of finished subject {0} ignored'.format(sub['zooniverse_id']))
+                    finished[imgid] = True
+                    continue
+                if len(state['records']) > 0:
+                    n_restarted += 1
+                    logging.info('{0} restarted from {1:d} classifications in the database'.format(sub['zooniverse_id'],len(state['records'])))
+            active[imgid] = state
+
+            if record is None:
+                record = Classification(c)
+            state['records'].append(record)
+
+            cons = stream_update(state,weights,scheme,kde,ir_count,precision)
+            if cons is not None:
+                out.write(json.dumps(cons,sort_keys=True)+'\n')
+                n_written += 1
+            if len(state['records']) >= retirement_limit(state['sub']):
+                del active[imgid]
+                finished[imgid] = True
+                n_finished += 1
+
+        while len(active) > max_subjects:
+            imgid,state = active.popitem(last=False)
+            n_dropped += 1
+            logging.warning('Stream state full; dropped {0} after {1:d} classifications'.format(state['sub']['zooniverse_id'],len(state['records'])))
+        while len(finished) > max_subjects:
+            finished.popitem(last=False)
+
+        out.flush()
+
+    logging.info('Stream finished: {0:d} classifications read, {1:d} updates written, {2:d} subjects finalised, {3:d} dropped, {4:d} restarted'.format(
+        n_read,n_written,n_finished,n_dropped,n_restarted))
 
     return None
 
+def csv_header(survey):
+
+    # Column names of the consensus CSV file
+
+    return 'zooniverse_id,{0}_id,n_votes,n_total,consensus_level,n_radio,label,bbox,ir_peak,ir_level,ir_flag,n_ir\n'.format(survey)
+
 def force_csv_update(survey='first',suffix=''):
 
     # Force an update of the CSV file from the JSON, in case of errors.
 
     filestem = 'consensus_rgz_{0}'.format(survey)
 
-    master_json = '{0}/json/{1}.json'.format(rgz_path,filestem)
-    
-    with open(master_json,'r') as fm:
-        jmaster = json.load(fm)
-    
     fc = open('{0}/csv/{1}{2}.csv'.format(rgz_path,filestem,suffix),'w')
-    fc.write('zooniverse_id,{0}_id,n_votes,n_total,consensus_level,n_radio,label,bbox,ir_peak,ir_level,ir_flag,n_ir\n'.format(survey))
+    fc.write(csv_header(survey))
 
-    for gal in jmaster:
-        for ans in gal['answer'].itervalues():
-            try:
-                ir_peak = ans['ir_peak']
-            except KeyError:
-                ir_peak = ans['ir'] if ans.has_key('ir') else (-99,-99)
-
-    
-            fc.write('{0},{1},{2:4d},{3:4d},{4:.3f},{5:2d},{6},"{7}","{8}"\n'.format(
-                    gal['zid'],
-                    gal['source'],
-                    gal['n_votes'],
-                    gal['n_total'],
-                    gal['n_votes'] * 1./gal['n_total'],
-                    len(ans['xmax']),
-                    alphabet(ans['ind']),
-                    bbox_unravel(ans['bbox']),
-                    ir_peak,
-                    ans['ir_level'],
-                    ans['ir_flag'],
-                    ans['n_ir']
-                    )
-                )
+    sink = OutputSink(survey,fc=fc)
+    for gal in iter_master(filestem+suffix):
+        gal.setdefault('consensus_level',gal['n_votes'] * 1./gal['n_total'])
+        sink.put(gal)
+    sink.close()
 
     fc.close()
 
@@ -1212,14 +3591,10 @@ def get_unique_users():
     
     check_indices(('user_name',))
 
-    print "Finding non-anonymous classifications"
-    logging.info("Finding non-anonymous classifications")
-    non_anonymous = classifications.find({"user_name":{"$exists":True}})
-
     print "Finding user list"
     logging.info("Finding user list")
-    users = [n['user_name'] for n in non_anonymous]
-    unique_users = set(users)
+    # Let the server work out the distinct names from the index, rather than pulling back every classification
+    unique_users = set([u for u in classifications.distinct('user_name') if u is not None])
 
     return unique_users
 
@@ -1251,52 +3626,73 @@ def weight_users(unique_users, scheme, min_gs=5, min_agree=0.5, scaling=5):
     if ex_count < 1:
         update_experts()
     
-    # Find the science team answers:
+    # Get all of the classifications of the gold standard subjects in a single query
     
-    gs_zids = [s['zooniverse_id'] for s in subjects.find({"goldstandard":True})]
-    science_answers = {}
+    gs_subjects = list(subjects.find({"goldstandard":True}))
+    gs_index = dict([(s['_id'],ix) for ix,s in enumerate(gs_subjects)])
     
-    for zid in gs_zids:
-        s = checksum(zid,experts_only=True)
-        science_answers[zid] = s['answer'].keys()
+    gs_records = [[] for s in gs_subjects]
+    for doc in classifications.find({'subject_ids':{'$in':gs_index.keys()}},classification_fields).sort([("subject_ids", ASCENDING)]):
+        rec = Classification(doc)
+        gs_records[gs_index[rec.subject_ids[0]]].append(rec)
     
-    gs_ids = [s['_id'] for s in subjects.find({"goldstandard":True})]
-    count = 0
-
-    # For each user, find the gold standard subjects they saw and whether it agreed with the experts
-    for u in list(unique_users):
-        count += 1
-        print count, u
-        logging.info((count, u))
-        
-        agreed = 0
-        u_str = u.encode('utf8')
-        zid_seen = set()
-        
-        # For each match, see if they agreed with the science team. If this happened more than once, only keep first classification.
-        for g in classifications.find({'user_name':u, 'subject_ids':{'$in':gs_ids}}):
-            zid = g['subjects'][0]['zooniverse_id']
-            if zid not in zid_seen:
-                zid_seen = zid_seen.union([zid])
-                their_answer = one_answer(zid,u)
-                their_checksums = their_answer['answer'].keys()
-                science_checksums = science_answers[zid]
-                if set(their_checksums) == set(science_checksums):
-                    agreed += 1
+    # Build a sparse (user x subject) matrix of whether each user agreed with the science team on
+    # the gold standard subjects they saw. If a user classified a subject more than once, their answer
+    # is the most common one (as in one_answer).
+    
+    users = sorted(unique_users)
+    user_index = dict([(u,ix) for ix,u in enumerate(users)])
+    rows,cols,agree = [],[],[]
+    
+    for ix,(sub,records) in enumerate(zip(gs_subjects,gs_records)):
         
-        gs_count = len(zid_seen)
+        current = [c for c in records if c.updated_at > main_release_date]
         
-        # Save output Mongo
+        # Find the science team answer
+        cons = consensus_from_tally(vote_tally(sub,[c for c in current if c.expert]),include_ir=False)
+        science_checksums = set(cons['answer'].keys()) if cons is not None else set()
         
-        if scheme == 'threshold' and gs_count > min_gs and (1.*agreed/gs_count) > min_agree:
-            weight = 1
-        elif scheme == 'scaling' and gs_count > min_gs:
-            weight = int(round(1.*scaling*agreed/gs_count))
-        else:
-            weight = 0
+        by_user = {}
+        for c in records:
+            if user_index.has_key(c.user_name):
+                by_user.setdefault(c.user_name,[])
+                if c.updated_at > main_release_date:
+                    by_user[c.user_name].append(c)
         
-        user_weights.update({'user_name':u_str}, {'$set':{'agreed':agreed, 'gs_seen':gs_count, 'weight':weight}}, upsert=True)
+        for u,user_records in by_user.iteritems():
+            their_checksums = set(one_answer_from_records(sub,user_records)['answer'].keys())
+            rows.append(user_index[u])
+            cols.append(ix)
+            agree.append(their_checksums == science_checksums)
+    
+    shape = (len(users),len(gs_subjects))
+    seen_matrix = coo_matrix((np.ones(len(rows),dtype=int),(rows,cols)),shape=shape).tocsr()
+    agree_matrix = coo_matrix((np.array(agree,dtype=int),(rows,cols)),shape=shape).tocsr()
+    
+    gs_seen = np.asarray(seen_matrix.sum(axis=1)).ravel()
+    agreed = np.asarray(agree_matrix.sum(axis=1)).ravel()
+    
+    # Set the weights for all users at once
+    
+    weight = scheme_weights(agreed,gs_seen,scheme,scaling,min_gs,min_agree)
+    
+    # Save output Mongo, with a single bulk upsert
     
+    print 'Saving weights for {} users'.format(len(users))
+    logging.info('Saving weights for {} users'.format(len(users)))
+    
+    if len(users) > 0:
+        bulk = user_weights.initialize_unordered_bulk_op()
+        for u,a,g,w in zip(users,agreed,gs_seen,weight):
+            bulk.find({'user_name':u.encode('utf8')}).upsert().update({'$set':{'agreed':int(a), 'gs_seen':int(g), 'weight':int(w)}})
+        bulk.execute()
+
+    # Record the thresholds, so that other weighting schemes (see variant_weights) use the same ones
+    weight_params.update({'_id':'parameters'},{'$set':{'scheme':scheme,'min_gs':min_gs,'min_agree':min_agree,'scaling':scaling}},upsert=True)
+    
+    # Make sure the consensus picks up the new weights
+    get_user_weights(reload=True)
+
     return None
 
 def print_user_weights(weight=0):
@@ -1311,7 +3707,51 @@ def print_user_weights(weight=0):
 
 if __name__ == "__main__":
 
-    # Run the consensus pipeline from the command line
+    # Run the consensus pipeline from the command line. To spread a full run over several machines:
+    #
+    #   python consensus.py --shard i/N     (for each i = 0 ... N-1)
+    #   python consensus.py merge --nshards N
+    #
+    # A run that was stopped part way through can be carried on from its last checkpoint with
+    #
+    #   python consensus.py --resume
+    #
+    # The bootstrap uncertainty and convergence of the consensus levels (see run_uncertainty) with
+    #
+    #   python consensus.py uncertainty
+    #
+    # and the catalogs as they would have been on some past dates (see replay_consensus) with
+    #
+    #   python consensus.py replay --dates 2014-06-01 2015-01-01
+    #
+    # The consensus can also be kept up to date from a live feed of classifications, one JSON
+    # document per line (see stream_consensus), read from stdin or by following a file:
+    #
+    #   python consensus.py stream --input feed.jsonl --follow
+
+    parser = argparse.ArgumentParser(description='Consensus for Radio Galaxy Zoo classifications')
+    parser.add_argument('command',nargs='?',default='run',choices=('run','merge','uncertainty','replay','stream'),
+                        help="'run' the consensus (default), 'merge' the outputs of a sharded run, find the 'uncertainty' of the consensus levels, 'replay' the catalogs of past dates, or 'stream' a live feed of classifications")
+    parser.add_argument('--shard',default=None,help='only process shard i of N, given as i/N')
+    parser.add_argument('--nshards',type=int,default=None,help='number of shards to merge')
+    parser.add_argument('--resume',action='store_true',help='carry on from the last checkpoint of an unfinished run')
+    parser.add_argument('--dates',nargs='+',default=[],help='cutoff dates (YYYY-MM-DD) of the catalogs to replay')
+    parser.add_argument('--input',default='-',help="file of classifications to stream, or '-' for stdin (default)")
+    parser.add_argument('--follow',action='store_true',help='keep reading the streamed file as it grows')
+    parser.add_argument('--output',default=None,help="file for the streamed consensus, or '-' for stdout")
+    args = parser.parse_args()
+
+    shard = None
+    if args.shard is not None:
+        shard = tuple([int(x) for x in args.shard.split('/')])
+        assert len(shard) == 2 and 0 <= shard[0] < shard[1], 'Shard must be given as i/N, with 0 <= i < N'
+    if args.command == 'merge':
+        assert args.nshards > 0, 'Number of shards to merge must be given with --nshards'
+    if args.command == 'replay':
+        assert len(args.dates) > 0, 'Cutoff dates to replay must be given with --dates'
+        cutoffs = [datetime.datetime.strptime(d,'%Y-%m-%d') for d in args.dates]
+    if args.command == 'stream':
+        assert not (args.follow and args.input == '-'), 'Only a file can be followed, not stdin'
 
     logging.basicConfig(filename='{}/{}'.format(rgz_path,logfile), level=logging.DEBUG, format='%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     logging.captureWarnings(True)
@@ -1357,15 +3797,70 @@ if __name__ == "__main__":
             assert (type(weights) == int) and weights >= 0, 'Weight must be a nonnegative integer'
             scheme = 'scaling'
             assert scheme in ['threshold', 'scaling'], 'Weighting scheme must be threshold or sliding, not {}'.format(scheme)
+
+            # kde: default = 'grid'
+            #
+            #   Method used for the kernel density estimate of the IR host position. 'grid' evaluates
+            #   the KDE at every pixel of the image; 'fft' bins the clicks and convolves them with the
+            #   same kernel, which is much faster and finds the same peaks to within a pixel. 'meanshift'
+            #   finds the modes of the KDE directly from the clicks without using a grid at all.
+            kde = 'grid'
+            assert kde in kde_engines, 'KDE engine must be one of {0}, not {1}'.format(kde_engines,kde)
+
+            # workers: default = 1
+            #
+            #   Number of processes to run the consensus in parallel. The output is written
+            #   in the same order (and is identical to) a run with a single process.
+            workers = 1
+            assert (type(workers) == int) and workers >= 1, 'Number of workers must be a positive integer'
+
+            # schemes: default = None
+            #
+            #   Make catalogs for several weighting schemes in a single run, given as a list of
+            #   (scheme, weights), eg. [('scaling',0),('scaling',5),('threshold',2)]. The classifications
+            #   are only read and counted once for all of them. If set, this replaces weights and scheme.
+            schemes = None
+            if schemes is not None:
+                for sch,w in schemes:
+                    assert sch in ['threshold', 'scaling'] and (type(w) == int) and w >= 0, 'Bad weighting scheme: {}'.format((sch,w))
+                sweep_weights = max([w for sch,w in schemes])
+            else:
+                sweep_weights = weights
+
+            # ir_count: default = False
+            #
+            #   Also save the number of IR sources marked in each classification of every answer
+            #   ('ir_count' in the JSON catalog and the consensus collection). This replaces the
+            #   separate pass of consensus_multi_ir.py, and is needed by multi_ir.py.
+            ir_count = False
             
-            # If you're using weights, make sure they're up to date
-            if weights > 1:
+            # If you're using weights, make sure they're up to date. Shards share the same weights,
+            # so these need to be calculated once before starting them. A resumed run carries on
+            # with the weights it started with.
+            if sweep_weights > 1 and shard is None and args.command == 'run' and not args.resume:
                 unique_users = get_unique_users()
                 weight_users(unique_users, scheme, min_gs=5, min_agree=0.5, scaling=weights)
 
-            # Run the consensus separately for different surveys, since the image parameters are different
-            for survey in ('atlas','first'):
-                run_sample(survey,update,subset,do_plot,weights,scheme)
+            # A stream has subjects from both surveys, in the order they're classified
+            if args.command == 'stream':
+                fin = sys.stdin if args.input == '-' else open(args.input,'r')
+                lines = follow_lines(fin) if args.follow else fin
+                if args.output == '-':
+                    fout = sys.stdout
+                else:
+                    fout = open(args.output if args.output is not None else '{0}/json/consensus_rgz_stream{1}.jsonl'.format(rgz_path,variant_suffix(scheme,weights)),'a')
+                stream_consensus(lines,fout,weights,scheme,kde,ir_count)
+            else:
+                # Run the consensus separately for different surveys, since the image parameters are different
+                for survey in ('atlas','first'):
+                    if args.command == 'merge':
+                        merge_shards(survey,args.nshards,subset)
+                    elif args.command == 'uncertainty':
+                        run_uncertainty(survey,weights=weights,scheme=scheme)
+                    elif args.command == 'replay':
+                        replay_consensus(survey,cutoffs,weights,scheme,kde,ir_count)
+                    else:
+                        run_sample(survey,update and shard is None and schemes is None,subset,do_plot,weights,scheme,kde,workers,shard,schemes,args.resume,ir_count=ir_count)
 
             output = 'Finished at',datetime.datetime.now().strftime('%H:%M:%S.%f')
             logging.info(output)
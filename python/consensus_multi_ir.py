@@ -12,6 +12,9 @@ set of static CSV output files.
 
 Originally developed by Kyle Willett (University of Minnesota), 2014-2016. 
 
+Superseded: the IR click counts ('ir_count') made by this copy of the pipeline are now saved by
+consensus.py itself when it's run with ir_count = True.
+
 '''
 
 # Local RGZ modules
@@ -123,10 +123,16 @@ def ac_data():
     gs = get_galaxies()
     ud = top_volunteers(gs)
 
+    # Compare each volunteer with the consensus of all classifiers (including themselves, as
+    # before), counting the votes for each galaxy only once. An answer now has to have the same
+    # combinations of components as the consensus, where compare only checked that the two
+    # results had the same number of fields, so the ratios aren't the same as in older versions of gs_compare.pkl.
+    agreement = consensus.leave_one_out_agreement(gs,exclude_user=False)
+
     match_ratio = []
     for user_name in ud:
-        matches = all_compare(gs,user_name)
-        match_ratio.append(np.sum(matches,dtype=float)/len(matches))
+        a = agreement.get(user_name,{'gs_seen':0,'agreed':0})
+        match_ratio.append(np.divide(a['agreed'],a['gs_seen'],dtype=float))
 
     # List of the ratio matches for a single user and the RGZ science team
     with open('%s/goldstandard/gs_compare.pkl' % rgz_dir, 'wb') as output:
@@ -202,10 +208,11 @@ def plot_gs_volunteers():
     # Plot the results of the gold standard classifications by the users, removing the expert classifications
 
     gs_gals = get_galaxies()
+    conslist = []
     for gal in gs_gals:
         print gal
-        c0 = consensus.checksum(gal,experts_only=False,excluded=experts)
-        consensus.plot_consensus(c0,savefig = True)
+        conslist.append(consensus.checksum(gal,experts_only=False,excluded=experts))
+    consensus.plot_consensus_batch(conslist)
 
     return None
 
@@ -39,7 +39,7 @@ def get_top_volunteers(gs):
     for g in gs:
     
         s = subjects.find_one({'zooniverse_id':g})
-        c = classifications.find({'subject_ids.0':s['_id']})
+        c = classifications.find({'subject_ids.0':s['_id']},{'user_name':1})
         
         ulist = []
         for cc in c:
@@ -136,6 +136,14 @@ def all_compare(gals,user_name):
 
     return matches
 
+def match_ratio(agreement,user_name):
+
+    # Fraction of the galaxies seen by a user where they agreed with the experts
+
+    a = agreement.get(user_name,{'gs_seen':0,'agreed':0})
+
+    return np.divide(a['agreed'],a['gs_seen'],dtype=float)
+
 def ac_data():
 
     # Compute and save the levels of agreement for volunteers and experts for all overlapping galaxies
@@ -146,10 +154,16 @@ def ac_data():
 
     udx = get_experts(gals)
 
-    # Run comparison for all matching galaxies and sum answers together to get total success ratio
+    # Compare everyone with the consensus of the whole science team in a single pass over the
+    # galaxies. As in all_compare, the experts aren't left out of the consensus they're compared to.
+    # An answer has to have all of the same combinations of components as the consensus, where
+    # compare only checked the number of sources and the last of them, so the ratios aren't the
+    # same as in older versions of the results files.
+    agreement = consensus.leave_one_out_agreement(gals,experts_only=True,exclude_user=False)
+
+    # Sum answers together to get total success ratio
     for user_name in udx:
-        matches = all_compare(gals,user_name)
-        udx[user_name]['match_ratio'] = np.sum(matches,dtype=float)/len(matches)
+        udx[user_name]['match_ratio'] = match_ratio(agreement,user_name)
 
     # Write dict to file.
     with open('%s/goldstandard/%s.pkl' % (rgz_dir,'gs_expert_results'), 'wb') as output:
@@ -160,8 +174,7 @@ def ac_data():
     udv = get_top_volunteers(gals)
 
     for user_name in udv:
-        matches = all_compare(gals,user_name)
-        udv[user_name]['match_ratio'] = np.sum(matches,dtype=float)/len(matches)
+        udv[user_name]['match_ratio'] = match_ratio(agreement,user_name)
 
     with open('%s/goldstandard/%s.pkl' % (rgz_dir,'gs_topvol_results'), 'wb') as output:
         pickle.dump(udv, output)
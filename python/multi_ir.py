@@ -1,12 +1,17 @@
-from consensus import db
+from consensus import db, version
 
-consensus = db['consensus_multi_ir']
+# IR click counts are saved in the consensus collection by a run of consensus.py with ir_count = True
+consensus = db['consensus{}'.format(version)]
 catalog = db['catalog_dr1']
 
+query = {'first_id':{'$exists':True}, 'ir_count':{'$exists':True}}
+assert consensus.find_one(query) is not None, \
+    'No IR click counts in {0}; run consensus.py with ir_count = True first'.format(consensus.name)
+
 count = 0
 with open('ir_clicks.csv', 'w') as f:
     print >> f, 'catalog_id,zooniverse_id,ir_ra,ir_dec,ir_level,radio_level,n_total,n_radio,n_ir,clicks'
-    for con in consensus.find({'first_id':{'$exists':True}}):
+    for con in consensus.find(query):
         count += 1
         if not count%1000:
             print count
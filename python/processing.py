@@ -10,6 +10,7 @@ import itertools
 #custom modules for the RGZ catalog
 import catalog_functions as fn #contains miscellaneous helper functions
 import contour_node as c #contains Node class
+from consensus import component_index, find_component #identifies radio components by their bbox
 
 def getWISE(entry):
 	'''
@@ -222,12 +223,13 @@ def getRadio(data, fits_loc, source):
 	'''
 	
 	#create list of trees, each containing a contour and its contents
+	#components are looked up by their bbox in the index of the contour file, allowing for rounding
+	index = component_index(data)
+	matched = sorted(set([find_component(index, bbox) for bbox in source['bbox']]) - set([None]))
 	contourTrees = []
-	for contour, bbox in itertools.product(data['contours'], source['bbox']):
-		if fn.approx(contour[0]['bbox'][0], bbox[0]) and fn.approx(contour[0]['bbox'][1], bbox[1]) and \
-		   fn.approx(contour[0]['bbox'][2], bbox[2]) and fn.approx(contour[0]['bbox'][3], bbox[3]):
-			tree = c.Node(contour=contour, fits_loc=fits_loc)
-			contourTrees.append(tree)
+	for i in matched:
+		tree = c.Node(contour=data['contours'][i], fits_loc=fits_loc)
+		contourTrees.append(tree)
 	
 	#get component fluxes and sizes
 	components = []
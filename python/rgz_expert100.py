@@ -2,8 +2,6 @@
 import numpy as np
 import datetime
 import os,sys
-import urllib
-import cStringIO
 import json
 
 from scipy.ndimage.filters import maximum_filter
@@ -14,7 +12,7 @@ from matplotlib import cm
 from collections import Counter
 from pymongo import MongoClient
 from scipy import stats
-from PIL import Image
+from consensus import grab_image
 from collections import OrderedDict
 
 #------------------------------------------------------------------------------------------------------------
@@ -193,13 +191,11 @@ def plot_image(x,y,npeaks,sub,all_radio,radio_unique,no_radio=False):
 
     # Display IR and radio images
 
-    url_standard = sub['location']['standard']
-    im_standard = Image.open(cStringIO.StringIO(urllib.urlopen(url_standard).read()))
+    im_standard = grab_image(sub,imgtype='standard')
     ax2 = fig.add_subplot(131)
     ax2.imshow(im_standard,origin='upper')
 
-    url_radio = sub['location']['radio']
-    im_radio = Image.open(cStringIO.StringIO(urllib.urlopen(url_radio).read()))
+    im_radio = grab_image(sub,imgtype='radio')
     ax3 = fig.add_subplot(132)
     ax3.imshow(im_radio,origin='upper')
 
@@ -0,0 +1,138 @@
+'''
+
+test_images.py
+
+Checks the image store behind grab_image against a local HTTP server standing in for the RGZ image
+host (consensus.image_url_base): images are only downloaded once, prefetch_images doesn't ask for
+the same image twice, and the in-memory cache of decoded images stays within image_lru_size.
+
+Run with: python -m unittest test_images
+
+'''
+
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import consensus
+
+class ImageServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+
+    # Serves the files under root, keeping a list of the paths it was asked for
+
+    daemon_threads = True
+
+    def __init__(self,root):
+        self.root = root
+        self.requests = []
+        self.lock = threading.Lock()
+        BaseHTTPServer.HTTPServer.__init__(self,('127.0.0.1',0),ImageHandler)
+
+class ImageHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def translate_path(self,path):
+        with self.server.lock:
+            self.server.requests.append(path)
+        return os.path.join(self.server.root,path.lstrip('/'))
+
+    def log_message(self,*args):
+        pass
+
+def make_subject(root,i):
+
+    # A subject whose images (a different solid colour for each) are on the test server
+
+    location = {}
+    for imgtype in ('standard','radio'):
+        name = 'ARG{0:07d}.png'.format(i)
+        d = os.path.join(root,'subjects',imgtype)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        Image.fromarray(np.full((8,8,3),(10*i,50 if imgtype == 'radio' else 0,0),dtype=np.uint8)).save(os.path.join(d,name))
+        location[imgtype] = 'http://radio.galaxyzoo.org/subjects/{0}/{1}'.format(imgtype,name)
+
+    return {'zooniverse_id':'ARG{0:07d}'.format(i),'location':location}
+
+class ImageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp,'www')
+        self.subs = [make_subject(self.root,i) for i in range(4)]
+
+        self.server = ImageServer(self.root)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.saved = (consensus.image_url_base,consensus.image_store_path,consensus.image_lru_size,consensus.data_path)
+        consensus.image_url_base = 'http://127.0.0.1:{0:d}'.format(self.server.server_address[1])
+        consensus.image_store_path = os.path.join(self.tmp,'store')
+        consensus.data_path = os.path.join(self.tmp,'data')
+        consensus._image_lru.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        consensus.image_url_base,consensus.image_store_path,consensus.image_lru_size,consensus.data_path = self.saved
+        consensus._image_lru.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_cache_hits(self):
+
+        im = consensus.grab_image(self.subs[0],'radio')
+        self.assertEqual(self.server.requests,['/subjects/radio/ARG0000000.png'])
+        self.assertEqual(im.getpixel((0,0)),(0,50,0))
+
+        # Decoded image in memory, then the copy in the image store: neither goes to the server
+        self.assertTrue(consensus.grab_image(self.subs[0],'radio') is im)
+        consensus._image_lru.clear()
+        self.assertEqual(consensus.grab_image(self.subs[0],'radio').getpixel((0,0)),(0,50,0))
+        self.assertEqual(len(self.server.requests),1)
+
+    def test_prefetch_dedup(self):
+
+        subs = self.subs[:2] + self.subs[:2] + [self.subs[0]]
+        consensus.prefetch_images(subs).get(30)
+        self.assertEqual(sorted(self.server.requests),sorted(['/subjects/{0}/ARG{1:07d}.png'.format(imgtype,i)
+                                                              for i in range(2) for imgtype in ('standard','radio')]))
+
+        # Already in the store
+        consensus.prefetch_images(subs).get(30)
+        for sub in subs:
+            consensus.grab_image(sub,'standard')
+        self.assertEqual(len(self.server.requests),4)
+
+    def test_lru_evicts(self):
+
+        consensus.image_lru_size = 2
+        urls = [consensus.image_url(sub,'standard') for sub in self.subs[:3]]
+        for sub in self.subs[:3]:
+            consensus.grab_image(sub,'standard')
+        self.assertEqual(consensus._image_lru.keys(),urls[1:])
+
+        # Using an image makes it the most recent, so the other one goes next
+        consensus.grab_image(self.subs[1],'standard')
+        consensus.grab_image(self.subs[3],'standard')
+        self.assertEqual(consensus._image_lru.keys(),[urls[1],consensus.image_url(self.subs[3],'standard')])
+
+        # An evicted image comes back from the store rather than the server
+        self.assertEqual(consensus.grab_image(self.subs[0],'standard').getpixel((0,0)),(0,0,0))
+        self.assertEqual(len(self.server.requests),4)
+
+    def test_missing_image(self):
+
+        sub = {'zooniverse_id':'ARG9999999','location':{'standard':'http://radio.galaxyzoo.org/subjects/standard/ARG9999999.png'}}
+        self.assertRaises(IOError,consensus.fetch_image,consensus.image_url(sub))
+        self.assertFalse(os.path.exists(consensus.image_store_files(consensus.image_url(sub))[0]))
+
+if __name__ == '__main__':
+    unittest.main()
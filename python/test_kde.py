@@ -0,0 +1,152 @@
+from __future__ import division
+
+'''
+
+test_kde.py
+
+Checks that the FFT kernel-density engine and the mean-shift mode finder find the same IR
+counterparts as evaluating the KDE at every pixel of the survey grid (consensus.ir_consensus with
+kde='fft', 'meanshift' and 'grid'), and that the peak data kept for plotting can be expanded back
+to the whole grid.
+
+Run with: python -m unittest test_kde
+
+'''
+
+import unittest
+
+import numpy as np
+
+import consensus
+
+class FFTEngineTest(unittest.TestCase):
+
+    kde = 'fft'
+
+    def compare(self,xv,yv,survey='first'):
+
+        # ir_peak must agree to within a pixel, and the rest of the answer exactly
+
+        grid = consensus.ir_consensus(xv,yv,survey,include_peak_data=False,kde='grid')
+        fft = consensus.ir_consensus(xv,yv,survey,include_peak_data=False,kde=self.kde)
+
+        self.assertEqual(grid['ir_flag'],fft['ir_flag'])
+        self.assertEqual(grid['n_ir'],fft['n_ir'])
+        self.assertEqual(grid['ir_level'],fft['ir_level'])
+        if grid.has_key('ir_peak'):
+            self.assertTrue(abs(grid['ir_peak'][0]-fft['ir_peak'][0]) <= 1 and abs(grid['ir_peak'][1]-fft['ir_peak'][1]) <= 1,
+                            'Peaks differ: {0} and {1}'.format(grid['ir_peak'],fft['ir_peak']))
+        else:
+            self.assertEqual(grid['ir'],fft['ir'])
+
+    def test_single_host(self):
+
+        rng = np.random.RandomState(1)
+        for i in range(20):
+            n = rng.randint(4,30)
+            center = rng.uniform(50,370,2)
+            xv = list(center[0] + rng.normal(0,rng.uniform(2,15),n))
+            yv = list(center[1] + rng.normal(0,rng.uniform(2,15),n))
+            self.compare(xv,yv)
+
+    def test_two_hosts(self):
+
+        rng = np.random.RandomState(2)
+        for i in range(20):
+            n1,n2 = rng.randint(3,15,2)
+            c1,c2 = rng.uniform(50,370,2),rng.uniform(50,370,2)
+            xv = list(np.concatenate([c1[0] + rng.normal(0,5,n1),c2[0] + rng.normal(0,5,n2)]))
+            yv = list(np.concatenate([c1[1] + rng.normal(0,5,n1),c2[1] + rng.normal(0,5,n2)]))
+            self.compare(xv,yv)
+
+    def test_no_sources(self):
+
+        self.compare([-99.,-99.,-99.,120.],[-99.,-99.,-99.,240.])
+
+    def test_collinear(self):
+
+        self.compare([100.,110.,120.,130.,140.],[200.,210.,220.,230.,240.])
+        self.compare([100.,100.,100.,100.,100.],[200.,210.,220.,230.,240.])
+
+class MeanShiftEngineTest(FFTEngineTest):
+
+    kde = 'meanshift'
+
+    def compare_peaks(self,xv,yv,survey='first'):
+
+        # The number of peaks as well. A narrow ridge running across the pixels can have several
+        # pixels that are each the highest in their neighbourhood, which count_peaks counts as
+        # separate peaks, so the grid may find more than the mode finder, but never fewer.
+
+        self.compare(xv,yv,survey)
+        grid = consensus.ir_consensus(xv,yv,survey,include_peak_data=True,kde='grid')
+        ms = consensus.ir_consensus(xv,yv,survey,include_peak_data=True,kde='meanshift')
+        self.assertEqual(grid['ir_peak'],ms['ir_peak'])
+
+        return grid['peak_data']['npeaks'],ms['peak_data']['npeaks']
+
+    def test_peaks_single_host(self):
+
+        rng = np.random.RandomState(3)
+        for i in range(20):
+            n = rng.randint(4,30)
+            center = rng.uniform(50,370,2)
+            xv = list(center[0] + rng.normal(0,rng.uniform(2,15),n))
+            yv = list(center[1] + rng.normal(0,rng.uniform(2,15),n))
+            npeaks_grid,npeaks_ms = self.compare_peaks(xv,yv)
+            self.assertEqual(npeaks_grid,npeaks_ms)
+
+    def test_peaks_shoulder(self):
+
+        # A few clicks on the shoulder of the main peak aren't a peak of their own
+
+        xv = [200.,201.,202.,199.,200.5,201.5,199.5,200.,207.,208.]
+        yv = [300.,301.,299.,300.5,302.,300.,299.,301.5,305.,304.]
+        self.assertEqual(self.compare_peaks(xv,yv),(1,1))
+
+    def test_peaks_two_hosts(self):
+
+        rng = np.random.RandomState(4)
+        for i in range(20):
+            n1,n2 = rng.randint(3,15,2)
+            c1,c2 = rng.uniform(50,370,2),rng.uniform(50,370,2)
+            xv = list(np.concatenate([c1[0] + rng.normal(0,5,n1),c2[0] + rng.normal(0,5,n2)]))
+            yv = list(np.concatenate([c1[1] + rng.normal(0,5,n1),c2[1] + rng.normal(0,5,n2)]))
+            npeaks_grid,npeaks_ms = self.compare_peaks(xv,yv)
+            self.assertTrue(1 <= npeaks_ms <= npeaks_grid)
+
+    def test_collinear(self):
+
+        # The grid engine falls back to the mean of the clicks; the mode finder still finds a peak on the line
+
+        ir = consensus.ir_consensus([100.,110.,120.,130.,140.],[200.,210.,220.,230.,240.],'first',include_peak_data=False,kde='meanshift')
+        self.assertEqual(ir['ir_flag'],1)
+        xpeak,ypeak = ir['ir_peak']
+        self.assertTrue(abs((ypeak - xpeak) - 100*500/424.) <= 1)
+
+class PeakDataTest(unittest.TestCase):
+
+    def test_tile(self):
+
+        # The cropped tile expands back to the density over the whole grid
+
+        xv,yv = [100.,104.,120.,130.,90.],[200.,215.,220.,230.,240.]
+        for kde in consensus.kde_engines:
+            ir = consensus.ir_consensus(xv,yv,'first',include_peak_data=True,kde=kde)
+            pd = ir['peak_data']
+            x0,x1,y0,y1 = pd['extent']
+            self.assertEqual(pd['Z'].shape,(x1-x0,y1-y0))
+            Z = consensus.peak_density(pd,'first')
+            self.assertAlmostEqual(Z.sum()/pd['Z'].sum(),1.,places=5)
+
+    def test_collinear_meanshift(self):
+
+        # The mode finder gives a peak for co-linear clicks, but there's no density to crop
+
+        ir = consensus.ir_consensus([100.,110.,120.,130.,140.],[200.,210.,220.,230.,240.],'first',include_peak_data=True,kde='meanshift')
+        self.assertEqual(ir['ir_flag'],1)
+        pd = ir['peak_data']
+        self.assertEqual(consensus.peak_density(pd,'first').shape,pd['Z'].shape)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+from __future__ import division
+
+'''
+
+test_master.py
+
+Checks the master consensus catalog, kept as JSON lines with an index of where the latest consensus
+for each subject is (consensus.open_master, write_master, master_index): that lookups find the
+replacement when an update appends a new consensus for a subject, that removed subjects are gone,
+and that compact_master keeps only the current consensus for each subject. The catalog is
+written to a temporary directory.
+
+Run with: python -m unittest test_master
+
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import consensus
+
+def result(zid,n_votes,n_total=10):
+    return {'zid':zid,'n_votes':n_votes,'n_total':n_total,'answer':{}}
+
+class MasterTest(unittest.TestCase):
+
+    filestem = 'consensus_rgz_first'
+
+    def setUp(self):
+
+        self.saved = consensus.rgz_path
+        consensus.rgz_path = tempfile.mkdtemp()
+        os.makedirs('{0}/json'.format(consensus.rgz_path))
+
+        store = consensus.open_master(self.filestem,update=False)
+        for zid,n_votes in (('ARG0000001',9),('ARG0000002',4),('ARG0000003',8)):
+            consensus.write_master(store,result(zid,n_votes))
+        consensus.close_master(store)
+
+        # An incremental run replaces the second subject and takes out the third
+        store = consensus.open_master(self.filestem,update=True)
+        consensus.write_master(store,result('ARG0000002',10))
+        consensus.remove_master(store,'ARG0000003')
+        consensus.close_master(store)
+
+    def tearDown(self):
+        shutil.rmtree(consensus.rgz_path)
+        consensus.rgz_path = self.saved
+
+    def lines(self,kind):
+
+        with open(consensus.master_files(self.filestem)[kind],'r') as f:
+            return f.readlines()
+
+    def check_current(self):
+
+        index = consensus.master_index(self.filestem)
+        self.assertEqual(sorted(index.keys()),['ARG0000001','ARG0000002'])
+        self.assertEqual(index['ARG0000002'][1],1.)
+
+        self.assertEqual(consensus.read_master(self.filestem,'ARG0000002',index),result('ARG0000002',10))
+        self.assertEqual(consensus.read_master(self.filestem,'ARG0000001',index),result('ARG0000001',9))
+
+        # In the order they were written, and filtered on the consensus level in the index
+        self.assertEqual(list(consensus.iter_master(self.filestem)),[result('ARG0000001',9),result('ARG0000002',10)])
+        self.assertEqual(list(consensus.iter_master(self.filestem,min_level=0.95)),[result('ARG0000002',10)])
+
+    def test_update(self):
+
+        self.check_current()
+
+        # The old versions are still in the catalog, but not in the index
+        self.assertEqual(len(self.lines('jsonl')),4)
+        self.assertEqual(len(self.lines('index')),5)
+
+    def test_compact(self):
+
+        consensus.compact_master(self.filestem)
+        self.check_current()
+
+        self.assertEqual(len(self.lines('jsonl')),2)
+        self.assertEqual(len(self.lines('index')),2)
+        self.assertFalse(os.path.exists(consensus.master_files(self.filestem)['jsonl']+'.tmp'))
+
+        # Compacting again changes nothing
+        before = self.lines('jsonl'),self.lines('index')
+        consensus.compact_master(self.filestem)
+        self.assertEqual((self.lines('jsonl'),self.lines('index')),before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+from __future__ import division
+
+'''
+
+test_replay.py
+
+Checks that replaying the classifications (consensus.replay_consensus) gives, at each cutoff date,
+the same catalog as finding the consensus from scratch with only the classifications made by
+then, and that retired_only keeps the subjects that would have been retired at the time. The
+Mongo collections are replaced by small in-memory ones (see test_workers).
+
+Run with: python -m unittest test_replay
+
+'''
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import consensus
+from test_workers import FakeCollection, make_sample
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+
+        # One classification a day for each subject, so each cutoff sees a few more of them. The
+        # first subject in the survey only needs 5 classifications to be retired, and the second
+        # isn't classified after the first cutoff, so its consensus is carried over.
+
+        self.subs,self.docs = make_sample(8)
+        start = datetime.datetime(2014,3,1)
+        for doc in self.docs:
+            i,j = divmod(doc['_id'],1000)
+            doc['created_at'] = doc['updated_at'] = start + datetime.timedelta(days=j,minutes=i)
+        self.subs[1]['metadata']['contour_count'] = 1
+        self.docs = [doc for doc in self.docs if doc['subject_ids'] != [3] or doc['_id'] % 1000 < 6]
+
+        self.saved = (consensus.subjects,consensus.classifications,consensus.rgz_path)
+        consensus.subjects = FakeCollection(self.subs)
+        consensus.classifications = FakeCollection(self.docs)
+        consensus.rgz_path = tempfile.mkdtemp()
+        os.makedirs('{0}/csv'.format(consensus.rgz_path))
+        os.makedirs('{0}/json'.format(consensus.rgz_path))
+
+        self.cutoffs = [datetime.datetime(2014,3,d,23) for d in (5,10,20)]
+
+    def tearDown(self):
+        shutil.rmtree(consensus.rgz_path)
+        consensus.subjects,consensus.classifications,consensus.rgz_path = self.saved
+
+    def catalog(self,cutoff):
+
+        # The catalog written for a cutoff, and the subjects in its CSV file
+
+        filestem = 'consensus_rgz_first_{0}'.format(cutoff.strftime('%Y%m%d'))
+        master = dict([(cons['zid'],json.dumps(cons,sort_keys=True)) for cons in consensus.iter_master(filestem)])
+        with open('{0}/csv/{1}.csv'.format(consensus.rgz_path,filestem)) as f:
+            rows = set([line.split(',')[0] for line in f.readlines()[1:]])
+
+        return master,rows
+
+    def expected(self,cutoff):
+
+        # The consensus of every subject in the survey from its classifications up to the cutoff
+
+        master = {}
+        for sub in self.subs:
+            if sub['metadata']['survey'] != 'first':
+                continue
+            records = [consensus.Classification(doc) for doc in self.docs if doc['subject_ids'] == [sub['_id']] and doc['updated_at'] <= cutoff]
+            cons = consensus.checksum_from_records(sub,sorted(records,key=lambda c: c._id),include_peak_data=False)
+            if cons is not None:
+                cons['consensus_level'] = cons['n_votes']/cons['n_total']
+                master[cons['zid']] = (len(records),json.dumps(cons,sort_keys=True))
+
+        return master
+
+    def test_replay(self):
+
+        consensus.replay_consensus('first',self.cutoffs,retired_only=False)
+        for cutoff in self.cutoffs:
+            master,rows = self.catalog(cutoff)
+            expected = self.expected(cutoff)
+            self.assertEqual(master,dict([(zid,cons) for zid,(n,cons) in expected.iteritems()]))
+            self.assertEqual(rows,set(master.keys()))
+
+    def test_retired_only(self):
+
+        consensus.replay_consensus('first',self.cutoffs,retired_only=True)
+        for cutoff in self.cutoffs:
+            master,rows = self.catalog(cutoff)
+            retired = [(zid,cons) for zid,(n,cons) in self.expected(cutoff).iteritems()
+                       if n >= consensus.retirement_limit(consensus.subjects.find_one({'zooniverse_id':zid}))]
+            self.assertEqual(master,dict(retired))
+
+        # Only the subject with a single radio component is retired by the first cutoff
+        self.assertEqual(self.catalog(self.cutoffs[0])[0].keys(),[self.subs[1]['zooniverse_id']])
+        self.assertEqual(len(self.catalog(self.cutoffs[-1])[0]),3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+from __future__ import division
+
+'''
+
+test_run.py
+
+Checks full runs of the consensus (consensus.run_sample) on a small sample: that an incremental
+run only finds the consensus again for subjects whose classifications have changed since their
+watermark (consensus.changed_subjects), and that a run stopped after a checkpoint and resumed
+writes the same outputs as one that wasn't, with each subject in them once. The Mongo collections are replaced by small in-memory ones
+(see test_workers), and the catalogs are written to a temporary directory.
+
+Run with: python -m unittest test_run
+
+'''
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import consensus
+from test_workers import FakeCollection, make_sample
+
+class FakeDatabase(dict):
+
+    # Collections are made when they're first used, as in Mongo
+
+    def __missing__(self,name):
+        self[name] = FakeCollection(name=name)
+        return self[name]
+
+class Interrupted(Exception):
+    pass
+
+class RunSampleTest(unittest.TestCase):
+
+    survey = 'first'
+
+    def setUp(self):
+
+        self.subs,self.docs = make_sample(8)
+        for sub in self.subs:
+            sub['state'] = 'complete'
+        self.zooniverse_ids = [sub['zooniverse_id'] for sub in self.subs if sub['metadata']['survey'] == self.survey]
+
+        self.saved = (consensus.subjects,consensus.classifications,consensus.db,consensus.rgz_path,consensus.cache_path,sys.stdout)
+        consensus.subjects = FakeCollection(self.subs)
+        consensus.classifications = FakeCollection(self.docs)
+        consensus.db = FakeDatabase()
+        consensus.rgz_path = tempfile.mkdtemp()
+        consensus.cache_path = None
+        os.makedirs('{0}/csv'.format(consensus.rgz_path))
+        os.makedirs('{0}/json'.format(consensus.rgz_path))
+
+        self.saved_iter,self.saved_sink = consensus.iter_consensus_variants,consensus.OutputSink
+
+        # Progress is printed as the run goes
+        sys.stdout = open(os.devnull,'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        shutil.rmtree(consensus.rgz_path)
+        consensus.subjects,consensus.classifications,consensus.db,consensus.rgz_path,consensus.cache_path,sys.stdout = self.saved
+        consensus.iter_consensus_variants = self.saved_iter
+        consensus.OutputSink = self.saved_sink
+
+    def collection(self):
+
+        return consensus.db['consensus{0}'.format(consensus.version)]
+
+    def run_started(self):
+
+        # Start time of the run that found the consensus for each subject in the master catalog
+
+        filestem = 'consensus_rgz_{0}'.format(self.survey)
+
+        return dict([(cons['zid'],cons['watermark']['run_started']) for cons in consensus.iter_master(filestem)])
+
+    def test_changed_subjects(self):
+
+        consensus.run_sample(self.survey,update=False)
+        before = self.run_started()
+        self.assertEqual(sorted(before.keys()),sorted(self.zooniverse_ids))
+
+        # A classification of the first subject is edited after the run, and the second has a
+        # new classification that only shows up in its count
+
+        edited,counted = self.subs[1],self.subs[3]
+        for doc in self.docs:
+            if doc['subject_ids'] == [edited['_id']]:
+                doc['updated_at'] = datetime.datetime.utcnow()
+                break
+        counted['classification_count'] += 1
+
+        self.assertEqual(consensus.changed_subjects(consensus.iter_master('consensus_rgz_{0}'.format(self.survey)),
+                                                    dict([(sub['zooniverse_id'],sub['classification_count']) for sub in self.subs])),
+                         [edited['zooniverse_id'],counted['zooniverse_id']])
+
+        consensus.run_sample(self.survey,update=True)
+        after = self.run_started()
+        self.assertEqual(sorted(after.keys()),sorted(self.zooniverse_ids))
+
+        redone = sorted([zid for zid in self.zooniverse_ids if after[zid] != before[zid]])
+        self.assertEqual(redone,[edited['zooniverse_id'],counted['zooniverse_id']])
+
+        # The redone subjects replace their rows in the CSV file and the consensus collection
+        with open('{0}/csv/consensus_rgz_{1}.csv'.format(consensus.rgz_path,self.survey)) as f:
+            rows = sorted([line.split(',')[0] for line in f.readlines()[1:]])
+        self.assertEqual(sorted(set(rows)),sorted(self.zooniverse_ids))
+        self.assertEqual(sorted([doc['zooniverse_id'] for doc in self.collection().docs]),rows)
+
+    def outputs(self):
+
+        # Everything written by a run: the CSV file, the lines of the master catalog (without the
+        # watermarks, which have the time of the run), and the documents in the consensus collection
+
+        filestem = 'consensus_rgz_{0}'.format(self.survey)
+        with open('{0}/csv/{1}.csv'.format(consensus.rgz_path,filestem)) as f:
+            csv = f.read()
+        with open(consensus.master_files(filestem)['jsonl']) as f:
+            master = [json.loads(line) for line in f]
+        for cons in master:
+            del cons['watermark']
+        docs = sorted([json.dumps(doc,sort_keys=True) for doc in self.collection().docs])
+
+        return csv,master,docs
+
+    def test_resume(self):
+
+        consensus.run_sample(self.survey,update=False)
+        expected = self.outputs()
+        consensus.db = FakeDatabase()
+
+        # Stop the run after three subjects, one more than the checkpoint. The outputs for the
+        # third are all written before it stops, as the worst case for the resumed run.
+
+        sinks = []
+        def interrupted(*args,**kwargs):
+            for n,results in enumerate(self.saved_iter(*args,**kwargs)):
+                if n == 3:
+                    raise Interrupted()
+                yield results
+        def recorded(*args,**kwargs):
+            sink = self.saved_sink(*args,**kwargs)
+            sinks.append(sink)
+            return sink
+
+        consensus.iter_consensus_variants,consensus.OutputSink = interrupted,recorded
+        self.assertRaises(Interrupted,consensus.run_sample,self.survey,update=False,checkpoint_every=2)
+        consensus.iter_consensus_variants,consensus.OutputSink = self.saved_iter,self.saved_sink
+
+        for sink in sinks:
+            sink.close()
+            consensus.flush_master(sink.store)
+            sink.fc.close()
+            sink.store['json'].close()
+
+        with open(consensus.master_files('consensus_rgz_{0}'.format(self.survey))['jsonl']+'.tmp') as f:
+            self.assertEqual(len(f.readlines()),3)
+        self.assertEqual(len(set([doc['zooniverse_id'] for doc in self.collection().docs])),3)
+
+        consensus.run_sample(self.survey,update=False,resume=True,checkpoint_every=2)
+        csv,master,docs = self.outputs()
+
+        self.assertEqual(csv,expected[0])
+        self.assertEqual(sorted([cons['zid'] for cons in master]),sorted(self.zooniverse_ids))
+        self.assertEqual(master,expected[1])
+        self.assertEqual(docs,expected[2])
+
+        # Resuming a finished run does nothing
+        consensus.run_sample(self.survey,update=False,resume=True,checkpoint_every=2)
+        self.assertEqual(self.outputs(),(csv,master,docs))
+
+if __name__ == '__main__':
+    unittest.main()
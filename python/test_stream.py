@@ -0,0 +1,95 @@
+from __future__ import division
+
+'''
+
+test_stream.py
+
+Checks the online consensus for a live feed of classifications (consensus.stream_consensus): that
+the final consensus for each subject is the same as a batch run gives, including for subjects
+dropped from the stream state and restarted from the database, and that late classifications of
+finished subjects are ignored. The Mongo collections are replaced by small in-memory ones (see
+test_workers).
+
+Run with: python -m unittest test_stream
+
+'''
+
+import cStringIO
+import datetime
+import json
+import logging
+import unittest
+
+from bson import json_util
+
+import consensus
+from test_workers import FakeCollection, make_sample
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (consensus.subjects,consensus.classifications)
+        self.subs,self.docs = make_sample(nsubjects=4)
+
+        # The feed is also written to the database, as it is in production
+        consensus.subjects = FakeCollection(self.subs)
+        consensus.classifications = FakeCollection(self.docs)
+
+        # Each subject dropped from the state is logged as a warning
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        consensus.subjects,consensus.classifications = self.saved
+        logging.disable(logging.NOTSET)
+
+    def stream(self,docs,**kwargs):
+
+        out = cStringIO.StringIO()
+        consensus.stream_consensus([json_util.dumps(doc)+'\n' for doc in docs],out,**kwargs)
+
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def assertBatch(self,results):
+
+        # Exactly one final consensus for each subject, the same as checksum gives for it
+
+        final = [cons for cons in results if cons['final']]
+        self.assertEqual(sorted([cons['zid'] for cons in final]),sorted([sub['zooniverse_id'] for sub in self.subs]))
+
+        for cons in final:
+            self.assertEqual(cons['n_classifications'],20)
+            batch = consensus.checksum(cons['zid'],include_peak_data=False,cache=False)
+            for key in ('consensus_level','n_classifications','stable','final'):
+                del cons[key]
+            self.assertEqual(cons,json.loads(json.dumps(batch)))
+
+    def test_final_matches_batch(self):
+
+        results = self.stream(self.docs)
+        self.assertBatch(results)
+
+        # Updates only come out when the answer changes
+        self.assertTrue(len(results) < len(self.docs))
+
+    def test_dropped_restarted(self):
+
+        # With room for one subject, each classification in turn drops the other subject, which
+        # carries on from its votes in the database
+
+        interleaved = sorted(self.docs,key=lambda doc: (doc['_id'] % 1000,doc['_id']))
+        self.assertBatch(self.stream(interleaved,max_subjects=1))
+
+    def test_late_classification_ignored(self):
+
+        # A classification of a retired subject, after it's been forgotten as finished
+
+        late = dict(self.docs[0],_id=99999,user_name='late',created_at=datetime.datetime(2014,4,1),updated_at=datetime.datetime(2014,4,1))
+        consensus.classifications.insert(late)
+
+        results = self.stream(self.docs + [late],max_subjects=1)
+        self.assertEqual(len([cons for cons in results if cons['final']]),len(self.subs))
+        self.assertEqual(results[-1]['zid'],self.subs[-1]['zooniverse_id'])
+        self.assertTrue(results[-1]['final'])
+
+if __name__ == '__main__':
+    unittest.main()
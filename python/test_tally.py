@@ -0,0 +1,310 @@
+from __future__ import division
+
+'''
+
+test_tally.py
+
+Checks the vote tally behind the consensus for a single subject: that radio sources are told
+apart by their components (consensus.answer_key) and found again in the contour file
+(consensus.find_component), that leaving a user out of the tally (consensus.tally_without_user)
+counts the same votes as starting again without them, that upweighted users get the extra votes
+stored for them by weight_users (consensus.variant_weights), that a cached consensus isn't used
+once a classification has been edited (consensus.fresh_cache), and that the bootstrap
+uncertainty (consensus.bootstrap_tally) shares tied resamples and can be repeated with a seed.
+The Mongo collections are replaced by small in-memory ones (see test_workers).
+
+Run with: python -m unittest test_tally
+
+'''
+
+import datetime
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import consensus
+from test_workers import FakeCollection
+
+def bbox(xmax,ymax,xmin,ymin):
+    return {'xmax':xmax,'ymax':ymax,'xmin':xmin,'ymin':ymin}
+
+def classification(i,galaxies,user_name=None):
+
+    # A classification made i minutes into the sample; galaxies is a list of (components, IR click)
+
+    annotations = []
+    for comps,ir in galaxies:
+        annotations.append({'radio':dict([(str(k),comp) for k,comp in enumerate(comps)]),
+                            'ir':'No Sources' if ir is None else {'0':{'x':ir[0],'y':ir[1]}}})
+    annotations.append({'finished_at':''})
+    created = datetime.datetime(2014,3,1) + datetime.timedelta(minutes=i)
+
+    return {'_id':i,'subject_ids':[0],'annotations':annotations,'user_name':user_name,
+            'created_at':created,'updated_at':created}
+
+# Four components; the first two and the last two have the same sum of xmax
+components = [bbox(10.,50.,5.,40.),bbox(30.,80.,20.,60.),bbox(15.,120.,8.,100.),bbox(25.,160.,18.,140.)]
+
+subject = {'_id':0,'zooniverse_id':'ARG0000000','classification_count':10,
+           'metadata':{'survey':'first','source':'S0','contour_count':4}}
+
+class ComponentTest(unittest.TestCase):
+
+    def test_same_xmax_sum(self):
+
+        # Two sources whose xmax add up to the same number are both in the answer
+
+        galaxies = [(components[:2],(100.,100.)),(components[2:],(300.,300.))]
+        records = [consensus.Classification(classification(i,galaxies)) for i in range(5)]
+        cons = consensus.checksum_from_records(subject,records,include_peak_data=False)
+
+        self.assertEqual(len(cons['answer']),2)
+        self.assertEqual(sorted([ans['ind'] for ans in cons['answer'].itervalues()]),[0,1])
+        self.assertEqual(len(consensus.csv_rows(dict(cons,consensus_level=1.))),2)
+
+        # The keys survive a trip through the JSON catalog
+        self.assertEqual(sorted(json.loads(json.dumps(cons))['answer'].keys()),sorted(cons['answer'].keys()))
+
+    def test_different_combinations(self):
+
+        # The same number of components, grouped differently, is a different answer
+
+        pairs = [(components[:2],None),(components[2:],None)]
+        cross = [([components[0],components[2]],None),([components[1],components[3]],None)]
+        records = [consensus.Classification(classification(i,pairs if i < 3 else cross)) for i in range(5)]
+        cons = consensus.checksum_from_records(subject,records,include_peak_data=False)
+        self.assertEqual(cons['n_votes'],3)
+
+        one = consensus.one_answer_from_records(subject,[records[4]])
+        self.assertEqual(len(set(one['answer'].keys()) & set(cons['answer'].keys())),0)
+        one = consensus.one_answer_from_records(subject,[records[0]])
+        self.assertEqual(set(one['answer'].keys()),set(cons['answer'].keys()))
+
+    def test_find_component(self):
+
+        # Bounding boxes copied into the annotations are matched to the contour file, even when
+        # they're strings or were rounded on either side of a boundary
+
+        contours = {'contours':[[{'bbox':[c['xmax'],c['ymax'],c['xmin'],c['ymin']]}] for c in components]}
+        contours['contours'][1][0]['bbox'][0] = 30.0004999
+        index = consensus.component_index(contours)
+
+        self.assertEqual(consensus.find_component(index,(10.,50.,5.,40.)),0)
+        self.assertEqual(consensus.find_component(index,('30.0005','80','20','60')),1)
+        self.assertEqual(consensus.find_component(index,(25.001,160.,18.,140.)),3)
+        self.assertEqual(consensus.find_component(index,(26.,160.,18.,140.)),None)
+        self.assertEqual(consensus.find_component(consensus.component_index({'contours':[]}),(10.,50.,5.,40.)),None)
+
+class LeaveOneOutTest(unittest.TestCase):
+
+    pairs = [(components[:2],(100.,100.)),(components[2:],(300.,300.))]
+    cross = [([components[0],components[2]],(100.,100.)),([components[1],components[3]],(300.,300.))]
+
+    def records(self,votes,seconds=60):
+
+        # votes is a list of (user_name, galaxies), made a number of seconds apart
+
+        docs = []
+        for i,(user_name,galaxies) in enumerate(votes):
+            doc = classification(i,galaxies,user_name)
+            doc['created_at'] = doc['updated_at'] = datetime.datetime(2014,3,1) + datetime.timedelta(seconds=i*seconds)
+            docs.append(consensus.Classification(doc))
+
+        return docs
+
+    def assertRecount(self,records,user_name):
+
+        tally = consensus.vote_tally(subject,records)
+        reduced = consensus.tally_without_user(tally,user_name)
+        recount = consensus.vote_tally(subject,[c for c in records if c.user_name != user_name])
+
+        ids = lambda clist: [c._id for c in clist]
+        for t in (reduced,recount):
+            t['ids'] = [ids(t[k]) for k in ('records','clist_nodup','clist')]
+        for k in ('ids','cdict','cowner','extra','n_removed'):
+            self.assertEqual(reduced[k],recount[k])
+
+        cons = consensus.consensus_from_tally(reduced,include_ir=False)
+        expected = consensus.consensus_from_tally(recount,include_ir=False)
+        self.assertEqual((cons['n_votes'],cons['n_total']),(expected['n_votes'],expected['n_total']))
+        self.assertEqual(sorted(cons['answer'].keys()),sorted(expected['answer'].keys()))
+
+    def test_remove_user(self):
+
+        # Repeat classifications by the same user and anonymous ones are in the tally too
+
+        votes = [('u1',self.pairs),('u2',self.cross),(None,self.pairs),('u3',self.pairs),
+                 ('u1',self.cross),(None,self.cross),('u4',self.cross),('u2',self.pairs),(None,self.pairs)]
+        records = self.records(votes)
+        for user_name in ('u1','u2','u3','u4','u5'):
+            self.assertRecount(records,user_name)
+
+    def test_anonymous_duplicates(self):
+
+        # The same anonymous answer twice within 30 seconds is counted once, which depends on
+        # who else classified in between
+
+        votes = [(None,self.pairs),('u1',self.cross),(None,self.pairs),('u2',self.pairs),(None,self.cross),(None,self.cross)]
+        records = self.records(votes,seconds=10)
+        for user_name in ('u1','u2'):
+            self.assertRecount(records,user_name)
+
+class WeightTest(unittest.TestCase):
+
+    # Weights stored by a run of weight_users with scaling=3; they aren't what the current
+    # agreement of the users would give with any other scaling
+
+    users = [{'user_name':'u1','agreed':9,'gs_seen':10,'weight':3},
+             {'user_name':'u2','agreed':2,'gs_seen':10,'weight':1},
+             {'user_name':'u3','agreed':4,'gs_seen':4,'weight':0}]
+
+    def setUp(self):
+        self.saved = (consensus.user_weights,consensus.weight_params,consensus._weight_table,consensus._weight_params)
+        consensus.user_weights = FakeCollection(self.users)
+        consensus.weight_params = FakeCollection([{'_id':'parameters','scheme':'scaling','min_gs':5,'min_agree':0.5,'scaling':3}])
+        consensus.get_user_weights(reload=True)
+
+        galaxies = [(components[:2],(100.,100.))]
+        self.records = [consensus.Classification(classification(i,galaxies,user)) for i,user in enumerate(('u1','u2','u3',None))]
+
+    def tearDown(self):
+        consensus.user_weights,consensus.weight_params,consensus._weight_table,consensus._weight_params = self.saved
+        consensus._variant_tables.clear()
+
+    def test_stored_weights(self):
+
+        # checksum counts the votes as if each user's classification had been repeated as many
+        # times as their stored weight says, whatever the scaling asked for
+
+        for weights in (1,5,20):
+            cons = consensus.checksum_from_records(subject,self.records,include_peak_data=False,weights=weights,scheme='scaling')
+            self.assertEqual((cons['n_votes'],cons['n_total']),(8,8))
+
+        # 'threshold' gives weights extra votes to the users with a weight of 1
+        cons = consensus.checksum_from_records(subject,self.records,include_peak_data=False,weights=5,scheme='threshold')
+        self.assertEqual((cons['n_votes'],cons['n_total']),(9,9))
+
+        self.assertEqual(consensus.variant_weights('scaling',20),{'u1':3,'u2':1})
+
+    def test_sweep_weights(self):
+
+        # The variants of a sweep find the weights again from the agreement, with the thresholds
+        # the stored weights were found with
+
+        tally = consensus.vote_tally(subject,self.records)
+        self.assertEqual(consensus.weighted_tally(tally,20,'scaling',recompute=True)['extra'],[18,4,0,0])
+        self.assertEqual(consensus.weighted_tally(tally,2,'threshold',recompute=True)['extra'],[2,0,0,0])
+        self.assertEqual(consensus.weighted_tally(tally,20,'scaling')['extra'],[3,1,0,0])
+
+class CacheTest(unittest.TestCase):
+
+    pairs = [(components[:2],(100.,100.)),(components[2:],(300.,300.))]
+    cross = [([components[0],components[2]],(100.,100.)),([components[1],components[3]],(300.,300.))]
+
+    def setUp(self):
+
+        self.docs = [classification(i,self.pairs,'u{0:d}'.format(i)) for i in range(10)]
+
+        self.saved = (consensus.subjects,consensus.classifications,consensus.cache_path,consensus.checksum_from_records)
+        consensus.subjects = FakeCollection([dict(subject)])
+        consensus.classifications = FakeCollection(self.docs)
+        consensus.cache_path = tempfile.mkdtemp()
+
+        # Count how often the consensus is actually found, rather than read from the cache
+        self.n_found = 0
+        def counted(*args,**kwargs):
+            self.n_found += 1
+            return self.saved[3](*args,**kwargs)
+        consensus.checksum_from_records = counted
+
+    def tearDown(self):
+        shutil.rmtree(consensus.cache_path)
+        consensus.subjects,consensus.classifications,consensus.cache_path,consensus.checksum_from_records = self.saved
+
+    def test_edited_classification(self):
+
+        cons = consensus.checksum(subject['zooniverse_id'],include_peak_data=False)
+        self.assertEqual(cons['n_votes'],10)
+        self.assertEqual(consensus.checksum(subject['zooniverse_id'],include_peak_data=False),cons)
+        self.assertEqual(self.n_found,1)
+
+        # Three users change their answers; the subject's classification count stays the same
+
+        for doc in self.docs[:3]:
+            doc.update(classification(doc['_id'],self.cross,doc['user_name']))
+            doc['updated_at'] = datetime.datetime(2014,4,1)
+
+        edited = consensus.checksum(subject['zooniverse_id'],include_peak_data=False)
+        self.assertEqual(edited['n_votes'],7)
+        self.assertEqual(self.n_found,2)
+        self.assertEqual(consensus.checksum(subject['zooniverse_id'],include_peak_data=False),edited)
+        self.assertEqual(self.n_found,2)
+
+        # A new classification changes the count
+
+        consensus.classifications.insert(classification(10,self.pairs,'u10'))
+        consensus.subjects.docs[0]['classification_count'] += 1
+        self.assertEqual(consensus.checksum(subject['zooniverse_id'],include_peak_data=False)['n_votes'],8)
+        self.assertEqual(self.n_found,3)
+
+class FixedDraws(object):
+
+    # Random numbers for bootstrap_tally with the resamples of the votes chosen in advance
+
+    def __init__(self,draws,seed=0):
+        self.draws = np.array(draws)
+        self.rng = np.random.RandomState(seed)
+
+    def randint(self,low,high,size):
+        assert self.draws.shape == size and self.draws.max() < high
+        return self.draws
+
+    def rand(self,*shape):
+        return self.rng.rand(*shape)
+
+class BootstrapTest(unittest.TestCase):
+
+    # Two votes for the pairs of components, and one each for two other ways of grouping them
+
+    pairs = [(components[:2],(100.,100.)),(components[2:],(300.,300.))]
+    cross = [([components[0],components[2]],(100.,100.)),([components[1],components[3]],(300.,300.))]
+    single = [(components,(200.,200.))]
+
+    def setUp(self):
+        votes = (self.pairs,self.pairs,self.cross,self.single)
+        self.records = [consensus.Classification(classification(i,galaxies,'u{0:d}'.format(i))) for i,galaxies in enumerate(votes)]
+        self.tally = consensus.vote_tally(subject,self.records)
+
+    def test_tied_runner_up(self):
+
+        # The first resample is a tie between the two runners-up, which share its win; the
+        # pairs win the second, and share the third with the crossed pairs
+
+        draws = [[2,3,2,3],[0,1,2,3],[0,2,0,2]]
+        r = consensus.bootstrap_tally(self.tally,n_boot=3,n_sub=5,n_max=4,rng=FixedDraws(draws))
+
+        self.assertEqual((r['n_votes'],r['n_total']),(2,4))
+        self.assertAlmostEqual(r['p_winner'],(0 + 1 + 0.5)/3)
+        self.assertAlmostEqual(r['p_runner_up'],(0.5 + 0 + 0.5)/3)
+        self.assertEqual(r['n_winners'],3)
+
+    def test_seed(self):
+
+        saved = (consensus.subjects,consensus.classifications)
+        consensus.subjects = FakeCollection([subject])
+        consensus.classifications = FakeCollection([classification(i,galaxies,'u{0:d}'.format(i)) for i,galaxies in
+                                                    enumerate((self.pairs,self.cross,self.pairs,self.single,self.pairs))])
+        try:
+            runs = [list(consensus.iter_uncertainty([subject['zooniverse_id']],n_boot=50,n_sub=20,seed=seed)) for seed in (3,3,4)]
+        finally:
+            consensus.subjects,consensus.classifications = saved
+
+        self.assertEqual(len(runs[0]),1)
+        np.testing.assert_equal(runs[0],runs[1])
+        self.assertNotEqual(runs[0][0]['stability_subsample'][1],runs[2][0]['stability_subsample'][1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+from __future__ import division
+
+'''
+
+test_workers.py
+
+Checks that the consensus comes out the same, byte for byte, whether it's run in a single process
+or shared out to a pool of workers (consensus.iter_consensus_variants with workers=1 and workers=N).
+The Mongo collections are replaced by small in-memory ones, so no database is needed.
+
+Run with: python -m unittest test_workers
+
+'''
+
+import cStringIO
+import datetime
+import json
+import unittest
+
+import numpy as np
+
+import consensus
+
+class FakeCursor(list):
+
+    def sort(self,key,direction=1):
+        keys = [(key,direction)] if isinstance(key,basestring) else key
+        for field,direction in reversed(keys):
+            list.sort(self,key=lambda doc: field_value(doc,field),reverse=direction < 0)
+        return self
+
+    def count(self):
+        return len(self)
+
+    def limit(self,n):
+        return FakeCursor(self[:n]) if n > 0 else self
+
+def field_value(doc,field):
+
+    # Value of a field in a document, following dotted names into subdocuments
+
+    for name in field.split('.'):
+        doc = doc.get(name) if isinstance(doc,dict) else None
+    return doc
+
+def matches(value,cond):
+
+    # Whether a value satisfies one condition of a Mongo query. A list matches if any of its
+    # elements do, as in Mongo.
+
+    if isinstance(value,list) and not (isinstance(cond,dict) and cond.has_key('$exists')):
+        return any([matches(v,cond) for v in value]) or value == cond
+    if not isinstance(cond,dict):
+        return value == cond
+
+    ok = True
+    for op,arg in cond.iteritems():
+        if op == '$in':
+            ok = ok and value in arg
+        elif op == '$gt':
+            ok = ok and value is not None and value > arg
+        elif op == '$gte':
+            ok = ok and value is not None and value >= arg
+        elif op == '$lt':
+            ok = ok and value is not None and value < arg
+        elif op == '$lte':
+            ok = ok and value is not None and value <= arg
+        elif op == '$ne':
+            ok = ok and value != arg
+        elif op == '$exists':
+            ok = ok and (value is not None) == arg
+        else:
+            raise NotImplementedError(op)
+    return ok
+
+class FakeCollection(object):
+
+    # Just enough of a Mongo collection (with the pymongo 3 API) for the consensus: find() with
+    # equality, $in, $gt, $gte, $lt, $lte, $ne and $exists, and the writes used by the output sink
+
+    def __init__(self,docs=None,name='fake'):
+        self.docs = list(docs) if docs is not None else []
+        self.name = name
+
+    def find(self,query=None,fields=None,no_cursor_timeout=False):
+        query = query or {}
+        return FakeCursor([doc for doc in self.docs if all([matches(field_value(doc,field),cond) for field,cond in query.iteritems()])])
+
+    def find_one(self,query=None,fields=None):
+        found = self.find(query,fields)
+        return found[0] if len(found) > 0 else None
+
+    def index_information(self):
+        return {}
+
+    def create_index(self,keys,name=None):
+        return name
+
+    def insert(self,docs):
+        self.docs.extend(docs if isinstance(docs,list) else [docs])
+
+    def remove(self,query=None):
+        found = self.find(query)
+        self.docs = [doc for doc in self.docs if not any([doc is f for f in found])]
+
+    def drop(self):
+        self.docs = []
+
+def make_sample(nsubjects=12,seed=5):
+
+    # Subjects with two to four radio components each, and classifications that group them in
+    # different ways with scattered IR clicks
+
+    rng = np.random.RandomState(seed)
+    start = datetime.datetime(2014,3,1)
+
+    subs,docs = [],[]
+    for i in range(nsubjects):
+        zid = 'ARG{0:07d}'.format(i)
+        survey = ('atlas','first')[i % 2]
+        sub = {'_id':i,'zooniverse_id':zid,'classification_count':20,
+               'metadata':{'survey':survey,'source':'S{0:d}'.format(i),'contour_count':rng.randint(2,5)}}
+        subs.append(sub)
+
+        ncomp = sub['metadata']['contour_count']
+        bboxes = [[round(x,6) for x in rng.uniform(50,400,4)] for j in range(ncomp)]
+        hosts = rng.uniform(60,360,(ncomp,2))
+
+        for j in range(20):
+            # Split the components into one or more galaxies
+            groups = rng.randint(0,rng.randint(1,ncomp+1),ncomp)
+            annotations = []
+            for g in sorted(set(groups)):
+                members = [k for k in range(ncomp) if groups[k] == g]
+                radio = dict([(str(m),dict(zip(('xmax','ymax','xmin','ymin'),bboxes[k]))) for m,k in enumerate(members)])
+                if rng.rand() < 0.15:
+                    ir = 'No Sources'
+                else:
+                    x,y = hosts[members[0]] + rng.normal(0,4,2)
+                    ir = {'0':{'x':x,'y':y}}
+                annotations.append({'radio':radio,'ir':ir})
+            annotations.append({'finished_at':''})
+            created = start + datetime.timedelta(hours=i,minutes=j)
+            docs.append({'_id':1000*i+j,'subject_ids':[i],'annotations':annotations,
+                         'user_name':None if j % 5 == 0 else 'user{0:d}'.format(j % 7),
+                         'created_at':created,'updated_at':created})
+
+    return subs,docs
+
+def install_sample():
+
+    # Replace the collections in this process; forked workers inherit them, and connect_mongo
+    # (the pool initializer) must not overwrite them with real connections
+
+    subs,docs = make_sample()
+    consensus.subjects = FakeCollection(subs)
+    consensus.classifications = FakeCollection(docs)
+
+    return [sub['zooniverse_id'] for sub in subs]
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (consensus.subjects,consensus.classifications,consensus.connect_mongo)
+        self.zooniverse_ids = install_sample()
+        consensus.connect_mongo = lambda: None
+
+    def tearDown(self):
+        consensus.subjects,consensus.classifications,consensus.connect_mongo = self.saved
+
+    def output(self,workers,**kwargs):
+
+        # Everything the output sink would write for the run: the master catalog and its index,
+        # the CSV rows, and the documents for the consensus collection
+
+        store = {'json':cStringIO.StringIO(),'index':[]}
+        rows = []
+        for results in consensus.iter_consensus_variants(self.zooniverse_ids,workers=workers,chunk_size=3,
+                                                          run_started='2016-01-01T00:00:00',**kwargs):
+            for cons in results:
+                if cons is not None:
+                    consensus.write_master(store,cons)
+                    rows.extend(consensus.csv_rows(cons))
+                    rows.extend([json.dumps(doc,sort_keys=True) for doc in consensus.mongo_rows(cons,cons['survey'])])
+
+        return store['json'].getvalue() + ''.join(store['index']) + ''.join(rows)
+
+    def test_workers_identical(self):
+
+        variants = [('scaling',0)]
+        serial = self.output(1,variants=variants,kde='fft')
+        self.assertTrue(len(serial) > 0)
+        for workers in (2,4):
+            self.assertEqual(serial,self.output(workers,variants=variants,kde='fft'))
+
+    def test_workers_identical_alternatives(self):
+
+        variants = [('scaling',0)]
+        serial = self.output(1,variants=variants,kde='grid',top_k=3,ir_count=True)
+        self.assertEqual(serial,self.output(3,variants=variants,kde='grid',top_k=3,ir_count=True))
+
+if __name__ == '__main__':
+    unittest.main()
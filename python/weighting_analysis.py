@@ -230,14 +230,9 @@ def plot_weighted_consensus(zid,savefig=False):
 
                 if ans.has_key('peak_data'):
 
-                    xmin = 1.
-                    xmax = img_params[survey]['IMG_HEIGHT_NEW']
-                    ymin = 1.
-                    ymax = img_params[survey]['IMG_WIDTH_NEW']
-
                     # Plot the KDE map
                     colormap = colormaparr.pop()
-                    ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=[xmin, xmax, ymin, ymax])
+                    ax3.imshow(np.rot90(ans['peak_data']['Z']), cmap=colormap,extent=ans['peak_data']['extent'])
             
                     # Plot individual sources
                     color = colorarr.pop()